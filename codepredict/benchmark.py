@@ -0,0 +1,225 @@
+"""
+Benchmark the featurization path of the predictor stage by stage:
+extract_dataflow, DFG_javascript, convert_examples_to_features and compute_attn_mask.
+
+    python benchmark.py                                   # run, write benchmarks/featurize-<commit>.json
+    python benchmark.py --compare old.json new.json       # compare two runs
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+from pathlib import Path
+
+import settings
+
+STAGES = ["parse", "extract_dataflow", "DFG_javascript", "convert_examples_to_features", "compute_attn_mask"]
+
+
+def synthetic_functions(count: int, seed: int = settings.seed) -> list[dict]:
+    """
+    Generate minified-looking and large functions, which are the slow cases of the real traffic
+    """
+    rng = random.Random(seed)
+    names = [chr(c) for c in range(ord('a'), ord('z') + 1)]
+    records = []
+    for i in range(count):
+        statements = rng.randint(200, 800) if i % 2 else rng.randint(10, 40)
+        body = []
+        for j in range(statements):
+            a, b, c = rng.choice(names), rng.choice(names), rng.choice(names)
+            kind = rng.randint(0, 4)
+            if kind == 0:
+                body.append(f"var {a}{j}={b}+{c}*{j}")
+            elif kind == 1:
+                body.append(f"if({a}&&{b}.{c}){{{a}={b}[{j}]}}else{{{c}=void 0}}")
+            elif kind == 2:
+                body.append(f"for(var {a}=0;{a}<{b}.length;{a}++){c}.push({b}[{a}])")
+            elif kind == 3:
+                body.append(f"{a}=function({b},{c}){{return {b}?{c}:{b}}}({a},{j})")
+            else:
+                body.append(f"{a}.{b}={c}||{{}},{c}.{a}=\"s{j}\"")
+        kind = "large" if i % 2 else "minified"
+        records.append({"code": f"function(e,t,n){{{';'.join(body)};return e}}", "label": None, "kind": kind})
+    return records
+
+
+def load_records(dataset: str, limit: int | None) -> list[dict]:
+    records = []
+    files = [Path(dataset)] if os.path.isfile(dataset) else sorted(Path(dataset).glob('**/*.jsonl'))
+    for file in files:
+        with file.open() as f:
+            for line in f:
+                if line.strip():
+                    records.append({"code": json.loads(line)["code"], "label": None, "kind": "dataset"})
+    if limit is not None:
+        records = records[:limit]
+    return records
+
+
+def _stage_functions(tokenizer):
+    """
+    :return: stage name -> (prepare(record) -> args, run(*args)); only run is measured
+    """
+    from parser import remove_comments_and_docstrings, tree_to_token_index, index_to_code_token
+    from utils import BundleDataset, convert_examples_to_features, extract_dataflow, parser as js_parser
+
+    def strip(code):
+        try:
+            return remove_comments_and_docstrings(code, 'javascript')
+        except:
+            return code
+
+    def prepare_dfg(record):
+        code = strip(record["code"])
+        root_node = js_parser[0].parse(code.encode('utf-8', errors='replace')).root_node
+        tokens_index = tree_to_token_index(root_node)
+        lines = code.split('\n')
+        index_to_code = {}
+        for idx, index in enumerate(tokens_index):
+            index_to_code[index] = (idx, index_to_code_token(index, lines))
+        return root_node, index_to_code
+
+    def prepare_mask(record):
+        return (convert_examples_to_features(record, tokenizer, {}),)
+
+    return {
+        "parse": (lambda r: (strip(r["code"]).encode('utf-8', errors='replace'),),
+                  lambda code: js_parser[0].parse(code)),
+        "extract_dataflow": (lambda r: (r["code"],),
+                             lambda code: extract_dataflow(code, js_parser, 'javascript')),
+        "DFG_javascript": (prepare_dfg,
+                           lambda root_node, index_to_code: js_parser[1](root_node, index_to_code, {})),
+        "convert_examples_to_features": (lambda r: (r,),
+                                         lambda r: convert_examples_to_features(r, tokenizer, {})),
+        "compute_attn_mask": (prepare_mask, BundleDataset.compute_attn_mask),
+    }
+
+
+def _percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * q / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def run_stage(prepare, run, records: list[dict], repeats: int) -> dict:
+    inputs = [prepare(r) for r in records]
+    # warm up caches of the parser and the tokenizer
+    for args in inputs[:3]:
+        run(*args)
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for args in inputs:
+            t = time.perf_counter()
+            run(*args)
+            latencies.append(time.perf_counter() - t)
+    total = time.perf_counter() - start
+
+    # tracemalloc slows execution down, so memory is measured in a separate pass
+    peak = 0
+    tracemalloc.start()
+    for args in inputs:
+        tracemalloc.reset_peak()
+        run(*args)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+    return {
+        "calls": len(latencies),
+        "throughput_per_s": len(latencies) / total if total > 0 else 0.0,
+        "latency_ms_p50": _percentile(latencies, 50) * 1000,
+        "latency_ms_p99": _percentile(latencies, 99) * 1000,
+        "latency_ms_mean": sum(latencies) / max(len(latencies), 1) * 1000,
+        "peak_memory_kb": peak / 1024,
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=settings.SCRIPT_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def benchmark(dataset: str, synthetic: int, repeats: int, limit: int | None, stages: list[str]) -> dict:
+    from transformers import RobertaTokenizer
+    tokenizer = RobertaTokenizer.from_pretrained(settings.model_name)
+    groups = {"dataset": load_records(dataset, limit)}
+    for record in synthetic_functions(synthetic):
+        groups.setdefault(record["kind"], []).append(record)
+    functions = _stage_functions(tokenizer)
+
+    results = {}
+    for group, records in groups.items():
+        if not records:
+            continue
+        results[group] = {"functions": len(records),
+                          "mean_code_chars": sum(len(r["code"]) for r in records) / len(records)}
+        for stage in stages:
+            prepare, run = functions[stage]
+            results[group][stage] = run_stage(prepare, run, records, repeats)
+            print(f"{group:>10} {stage:>30}: {results[group][stage]['throughput_per_s']:10.1f}/s "
+                  f"p50 {results[group][stage]['latency_ms_p50']:8.2f}ms "
+                  f"p99 {results[group][stage]['latency_ms_p99']:8.2f}ms "
+                  f"peak {results[group][stage]['peak_memory_kb']:10.1f}KB")
+    return {
+        "commit": _git_commit(),
+        "time": time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime()),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "config": {"code_length": settings.code_length, "data_flow_length": settings.data_flow_length,
+                   "repeats": repeats, "synthetic": synthetic, "dataset": dataset},
+        "results": results,
+    }
+
+
+def compare(base_file: str, new_file: str):
+    with open(base_file) as f:
+        base = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    print(f"{base['commit']} -> {new['commit']}")
+    for group, stages in new["results"].items():
+        for stage, result in stages.items():
+            old = base["results"].get(group, {}).get(stage)
+            if not isinstance(result, dict) or not isinstance(old, dict):
+                continue
+            changes = []
+            for metric in ["throughput_per_s", "latency_ms_p50", "latency_ms_p99", "peak_memory_kb"]:
+                change = (result[metric] - old[metric]) / old[metric] * 100 if old[metric] else 0.0
+                changes.append(f"{metric} {old[metric]:.2f} -> {result[metric]:.2f} ({change:+.1f}%)")
+            print(f"{group:>10} {stage:>30}: " + ", ".join(changes))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", default=f"{settings.SCRIPT_DIR}/dataset/tiny", type=str,
+                        help="A .jsonl file or a directory of .jsonl files.")
+    parser.add_argument("--limit", default=None, type=int, help="Use at most this many dataset functions.")
+    parser.add_argument("--synthetic", default=20, type=int, help="Number of synthetic minified/large functions.")
+    parser.add_argument("--repeats", default=3, type=int)
+    parser.add_argument("--stages", default=",".join(STAGES), type=str)
+    parser.add_argument("--output", default=None, type=str,
+                        help="Result file, defaults to benchmarks/featurize-<commit>.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), default=None,
+                        help="Compare two result files instead of running the benchmark.")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        random.seed(settings.seed)
+        result = benchmark(args.dataset, args.synthetic, args.repeats, args.limit, args.stages.split(","))
+        output = args.output or f"{settings.SCRIPT_DIR}/benchmarks/featurize-{result['commit']}.json"
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Results written to {output}")
@@ -0,0 +1,212 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+class EncoderCache:
+    """
+    LRU cache of pooled [CLS] encoder outputs, keyed by a hash of the feature tensors.
+    Different raw code often normalizes to the same features, and the same function is often
+    re-queried (e.g. with another topn), so the head can run without re-encoding.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(input_ids, position_idx, attn_mask) -> bytes:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(np.asarray(input_ids, dtype=np.int32).tobytes())
+        h.update(np.asarray(position_idx, dtype=np.int32).tobytes())
+        # the graph-guided mask depends on the data flow edges, not only on the ids
+        h.update(np.packbits(np.asarray(attn_mask, dtype=bool)).tobytes())
+        return h.digest()
+
+    def get(self, key: bytes):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: bytes, pooled):
+        size = pooled.element_size() * pooled.nelement()
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = pooled
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= evicted.element_size() * evicted.nelement()
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses}
+
+
+class FeatureCache:
+    """
+    Persistent cache of convert_examples_to_features results of unlabeled functions, in a SQLite file
+    shared by all server workers. The features only depend on the code, the tokenizer and the sequence
+    lengths, so the cache stays valid across checkpoints and the parse/DFG/tokenization of a function
+    seen before (e.g. when re-running a crawl after a model update) is skipped.
+    Cached features do not keep input_tokens, which is only needed for debugging.
+    """
+    # bump when the feature layout or the encoding below changes
+    FORMAT_VERSION = 2
+    # token ids (vocabulary < 65536), positions and data flow indexes (< code + data flow length) fit in uint16;
+    # dfg_to_code holds offsets into the subtokens before truncation, which exceed it for large functions
+    DTYPES = (np.uint16, np.uint16, np.uint32, np.uint16, np.uint16)
+
+    def __init__(self, path: str, max_bytes: int, code_length: int, data_flow_length: int, tokenizer_name: str):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._local = threading.local()
+        self._config = f"{self.FORMAT_VERSION}:{tokenizer_name}:{code_length}:{data_flow_length}".encode()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS features (key BLOB PRIMARY KEY, value BLOB NOT NULL)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can not be shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def key(self, code: str) -> bytes:
+        h = hashlib.blake2b(self._config, digest_size=16)
+        h.update(code.encode('utf-8', errors='replace'))
+        return h.digest()
+
+    @classmethod
+    def encode(cls, feature) -> bytes:
+        dfg_to_dfg_lengths = [len(x) for x in feature.dfg_to_dfg]
+        values = [feature.input_ids, feature.position_idx, feature.dfg_to_code, dfg_to_dfg_lengths,
+                  [y for x in feature.dfg_to_dfg for y in x]]
+        arrays = [np.asarray(v, dtype=dtype).reshape(-1) for v, dtype in zip(values, cls.DTYPES)]
+        header = np.asarray([len(a) for a in arrays], dtype=np.uint32).tobytes()
+        return zlib.compress(header + b"".join(a.tobytes() for a in arrays))
+
+    @classmethod
+    def decode(cls, value: bytes):
+        from utils import InputFeatures
+        data = zlib.decompress(value)
+        lengths = np.frombuffer(data, dtype=np.uint32, count=5)
+        offset = lengths.nbytes
+        arrays = []
+        for length, dtype in zip(lengths, cls.DTYPES):
+            arrays.append(np.frombuffer(data, dtype=dtype, count=int(length), offset=offset).tolist())
+            offset += int(length) * np.dtype(dtype).itemsize
+        input_ids, position_idx, dfg_to_code, dfg_to_dfg_lengths, dfg_to_dfg_flat = arrays
+        dfg_to_code = [(dfg_to_code[i], dfg_to_code[i + 1]) for i in range(0, len(dfg_to_code), 2)]
+        dfg_to_dfg, start = [], 0
+        for length in dfg_to_dfg_lengths:
+            dfg_to_dfg.append(dfg_to_dfg_flat[start:start + length])
+            start += length
+        return InputFeatures(None, input_ids, position_idx, dfg_to_code, dfg_to_dfg, [])
+
+    def get(self, code: str):
+        try:
+            row = self._connection().execute("SELECT value FROM features WHERE key = ?",
+                                              (self.key(code),)).fetchone()
+        except sqlite3.Error:
+            # a busy or broken cache must not fail the prediction
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.decode(row[0])
+
+    def put(self, code: str, feature):
+        try:
+            with self._connection() as connection:
+                connection.execute("INSERT OR IGNORE INTO features (key, value) VALUES (?, ?)",
+                                   (self.key(code), self.encode(feature)))
+            self._puts += 1
+            if self._puts % 1000 == 0:
+                self._evict()
+        except sqlite3.Error:
+            pass
+
+    def _evict(self):
+        connection = self._connection()
+        page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+        pages = connection.execute("PRAGMA page_count").fetchone()[0] - \
+            connection.execute("PRAGMA freelist_count").fetchone()[0]
+        if page_size * pages <= self.max_bytes:
+            return
+        # drop the oldest quarter, freed pages are reused by later inserts
+        with connection:
+            connection.execute("DELETE FROM features WHERE rowid IN "
+                               "(SELECT rowid FROM features ORDER BY rowid LIMIT (SELECT COUNT(*) / 4 FROM features))")
+
+    def stats(self) -> dict:
+        return {"path": self.path, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical computations: while do(key, compute) runs for a key, other callers with
+    the same key wait for it and share its result (or exception) instead of computing it again.
+    Only threads of one process are coalesced, e.g. the request threads of a gunicorn worker.
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, compute):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = compute()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
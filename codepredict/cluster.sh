@@ -1,3 +1,3 @@
 #!/usr/bin/env bash
 port=$1
-gunicorn -w 20 -b 0.0.0.0:${port} predictServer:app
\ No newline at end of file
+python3 "$(dirname "$0")/launcher.py" --workers 20 --bind 0.0.0.0:${port}
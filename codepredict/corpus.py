@@ -0,0 +1,283 @@
+"""
+Compressed, indexed corpus format for the training data, replacing directories of raw JSONL.
+
+A corpus is a directory with index.json and shard files. Every shard is a sequence of zlib-compressed chunks;
+a chunk stores its records column by column (label ids, package ids, code offsets, code bytes). index.json
+holds the label and package tables and the offset of every chunk, so a record is read by decompressing a
+single chunk, and shards can be read in parallel.
+
+    python corpus.py convert dataset/full-dataset dataset/full.corpus   # JSONL file or directory -> corpus
+    python corpus.py sample dataset/full.corpus dataset/small.corpus --records 100000
+    python corpus.py info dataset/full.corpus
+"""
+import argparse
+import bisect
+import json
+import os
+import random
+import threading
+import zlib
+from collections import OrderedDict
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+
+INDEX_FILE = "index.json"
+FORMAT_VERSION = 1
+
+
+def is_corpus(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, INDEX_FILE))
+
+
+def jsonl_records(inputs: str):
+    files = [Path(inputs)] if os.path.isfile(inputs) else sorted(Path(inputs).glob('**/*.jsonl'))
+    for file in files:
+        with file.open() as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+class CorpusWriter:
+    def __init__(self, output_dir: str, shard_records: int = 100_000, chunk_records: int = 1024, level: int = 6):
+        self.output_dir = output_dir
+        self.shard_records = shard_records
+        self.chunk_records = chunk_records
+        self.level = level
+        self.labels: list[dict] = []
+        self.packages: list[str] = []
+        self._label_ids: dict[str, int] = {}
+        self._package_ids: dict[str, int] = {}
+        self._shards: list[dict] = []
+        self._chunk: list[tuple[str, int, int]] = []
+        self._file = None
+        os.makedirs(output_dir, exist_ok=True)
+        # the index of an earlier conversion into the same directory would describe the new shards
+        if os.path.exists(os.path.join(output_dir, INDEX_FILE)):
+            os.remove(os.path.join(output_dir, INDEX_FILE))
+
+    def add(self, record: dict):
+        # the label table keeps the whole label (packageVersion, isEsModule, ...), not only the triple
+        label_key = json.dumps(record["label"], sort_keys=True)
+        label_id = self._label_ids.get(label_key)
+        if label_id is None:
+            label_id = self._label_ids[label_key] = len(self.labels)
+            self.labels.append(record["label"])
+        package = record["label"]["packageName"]
+        package_id = self._package_ids.get(package)
+        if package_id is None:
+            package_id = self._package_ids[package] = len(self.packages)
+            self.packages.append(package)
+        self._chunk.append((record["code"], label_id, package_id))
+        if len(self._chunk) >= self.chunk_records:
+            self._flush_chunk()
+
+    def _flush_chunk(self):
+        if not self._chunk:
+            return
+        if self._file is None or self._shards[-1]["records"] >= self.shard_records:
+            self._open_shard()
+        codes = [code.encode("utf-8", errors="replace") for code, _, _ in self._chunk]
+        offsets = np.zeros(len(codes) + 1, dtype=np.uint64)
+        offsets[1:] = np.cumsum([len(c) for c in codes])
+        columns = [
+            np.asarray([len(codes)], dtype=np.uint32).tobytes(),
+            np.asarray([label for _, label, _ in self._chunk], dtype=np.uint32).tobytes(),
+            np.asarray([package for _, _, package in self._chunk], dtype=np.uint32).tobytes(),
+            offsets.tobytes(),
+            b"".join(codes),
+        ]
+        data = zlib.compress(b"".join(columns), self.level)
+        shard = self._shards[-1]
+        shard["chunks"].append({"offset": self._file.tell(), "length": len(data), "records": len(codes)})
+        shard["records"] += len(codes)
+        self._file.write(data)
+        self._chunk = []
+
+    def _open_shard(self):
+        if self._file is not None:
+            self._file.close()
+        name = f"shard-{len(self._shards):05d}.bin"
+        self._file = open(os.path.join(self.output_dir, name), "wb")
+        self._shards.append({"file": name, "records": 0, "chunks": []})
+
+    def close(self):
+        self._flush_chunk()
+        if self._file is not None:
+            self._file.close()
+        index = {"version": FORMAT_VERSION, "records": sum(s["records"] for s in self._shards),
+                 "labels": self.labels, "packages": self.packages, "shards": self._shards}
+        # written last, a directory without index.json is an incomplete conversion
+        tmp = os.path.join(self.output_dir, f".{INDEX_FILE}")
+        with open(tmp, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp, os.path.join(self.output_dir, INDEX_FILE))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+        elif self._file is not None:
+            # no index, the partial corpus must not look complete
+            self._file.close()
+
+
+def convert(inputs: str, output_dir: str, **kwargs) -> int:
+    with CorpusWriter(output_dir, **kwargs) as writer:
+        count = 0
+        for record in jsonl_records(inputs):
+            writer.add(record)
+            count += 1
+    return count
+
+
+def _decode_chunk(data: bytes) -> tuple[np.ndarray, np.ndarray, np.ndarray, bytes]:
+    data = zlib.decompress(data)
+    n = int(np.frombuffer(data, dtype=np.uint32, count=1)[0])
+    offset = 4
+    labels = np.frombuffer(data, dtype=np.uint32, count=n, offset=offset)
+    offset += 4 * n
+    packages = np.frombuffer(data, dtype=np.uint32, count=n, offset=offset)
+    offset += 4 * n
+    code_offsets = np.frombuffer(data, dtype=np.uint64, count=n + 1, offset=offset)
+    offset += 8 * (n + 1)
+    return labels, packages, code_offsets, data[offset:]
+
+
+class Corpus:
+    """
+    Random and sequential access to a corpus written by CorpusWriter. Records are {"code", "label"} like the
+    JSONL lines they were converted from.
+    """
+
+    def __init__(self, path: str, cached_chunks: int = 8):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            index = json.load(f)
+        if index["version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported corpus version {index['version']} in {path}")
+        self.labels: list[dict] = index["labels"]
+        self.packages: list[str] = index["packages"]
+        self.shards: list[dict] = index["shards"]
+        # first record number of every chunk, for the binary search of random access
+        self._chunks: list[tuple[int, int]] = []
+        self._chunk_starts: list[int] = []
+        start = 0
+        for s, shard in enumerate(self.shards):
+            for c, chunk in enumerate(shard["chunks"]):
+                self._chunks.append((s, c))
+                self._chunk_starts.append(start)
+                start += chunk["records"]
+        self._length = start
+        self._cached_chunks = cached_chunks
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._length
+
+    def read_chunk(self, shard: int, chunk: int):
+        entry = self.shards[shard]["chunks"][chunk]
+        with open(os.path.join(self.path, self.shards[shard]["file"]), "rb") as f:
+            f.seek(entry["offset"])
+            return _decode_chunk(f.read(entry["length"]))
+
+    def _chunk(self, number: int):
+        with self._lock:
+            decoded = self._cache.get(number)
+            if decoded is not None:
+                self._cache.move_to_end(number)
+                return decoded
+        decoded = self.read_chunk(*self._chunks[number])
+        with self._lock:
+            self._cache[number] = decoded
+            while len(self._cache) > self._cached_chunks:
+                self._cache.popitem(last=False)
+        return decoded
+
+    def _record(self, decoded, i: int) -> dict:
+        labels, _, code_offsets, codes = decoded
+        code = codes[int(code_offsets[i]):int(code_offsets[i + 1])].decode("utf-8")
+        return {"code": code, "label": self.labels[int(labels[i])]}
+
+    def __getitem__(self, item: int) -> dict:
+        if item < 0:
+            item += self._length
+        if not 0 <= item < self._length:
+            raise IndexError(item)
+        number = bisect.bisect_right(self._chunk_starts, item) - 1
+        return self._record(self._chunk(number), item - self._chunk_starts[number])
+
+    def shard_records(self, shard: int):
+        with open(os.path.join(self.path, self.shards[shard]["file"]), "rb") as f:
+            for entry in self.shards[shard]["chunks"]:
+                f.seek(entry["offset"])
+                decoded = _decode_chunk(f.read(entry["length"]))
+                for i in range(entry["records"]):
+                    yield self._record(decoded, i)
+
+    def records(self, processes: int | None = None):
+        """
+        Iterate over all records in corpus order, reading shards in parallel when processes > 1
+        """
+        if not processes or processes <= 1 or len(self.shards) <= 1:
+            for shard in range(len(self.shards)):
+                yield from self.shard_records(shard)
+            return
+        with Pool(min(processes, len(self.shards))) as pool:
+            for records in pool.imap(_read_shard, [(self.path, shard) for shard in range(len(self.shards))]):
+                yield from records
+
+    def sample(self, k: int, seed: int = 42) -> list[dict]:
+        """
+        Random subset of k records; indexes are read in order so every chunk is decompressed once
+        """
+        indexes = sorted(random.Random(seed).sample(range(self._length), min(k, self._length)))
+        return [self[i] for i in indexes]
+
+
+def _read_shard(args) -> list[dict]:
+    path, shard = args
+    return list(Corpus(path, cached_chunks=0).shard_records(shard))
+
+
+def info(path: str) -> dict:
+    corpus = Corpus(path)
+    size = sum(os.path.getsize(os.path.join(path, s["file"])) for s in corpus.shards)
+    return {"records": len(corpus), "labels": len(corpus.labels), "packages": len(corpus.packages),
+            "shards": len(corpus.shards), "bytes": size}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+    convert_parser = sub.add_parser("convert", help="Convert a JSONL file or directory into a corpus.")
+    convert_parser.add_argument("inputs")
+    convert_parser.add_argument("output_dir")
+    convert_parser.add_argument("--shard_records", default=100_000, type=int)
+    convert_parser.add_argument("--chunk_records", default=1024, type=int)
+    sample_parser = sub.add_parser("sample", help="Write a random subset of a corpus as a new corpus.")
+    sample_parser.add_argument("corpus")
+    sample_parser.add_argument("output_dir")
+    sample_parser.add_argument("--records", required=True, type=int)
+    sample_parser.add_argument("--seed", default=42, type=int)
+    info_parser = sub.add_parser("info", help="Print the size of a corpus.")
+    info_parser.add_argument("corpus")
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        count = convert(args.inputs, args.output_dir, shard_records=args.shard_records,
+                        chunk_records=args.chunk_records)
+        print(f"Converted {count} records into {args.output_dir}")
+    elif args.command == "sample":
+        with CorpusWriter(args.output_dir) as writer:
+            for record in Corpus(args.corpus).sample(args.records, args.seed):
+                writer.add(record)
+        print(json.dumps(info(args.output_dir)))
+    else:
+        print(json.dumps(info(args.corpus)))
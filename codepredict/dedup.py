@@ -0,0 +1,159 @@
+"""
+Near-duplicate removal for the training data with MinHash and LSH.
+
+Functions are compared on shingles of their tokens after renaming identifiers canonically (in order of first
+use), so minified variants that only differ in variable names collide. A sample is only dropped when an
+already kept near-duplicate has the same label, so no label loses all its samples.
+
+    python dedup.py dataset/full-dataset --threshold 0.9                              # report only
+    python dedup.py dataset/full-dataset --threshold 0.9 --output dataset/dedup.corpus   # write the kept samples
+"""
+import argparse
+import hashlib
+import json
+import logging
+import re
+from collections import Counter, defaultdict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r"""//[^\n]*|/\*.*?\*/|"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|`(?:[^`\\]|\\.)*`"""
+                      r"""|[A-Za-z_$][\w$]*|\d[\w.]*|\S""", re.DOTALL)
+KEYWORDS = frozenset("""
+    await break case catch class const continue debugger default delete do else export extends false finally for
+    function if import in instanceof let new null of return static super switch this throw true try typeof
+    undefined var void while with yield async get set arguments
+""".split())
+# Mersenne prime modulus of the permutations
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+# probability that a pair at the threshold is compared at all
+MIN_RECALL = 0.99
+
+
+def normalized_tokens(code: str) -> list[str]:
+    """
+    Tokens with comments dropped and identifiers renamed by first use; property names (after '.') are kept
+    because they are part of the behavior and usually survive minification
+    """
+    names = {}
+    tokens = []
+    previous = None
+    for token in TOKEN_RE.findall(code):
+        if token.startswith("//") or token.startswith("/*"):
+            continue
+        if (token[0].isalpha() or token[0] in "_$") and token not in KEYWORDS and previous != ".":
+            token = names.setdefault(token, f"v{len(names)}")
+        tokens.append(token)
+        previous = token
+    return tokens
+
+
+def shingles(tokens: list[str], size: int) -> set[int]:
+    if len(tokens) < size:
+        grams = [" ".join(tokens)]
+    else:
+        grams = [" ".join(tokens[i:i + size]) for i in range(len(tokens) - size + 1)]
+    return {int.from_bytes(hashlib.blake2b(g.encode(), digest_size=4).digest(), "little") for g in grams}
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = 128, seed: int = 42):
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, _MAX_HASH, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, _MAX_HASH, size=num_perm, dtype=np.uint64)
+
+    def signature(self, values: set[int]) -> np.ndarray:
+        hashes = np.fromiter(values, dtype=np.uint64, count=len(values))
+        # universal hashing (a * x + b) mod p, with 32-bit inputs and parameters the product fits in uint64
+        permuted = (hashes[:, None] * self.a[None, :] + self.b[None, :]) % _PRIME
+        return (permuted & _MAX_HASH).min(axis=0).astype(np.uint32)
+
+
+def lsh_bands(num_perm: int, threshold: float) -> tuple[int, int]:
+    """
+    Bands and rows per band (bands * rows <= num_perm) for recall: a pair at the threshold becomes a candidate with
+    probability 1 - (1 - s^r)^b >= MIN_RECALL. Of those, the one with the most rows per band, so with the fewest
+    spurious candidates; deduplicate compares the full signatures of every candidate anyway.
+    """
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        if 1 - (1 - threshold ** rows) ** bands < MIN_RECALL:
+            break
+        best = (bands, rows)
+    return best
+
+
+def deduplicate(records: list[dict], threshold: float, num_perm: int = 128, shingle_size: int = 5,
+                label_key=None) -> tuple[list[dict], dict]:
+    """
+    Drop the records that have an earlier kept record with the same label and an estimated Jaccard similarity
+    of their normalized token shingles of at least threshold.
+    :param label_key: record -> hashable label, default is the (packageName, functionFile, functionName) triple
+    :return: kept records (in input order) and a report of what was removed
+    """
+    if label_key is None:
+        label_key = lambda r: (r["label"]["packageName"], r["label"]["functionFile"], r["label"]["functionName"])
+    hasher = MinHasher(num_perm)
+    bands, rows = lsh_bands(num_perm, threshold)
+    buckets = [defaultdict(list) for _ in range(bands)]
+    kept, signatures, kept_labels = [], [], []
+    removed_per_label = Counter()
+    for record in records:
+        signature = hasher.signature(shingles(normalized_tokens(record["code"]), shingle_size))
+        label = label_key(record)
+        keys = [signature[band * rows:(band + 1) * rows].tobytes() for band in range(bands)]
+        candidates = {k for band, key in enumerate(keys) for k in buckets[band].get(key, ())}
+        duplicate = any(kept_labels[k] == label and np.mean(signatures[k] == signature) >= threshold
+                        for k in candidates)
+        if duplicate:
+            removed_per_label[label] += 1
+            continue
+        for band, key in enumerate(keys):
+            buckets[band][key].append(len(kept))
+        kept.append(record)
+        signatures.append(signature)
+        kept_labels.append(label)
+
+    labels_before = len({label_key(r) for r in records})
+    labels_after = len(set(kept_labels))
+    report = {
+        "threshold": threshold,
+        "num_perm": num_perm,
+        "bands": bands,
+        "rows": rows,
+        "samples": len(records),
+        "kept_samples": len(kept),
+        "removed_samples": len(records) - len(kept),
+        "labels": labels_before,
+        "removed_labels": labels_before - labels_after,
+        "labels_with_removed_samples": len(removed_per_label),
+        "most_removed": [{"label": "!!".join(label), "removed": n} for label, n in removed_per_label.most_common(10)],
+    }
+    logger.info("Near-duplicate removal (threshold %s): removed %d of %d samples, %d of %d labels",
+                threshold, report["removed_samples"], len(records), report["removed_labels"], labels_before)
+    return kept, report
+
+
+if __name__ == "__main__":
+    from corpus import Corpus, CorpusWriter, is_corpus, jsonl_records
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dataset", help="A .jsonl file, a directory of .jsonl files or a corpus.")
+    parser.add_argument("--threshold", default=0.9, type=float, help="Minimum estimated Jaccard similarity.")
+    parser.add_argument("--num_perm", default=128, type=int)
+    parser.add_argument("--shingle_size", default=5, type=int)
+    parser.add_argument("--output", default=None, type=str, help="Write the kept samples as a corpus.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    records = list(Corpus(args.dataset).records()) if is_corpus(args.dataset) else list(jsonl_records(args.dataset))
+    kept, report = deduplicate(records, args.threshold, args.num_perm, args.shingle_size)
+    if args.output:
+        with CorpusWriter(args.output) as writer:
+            for record in kept:
+                writer.add(record)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,246 @@
+import argparse
+import copy
+import json
+import logging
+import os
+import random
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import RandomSampler, DataLoader
+from tqdm import tqdm
+from transformers import (AdamW, get_linear_schedule_with_warmup, RobertaForSequenceClassification)
+
+import settings
+from model import Model
+from predict import load_model
+from train import save_checkpoint
+from utils import BundleDataset, convert_examples_to_features, set_seed
+
+logger = logging.getLogger(__name__)
+
+
+def build_student(teacher, num_layers):
+    """
+    Build a shallower student sharing the teacher's tokenizer, embeddings and head.
+    Student layer i is initialized from an evenly spaced teacher layer.
+    """
+    if getattr(teacher.config, "hierarchical_head", False):
+        raise ValueError("Distilling a hierarchical head is not supported, distill a flat teacher instead")
+    config = copy.deepcopy(teacher.config)
+    teacher_layers = config.num_hidden_layers
+    if num_layers > teacher_layers:
+        raise ValueError(f"Student has more layers ({num_layers}) than the teacher ({teacher_layers})")
+    config.num_hidden_layers = num_layers
+    student = Model(RobertaForSequenceClassification(config), config, teacher.tokenizer)
+
+    teacher_state = teacher.state_dict()
+    layer_map = [round(i * (teacher_layers - 1) / max(num_layers - 1, 1)) for i in range(num_layers)]
+    student_state = {}
+    for name in student.state_dict():
+        source = name
+        marker = "encoder.roberta.encoder.layer."
+        if name.startswith(marker):
+            idx, rest = name[len(marker):].split(".", 1)
+            source = f"{marker}{layer_map[int(idx)]}.{rest}"
+        if source in teacher_state:
+            student_state[name] = teacher_state[source].clone()
+    student.load_state_dict(student_state, strict=False)
+    logger.info("Student layers initialized from teacher layers %s", layer_map)
+    return student
+
+
+def distill_loss(student_logits, teacher_prob, labels, temperature, alpha):
+    """
+    Soft loss against the teacher's softmax outputs plus the usual hard label loss.
+    Softening p with temperature T is softmax(log(p) / T), so the teacher logits are not needed.
+    """
+    teacher_soft = F.softmax(torch.log(teacher_prob.clamp_min(1e-12)) / temperature, dim=-1)
+    student_log_soft = F.log_softmax(student_logits / temperature, dim=-1)
+    soft_loss = F.kl_div(student_log_soft, teacher_soft, reduction="batchmean") * temperature ** 2
+    hard_loss = F.cross_entropy(student_logits, labels)
+    return alpha * soft_loss + (1 - alpha) * hard_loss
+
+
+def distill(train_dataset, teacher, student, output_dir, temperature=settings.distill_temperature,
+            alpha=settings.distill_alpha):
+    """ Train the student against the teacher """
+    train_sampler = RandomSampler(train_dataset)
+    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=settings.train_batch_size,
+                                  num_workers=4)
+
+    max_steps = settings.epochs * len(train_dataloader)
+    save_steps = max(1, len(train_dataloader) // 2)
+    warmup_steps = max_steps // 5
+    teacher.to(settings.device)
+    teacher.eval()
+    student.to(settings.device)
+
+    no_decay = ['bias', 'LayerNorm.weight']
+    optimizer_grouped_parameters = [
+        {'params': [p for n, p in student.named_parameters() if not any(nd in n for nd in no_decay)],
+         'weight_decay': settings.weight_decay},
+        {'params': [p for n, p in student.named_parameters() if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
+    ]
+    optimizer = AdamW(optimizer_grouped_parameters, lr=settings.learning_rate, eps=settings.adam_epsilon)
+    scheduler = get_linear_schedule_with_warmup(optimizer, num_warmup_steps=warmup_steps,
+                                                num_training_steps=max_steps)
+
+    logger.info("***** Running distillation *****")
+    logger.info("  Num examples = %d", len(train_dataset))
+    logger.info("  Num Epochs = %d", settings.epochs)
+    logger.info("  Student layers = %d", student.config.num_hidden_layers)
+    logger.info("  Temperature = %s, alpha = %s", temperature, alpha)
+
+    global_step = 0
+    best_loss = None
+    student.zero_grad()
+    for idx in range(settings.epochs):
+        bar = tqdm(train_dataloader, total=len(train_dataloader))
+        tr_num = 0
+        train_loss = 0
+        for step, batch in enumerate(bar):
+            (inputs_ids, position_idx, attn_mask, labels) = [x.to(settings.device) for x in batch]
+            with torch.no_grad():
+                teacher_prob = teacher(inputs_ids, position_idx, attn_mask)
+            student.train()
+            student_logits = student.classifier(student.encode(inputs_ids, position_idx, attn_mask))
+            loss = distill_loss(student_logits, teacher_prob, labels, temperature, alpha)
+            if settings.gradient_accumulation_steps > 1:
+                loss = loss / settings.gradient_accumulation_steps
+
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(student.parameters(), settings.max_grad_norm)
+
+            tr_num += 1
+            train_loss += loss.item()
+            avg_loss = round(train_loss / tr_num, 5)
+            bar.set_description("epoch {} loss {}".format(idx, avg_loss))
+            if (step + 1) % settings.gradient_accumulation_steps == 0:
+                optimizer.step()
+                optimizer.zero_grad()
+                scheduler.step()
+                global_step += 1
+                if global_step % save_steps == 0 and (best_loss is None or avg_loss < best_loss):
+                    best_loss = avg_loss
+                    save_checkpoint(student, train_dataset.function2number, output_dir)
+
+
+def _rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _predict_timed(model, feature):
+    input_ids = torch.tensor(feature.input_ids, dtype=torch.long).unsqueeze(0).to(settings.device)
+    position_idx = torch.tensor(feature.position_idx, dtype=torch.long).unsqueeze(0).to(settings.device)
+    attn_mask = torch.tensor(BundleDataset.compute_attn_mask(feature)).unsqueeze(0).to(settings.device)
+    if settings.device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    with torch.no_grad():
+        prob = model(input_ids, position_idx, attn_mask)
+    if settings.device.type == "cuda":
+        torch.cuda.synchronize()
+    return time.perf_counter() - start, prob[0].cpu().numpy()
+
+
+def report(teacher_dir, student_dir, dataset, samples=200, topk=5):
+    """
+    Compare latency per function, memory and top-k agreement of a teacher and a student checkpoint.
+    The report is printed and written to <student_dir>/distill-report.json
+    """
+    records = []
+    files = [dataset] if os.path.isfile(dataset) else sorted(
+        os.path.join(root, f) for root, _, fs in os.walk(dataset) for f in fs if f.endswith(".jsonl"))
+    for file in files:
+        with open(file) as f:
+            records.extend(json.loads(line)["code"] for line in f if line.strip())
+    random.Random(settings.seed).shuffle(records)
+    records = records[:samples]
+
+    results = {}
+    probs = {}
+    for name, model_dir in [("teacher", teacher_dir), ("student", student_dir)]:
+        rss_before = _rss_mb()
+        model, tokenizer, _ = load_model(model_dir)
+        rss_after = _rss_mb()
+        checkpoint = os.path.join(model_dir, settings.checkpoint_prefix, "model.bin")
+        latencies = []
+        probs[name] = []
+        # warm up so that the first measured function does not pay for lazy initialization
+        _predict_timed(model, convert_examples_to_features({"code": records[0], "label": None}, tokenizer, {}))
+        for code in tqdm(records, desc=name):
+            feature = convert_examples_to_features({"code": code, "label": None}, tokenizer, {})
+            latency, prob = _predict_timed(model, feature)
+            latencies.append(latency)
+            probs[name].append(prob)
+        results[name] = {
+            "layers": model.config.num_hidden_layers,
+            "parameters": sum(p.numel() for p in model.parameters()),
+            "checkpoint_mb": os.path.getsize(checkpoint) / 1024 / 1024,
+            "load_rss_mb": rss_after - rss_before if rss_before is not None and rss_after is not None else None,
+            "latency_ms_mean": float(np.mean(latencies) * 1000),
+            "latency_ms_p50": float(np.percentile(latencies, 50) * 1000),
+            "latency_ms_p99": float(np.percentile(latencies, 99) * 1000),
+        }
+        del model
+
+    top1, overlap, teacher_top1_in_student = 0, 0.0, 0
+    for t, s in zip(probs["teacher"], probs["student"]):
+        t_top = list(np.argsort(t)[-topk:][::-1])
+        s_top = list(np.argsort(s)[-topk:][::-1])
+        top1 += t_top[0] == s_top[0]
+        overlap += len(set(t_top) & set(s_top)) / topk
+        teacher_top1_in_student += t_top[0] in s_top
+    n = max(len(records), 1)
+    results["agreement"] = {
+        "samples": len(records),
+        "top1": top1 / n,
+        f"top{topk}_overlap": overlap / n,
+        f"teacher_top1_in_student_top{topk}": teacher_top1_in_student / n,
+    }
+    results["speedup"] = results["teacher"]["latency_ms_mean"] / results["student"]["latency_ms_mean"]
+
+    print(json.dumps(results, indent=2))
+    with open(os.path.join(student_dir, "distill-report.json"), "w") as f:
+        json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", default=None, type=str, required=True,
+                        help="The training data (a .jsonl file or a directory of .jsonl files).")
+    parser.add_argument("--teacher_dir", default=settings.output_dir, type=str,
+                        help="Directory of the teacher checkpoint and labelMap.pkl.")
+    parser.add_argument("--output_dir", default=settings.student_output_dir, type=str,
+                        help="Directory the student checkpoint is written to, same layout as the teacher.")
+    parser.add_argument("--layers", default=settings.student_num_layers, type=int,
+                        help="Number of transformer layers of the student.")
+    parser.add_argument("--temperature", default=settings.distill_temperature, type=float)
+    parser.add_argument("--alpha", default=settings.distill_alpha, type=float)
+    parser.add_argument("--report", action='store_true',
+                        help="Only compare an already distilled student against the teacher.")
+    parser.add_argument("--report_samples", default=200, type=int)
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s', datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+    args = parser.parse_args()
+    set_seed()
+
+    if not args.report:
+        teacher, tokenizer, label_id_to_label = load_model(args.teacher_dir)
+        function2number = {v: k for k, v in label_id_to_label.items()}
+        # keep the teacher's label ids so the student is a drop-in replacement
+        train_dataset = BundleDataset(tokenizer, args.dataset, function2number=function2number, extend_labels=False)
+        student = build_student(teacher, args.layers)
+        distill(train_dataset, teacher, student, args.output_dir, args.temperature, args.alpha)
+    report(args.teacher_dir, args.output_dir, args.dataset, samples=args.report_samples)
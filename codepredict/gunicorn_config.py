@@ -0,0 +1,32 @@
+"""
+gunicorn hooks of launcher.py: give every worker its own slice of the cores and size its thread pools to it.
+"""
+import os
+
+from launcher import partition, worker_environment
+
+_partitions = None
+
+
+def _worker_partitions(workers: int) -> list[list[int]]:
+    global _partitions
+    if _partitions is None:
+        threads = os.getenv("CODEPREDICT_WORKER_CPUS")
+        _partitions = partition(workers, int(threads) if threads else None)
+    return _partitions
+
+
+def pre_fork(server, worker):
+    # runs in the master: a restarted worker takes over the slot of the worker it replaces
+    used = {getattr(w, "slot", None) for w in server.WORKERS.values()}
+    worker.slot = next(i for i in range(server.num_workers + len(used)) if i not in used)
+
+
+def post_fork(server, worker):
+    # runs in the worker before the app (and torch) is imported, so the environment sizes the thread pools
+    partitions = _worker_partitions(int(os.getenv("CODEPREDICT_WORKERS", server.num_workers)))
+    cpus = partitions[worker.slot % len(partitions)]
+    os.environ.update(worker_environment(cpus))
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    server.log.info(f"Worker {worker.slot} (pid {worker.pid}) pinned to cores {cpus}")
@@ -0,0 +1,176 @@
+"""
+Start the prediction server with CPU inference workers that do not oversubscribe the machine: the usable cores
+are partitioned across the gunicorn workers (keeping each worker inside one NUMA node where possible), every
+worker is pinned to its cores and sizes its torch/OpenMP thread pools to them.
+
+    python launcher.py --workers 4 --bind 0.0.0.0:8000            # 4 workers, cores split evenly
+    python launcher.py --workers 8 --threads 2 --bind 0.0.0.0:8000
+    python launcher.py --sweep 1x16,2x8,4x4,8x2 --duration 60     # load test each workers x threads configuration
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+
+# the gunicorn master imports this module through gunicorn_config.py, settings.py would pull in torch
+SCRIPT_DIR = os.path.split(os.path.realpath(__file__))[0]
+# request threads per worker: identical concurrent requests are only coalesced within one worker
+HTTP_THREADS = 4
+
+
+def _parse_cpulist(cpulist: str) -> list[int]:
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            lo, hi = part.split("-")
+            cpus.extend(range(int(lo), int(hi) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def available_cpus() -> list[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def numa_nodes() -> list[list[int]]:
+    """
+    The usable cores of every NUMA node, a single node if the topology is not exposed
+    """
+    usable = set(available_cpus())
+    nodes = []
+    for path in sorted(glob.glob("/sys/devices/system/node/node*/cpulist"),
+                       key=lambda p: int(re.search(r"node(\d+)", p).group(1))):
+        with open(path) as f:
+            cpus = [c for c in _parse_cpulist(f.read()) if c in usable]
+        if cpus:
+            nodes.append(cpus)
+    return nodes or [sorted(usable)]
+
+
+def partition(workers: int, threads: int | None = None) -> list[list[int]]:
+    """
+    Split the usable cores into one set per worker, disjoint as long as there are enough cores. Workers are
+    spread across the NUMA nodes in proportion to their cores and take contiguous cores of their node, so a
+    worker never straddles two nodes.
+    :param threads: cores per worker, default is an even share of the cores of its node
+    """
+    nodes = numa_nodes()
+    total = sum(len(n) for n in nodes)
+    # workers per node, proportional to its cores
+    shares = [len(n) * workers // total for n in nodes]
+    for i in sorted(range(len(nodes)), key=lambda i: -len(nodes[i]))[:workers - sum(shares)]:
+        shares[i] += 1
+    partitions = []
+    for cpus, share in zip(nodes, shares):
+        if share == 0:
+            continue
+        size = min(threads or max(len(cpus) // share, 1), len(cpus))
+        disjoint = share * size <= len(cpus)
+        for w in range(share):
+            # otherwise the blocks overlap, spread evenly over the node
+            start = w * size if disjoint else min(w * len(cpus) // share, len(cpus) - size)
+            partitions.append(cpus[start:start + size])
+    return partitions
+
+
+def worker_environment(cpus: list[int]) -> dict[str, str]:
+    threads = str(len(cpus))
+    return {
+        "CODEPREDICT_TORCH_THREADS": threads,
+        "OMP_NUM_THREADS": threads,
+        "MKL_NUM_THREADS": threads,
+    }
+
+
+def gunicorn_command(workers: int, bind: str, http_threads: int = HTTP_THREADS) -> list[str]:
+    return [sys.executable, "-m", "gunicorn", "-c", os.path.join(SCRIPT_DIR, "gunicorn_config.py"),
+            "-w", str(workers), "--threads", str(http_threads), "-b", bind, "predictServer:app"]
+
+
+def launch(workers: int, threads: int | None, bind: str, http_threads: int = HTTP_THREADS):
+    env = os.environ.copy()
+    env["CODEPREDICT_WORKERS"] = str(workers)
+    if threads is not None:
+        env["CODEPREDICT_WORKER_CPUS"] = str(threads)
+    for i, cpus in enumerate(partition(workers, threads)):
+        print(f"worker {i}: cores {','.join(map(str, cpus))}")
+    os.chdir(SCRIPT_DIR)
+    command = gunicorn_command(workers, bind, http_threads)
+    os.execvpe(command[0], command, env)
+
+
+def sweep(configurations: list[tuple[int, int]], args) -> list[dict]:
+    from loadtest import load_bodies, run_load, start_server, stop_server, wait_until_ready
+
+    bodies = load_bodies(args.inputs, args.limit)
+    url = f"http://127.0.0.1:{args.port}/"
+    results = []
+    for workers, threads in configurations:
+        name = f"{workers}x{threads}"
+        config = {"name": name, "workers": workers, "threads": threads,
+                  "command": f"{sys.executable} launcher.py --workers {workers} --threads {threads} "
+                             f"--bind 127.0.0.1:$PORT"}
+        process = start_server(config, args.port)
+        try:
+            if not wait_until_ready(url, args.startup_timeout, bodies[0]):
+                print(f"{name}: server not ready after {args.startup_timeout}s")
+                continue
+            # closed loop with enough clients to keep every worker busy
+            result = run_load(url, bodies, args.concurrency or 2 * workers, 0, args.duration, [3])
+        finally:
+            stop_server(process)
+        results.append({"config": config, **result})
+        print(f"{name:>8}: {result['throughput_per_s']:8.1f} req/s, p50 {result['latency_ms_p50']:8.1f}ms "
+              f"p99 {result['latency_ms_p99']:8.1f}ms, errors {result['error_rate'] * 100:.2f}%")
+    return results
+
+
+def default_configurations() -> list[tuple[int, int]]:
+    cores = len(available_cpus())
+    configurations = []
+    threads = 1
+    while threads <= cores:
+        configurations.append((cores // threads, threads))
+        threads *= 2
+    return configurations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default=2, type=int)
+    parser.add_argument("--threads", default=None, type=int,
+                        help="Cores (torch intra-op threads) per worker, default is an even share.")
+    parser.add_argument("--http_threads", default=HTTP_THREADS, type=int,
+                        help="Request threads per gunicorn worker; with 1, identical requests are never coalesced.")
+    parser.add_argument("--bind", default="0.0.0.0:8000", type=str)
+    parser.add_argument("--sweep", nargs="?", const="", default=None, type=str,
+                        help="Load test workers x threads configurations, e.g. 1x16,4x4; "
+                             "default is every power of two of threads that fills the cores.")
+    parser.add_argument("--inputs", default=f"{SCRIPT_DIR}/dataset/tiny", type=str)
+    parser.add_argument("--limit", default=None, type=int)
+    parser.add_argument("--port", default=8100, type=int)
+    parser.add_argument("--startup_timeout", default=600, type=float)
+    parser.add_argument("--concurrency", default=None, type=int, help="Clients of the sweep, default is 2 per worker.")
+    parser.add_argument("--duration", default=60, type=float, help="Seconds of load per configuration.")
+    parser.add_argument("--output", default=None, type=str, help="Write the sweep results as JSON.")
+    args = parser.parse_args()
+
+    if args.sweep is None:
+        launch(args.workers, args.threads, args.bind, args.http_threads)
+    else:
+        configurations = [tuple(int(x) for x in c.split("x")) for c in args.sweep.split(",") if c] \
+            or default_configurations()
+        results = sweep(configurations, args)
+        if results:
+            best = max(results, key=lambda r: r["throughput_per_s"])
+            print(f"best: {best['config']['name']} with {best['throughput_per_s']:.1f} req/s")
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"duration": args.duration, "results": results}, f, indent=2)
@@ -0,0 +1,224 @@
+"""
+Load test for predictServer.py: replay recorded function bodies like d-bundlr's query(code, topn).
+
+    # against a running server
+    python loadtest.py --url http://127.0.0.1:8000/ --concurrency 8 --rate 50 --duration 60
+    # start one server per configuration, e.g. [{"name": "w4-cache", "workers": 4, "env": {...}}]
+    python loadtest.py --configs configs.json --concurrency 8 --duration 60
+"""
+import argparse
+import json
+import os
+import random
+import signal
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# the client side only needs the standard library, settings.py would pull in torch
+SCRIPT_DIR = os.path.split(os.path.realpath(__file__))[0]
+
+
+def load_bodies(inputs: str, limit: int | None = None) -> list[str]:
+    files = [Path(inputs)] if os.path.isfile(inputs) else sorted(Path(inputs).glob('**/*.jsonl'))
+    bodies = []
+    for file in files:
+        with file.open() as f:
+            for line in f:
+                if line.strip():
+                    bodies.append(json.loads(line)["code"])
+    if not bodies:
+        raise ValueError(f"No function bodies found in {inputs}")
+    return bodies[:limit] if limit else bodies
+
+
+def query(url: str, code: str, topn: int, timeout: float, accept: str | None = None) -> int:
+    """
+    Same request as d-bundlr's predictpackage.query
+    :return: number of response bytes
+    """
+    headers = {"Content-Type": "application/json"}
+    if accept:
+        headers["Accept"] = accept
+    request = urllib.request.Request(f"{url.rstrip('/')}/predict", data=json.dumps({"code": code, "topn": topn}).encode(),
+                                     headers=headers, method="POST")
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        body = response.read()
+        # predictServer answers failed predictions with an empty list (no ids in the label-id format)
+        if body.strip() == b"[]" or b'"ids":[]' in body:
+            raise ValueError("empty prediction")
+        return len(body)
+
+
+def _percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * q / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def run_load(url: str, bodies: list[str], concurrency: int, rate: float, duration: float, topn: list[int],
+             timeout: float = 60, accept: str | None = None, seed: int = 42) -> dict:
+    """
+    :param rate: mean arrival rate (requests/s) of a Poisson process (open loop); 0 sends a new request as soon
+        as one of the concurrency clients is free (closed loop)
+    """
+    rng = random.Random(seed)
+    latencies, errors, sizes = [], [], []
+    lock = threading.Lock()
+
+    def send(code, n, scheduled):
+        try:
+            size = query(url, code, n, timeout, accept)
+            # latency counts from the scheduled arrival, so queueing in the client is not hidden
+            with lock:
+                latencies.append(time.perf_counter() - scheduled)
+                sizes.append(size)
+        except Exception as e:
+            with lock:
+                errors.append(type(e).__name__)
+
+    start = time.perf_counter()
+    end = start + duration
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        if rate > 0:
+            next_arrival = start
+            while next_arrival < end:
+                now = time.perf_counter()
+                if next_arrival > now:
+                    time.sleep(next_arrival - now)
+                pool.submit(send, rng.choice(bodies), rng.choice(topn), next_arrival)
+                next_arrival += rng.expovariate(rate)
+        else:
+            def client(client_seed):
+                client_rng = random.Random(client_seed)
+                while time.perf_counter() < end:
+                    send(client_rng.choice(bodies), client_rng.choice(topn), time.perf_counter())
+            for i in range(concurrency):
+                pool.submit(client, seed + i)
+    elapsed = time.perf_counter() - start
+
+    total = len(latencies) + len(errors)
+    return {
+        "requests": total,
+        "elapsed_s": elapsed,
+        "throughput_per_s": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "error_rate": len(errors) / total if total else 0.0,
+        "errors": {e: errors.count(e) for e in set(errors)},
+        "latency_ms_p50": _percentile(latencies, 50) * 1000,
+        "latency_ms_p90": _percentile(latencies, 90) * 1000,
+        "latency_ms_p99": _percentile(latencies, 99) * 1000,
+        "latency_ms_max": max(latencies, default=0.0) * 1000,
+        "response_bytes_mean": sum(sizes) / len(sizes) if sizes else 0.0,
+    }
+
+
+def wait_until_ready(url: str, timeout: float, probe: str) -> bool:
+    """
+    Poll /ready, or send probe requests to servers without a readiness endpoint
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(f"{url.rstrip('/')}/ready", timeout=30):
+                return True
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                try:
+                    query(url, probe, 1, timeout=30)
+                    return True
+                except Exception:
+                    pass
+        except Exception:
+            pass
+        time.sleep(2)
+    return False
+
+
+def start_server(config: dict, port: int) -> subprocess.Popen:
+    """
+    Start a server for one configuration: {"name", "workers", "threads", "env", "command"}.
+    env is passed to the workers, e.g. CODEPREDICT_ENCODER_CACHE_MB or CODEPREDICT_QUANTIZE.
+    """
+    env = os.environ.copy()
+    env.update({k: str(v) for k, v in config.get("env", {}).items()})
+    command = config.get("command") or (f"gunicorn -w {config.get('workers', 1)} --threads {config.get('threads', 1)} "
+                                        f"-b 127.0.0.1:{port} predictServer:app")
+    return subprocess.Popen(command.replace("$PORT", str(port)), shell=True, env=env, cwd=SCRIPT_DIR,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def stop_server(process: subprocess.Popen):
+    # the process group is gone if the server crashed or failed to start, that must not hide the original error
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=30)
+        return
+    except ProcessLookupError:
+        pass
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    process.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--inputs", default=f"{SCRIPT_DIR}/dataset/tiny", type=str,
+                        help="Recorded function bodies: a .jsonl file or a directory of .jsonl files with a 'code' field.")
+    parser.add_argument("--limit", default=None, type=int)
+    parser.add_argument("--url", default=os.getenv("PREDICT_SERVER", "http://127.0.0.1:8000/"), type=str)
+    parser.add_argument("--configs", default=None, type=str,
+                        help="JSON list of server configurations to start and test one after another.")
+    parser.add_argument("--port", default=8100, type=int, help="Port of the servers started for --configs.")
+    parser.add_argument("--startup_timeout", default=600, type=float)
+    parser.add_argument("--concurrency", default=8, type=int)
+    parser.add_argument("--rate", default=0, type=float, help="Requests per second, 0 for a closed loop.")
+    parser.add_argument("--duration", default=60, type=float, help="Seconds of load per configuration.")
+    parser.add_argument("--topn", default="3", type=str, help="Comma separated topn values to draw from.")
+    parser.add_argument("--accept", default=None, type=str, help="Accept header of the requests.")
+    parser.add_argument("--output", default=None, type=str, help="Write the results as JSON.")
+    args = parser.parse_args()
+
+    bodies = load_bodies(args.inputs, args.limit)
+    topn = [int(n) for n in args.topn.split(",")]
+    results = []
+    if args.configs:
+        with open(args.configs) as f:
+            configs = json.load(f)
+        for config in configs:
+            url = f"http://127.0.0.1:{args.port}/"
+            process = start_server(config, args.port)
+            try:
+                if not wait_until_ready(url, args.startup_timeout, bodies[0]):
+                    print(f"{config.get('name')}: server not ready after {args.startup_timeout}s")
+                    results.append({"config": config, "error": "not ready"})
+                    continue
+                result = run_load(url, bodies, args.concurrency, args.rate, args.duration, topn, accept=args.accept)
+            finally:
+                stop_server(process)
+            results.append({"config": config, **result})
+            print(json.dumps(results[-1]))
+    else:
+        result = run_load(args.url, bodies, args.concurrency, args.rate, args.duration, topn, accept=args.accept)
+        results.append({"config": {"name": args.url}, **result})
+        print(json.dumps(results[-1]))
+
+    for r in results:
+        if "error" in r:
+            continue
+        print(f"{r['config'].get('name', ''):>20}: {r['throughput_per_s']:8.1f} req/s, "
+              f"p50 {r['latency_ms_p50']:8.1f}ms p90 {r['latency_ms_p90']:8.1f}ms p99 {r['latency_ms_p99']:8.1f}ms, "
+              f"errors {r['error_rate'] * 100:.2f}%")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"concurrency": args.concurrency, "rate": args.rate, "duration": args.duration,
+                       "results": results}, f, indent=2)
@@ -4,6 +4,21 @@ from torch.nn import CrossEntropyLoss
 import torch.nn.functional as F
 from transformers import ( RobertaForSequenceClassification)
 
+def _extend_linear(linear, out_features, initializer_range):
+    """
+    :return: a copy of linear with extra, freshly initialized output rows
+    """
+    old_features = linear.out_features
+    if out_features < old_features:
+        raise ValueError(f"Cannot shrink the output layer from {old_features} to {out_features}")
+    extended = nn.Linear(linear.in_features, out_features).to(linear.weight.device)
+    extended.weight.data.normal_(mean=0.0, std=initializer_range)
+    extended.bias.data.zero_()
+    extended.weight.data[:old_features] = linear.weight.data
+    extended.bias.data[:old_features] = linear.bias.data
+    return extended
+
+
 class RobertaClassificationHead(nn.Module):
     """Head for sentence-level classification tasks."""
 
@@ -14,8 +29,7 @@ class RobertaClassificationHead(nn.Module):
         self.out_proj = nn.Linear(config.hidden_size, config.num_labels)
 
     def forward(self, features, **kwargs):
-        x = features[:, 0, :]  # take <s> token (equiv. to [CLS])
-        x = self.dropout(x)
+        x = self.dropout(features)  # features are the pooled <s> token (equiv. to [CLS])
         x = self.dense(x)
         x = torch.tanh(x)
         x = self.dropout(x)
@@ -23,6 +37,115 @@ class RobertaClassificationHead(nn.Module):
         return x
 
 
+class HierarchicalClassificationHead(nn.Module):
+    """
+    Two-level head: predict the package first, then score only the functions of the top packages.
+    Functions are scored against small embeddings instead of hidden_size wide output rows, and
+    inference only touches the functions of the config.top_packages most likely packages.
+    """
+
+    def __init__(self, config):
+        super().__init__()
+        self.top_packages = config.top_packages
+        self.dense = nn.Linear(config.hidden_size, config.hidden_size)
+        self.dropout = nn.Dropout(config.hidden_dropout_prob)
+        self.package_proj = nn.Linear(config.hidden_size, config.num_packages)
+        self.function_proj = nn.Linear(config.hidden_size, config.function_embedding_size)
+        self.function_embeddings = nn.Embedding(config.num_labels, config.function_embedding_size)
+        self.function_bias = nn.Parameter(torch.zeros(config.num_labels))
+        # package of each function, and functions grouped by package: function_order[offsets[p]:offsets[p+1]]
+        self.register_buffer("function_package", torch.zeros(config.num_labels, dtype=torch.long))
+        self.register_buffer("function_order", torch.arange(config.num_labels, dtype=torch.long))
+        self.register_buffer("package_offsets", torch.zeros(config.num_packages + 1, dtype=torch.long))
+
+    def set_function_package(self, function_package):
+        function_package = torch.as_tensor(function_package, dtype=torch.long, device=self.function_package.device)
+        self.function_package.copy_(function_package)
+        self.function_order.copy_(torch.argsort(function_package, stable=True))
+        counts = torch.bincount(function_package, minlength=self.package_offsets.shape[0] - 1)
+        self.package_offsets.zero_()
+        self.package_offsets[1:] = torch.cumsum(counts, dim=0)
+
+    def resize_labels(self, num_labels, num_packages, initializer_range):
+        """
+        Append rows for new functions and packages, keeping the ids and weights of the existing ones
+        """
+        old_labels = self.function_bias.shape[0]
+        old_package_proj = self.package_proj
+        self.package_proj = _extend_linear(old_package_proj, num_packages, initializer_range)
+        old_embeddings = self.function_embeddings
+        self.function_embeddings = nn.Embedding(num_labels, old_embeddings.embedding_dim).to(old_embeddings.weight.device)
+        self.function_embeddings.weight.data.normal_(mean=0.0, std=initializer_range)
+        self.function_embeddings.weight.data[:old_labels] = old_embeddings.weight.data
+        function_bias = self.function_bias.data.new_zeros(num_labels)
+        function_bias[:old_labels] = self.function_bias.data
+        self.function_bias = nn.Parameter(function_bias)
+        function_package = self.function_package.new_zeros(num_labels)
+        function_package[:old_labels] = self.function_package
+        self.function_package = function_package
+        self.function_order = torch.arange(num_labels, dtype=torch.long, device=function_package.device)
+        self.package_offsets = self.package_offsets.new_zeros(num_packages + 1)
+
+    def forward(self, features, labels=None):
+        x = self.dropout(features)  # features are the pooled <s> token (equiv. to [CLS])
+        x = self.dense(x)
+        x = torch.tanh(x)
+        x = self.dropout(x)
+        package_logits = self.package_proj(x)
+        function_features = self.function_proj(x)
+        if labels is None:
+            return self.predict(package_logits, function_features)
+
+        function_idx = labels.argmax(-1) if labels.dim() > 1 else labels
+        package_idx = self.function_package[function_idx]
+        # P(function | package) is a softmax over the functions of the labelled package only
+        functions, valid = self._package_functions(package_idx)
+        function_logits = self._score(function_features, functions, valid)
+        function_target = ((functions == function_idx[:, None]) & valid).long().argmax(-1)
+        loss = F.cross_entropy(package_logits, package_idx) + F.cross_entropy(function_logits, function_target)
+        if self.training:
+            return loss, None
+        # evaluation compares against the dense label matrix, so scatter the sparse prediction into it
+        ids, prob = self.predict(package_logits, function_features)
+        dense = prob.new_zeros((prob.shape[0], self.function_bias.shape[0]))
+        dense.scatter_add_(1, ids.clamp(min=0), prob)  # padding adds 0
+        return loss, dense
+
+    def _package_functions(self, packages):
+        """
+        :return: the functions of each package in packages, padded to the largest one, and the mask of real entries
+        """
+        starts = self.package_offsets[packages]
+        sizes = self.package_offsets[packages + 1] - starts
+        positions = torch.arange(max(int(sizes.max()), 1), device=packages.device)
+        valid = positions < sizes[..., None]
+        index = (starts[..., None] + positions).clamp(max=self.function_order.shape[0] - 1)
+        return self.function_order[index], valid
+
+    def _score(self, function_features, functions, valid):
+        """
+        :return: logits of the (padded) functions against function_features, padding set to the dtype minimum
+        """
+        embeddings = self.function_embeddings(functions)
+        features = function_features.view(function_features.shape[0], *([1] * (functions.dim() - 1)), -1)
+        scores = (embeddings * features).sum(-1) + self.function_bias[functions]
+        return scores.masked_fill(~valid, torch.finfo(scores.dtype).min)
+
+    def predict(self, package_logits, function_features):
+        """
+        :return: (ids, probs) of the functions of the top packages, sorted by P(package) * P(function | package);
+        rows are padded with id -1 and probability 0
+        """
+        package_prob = F.softmax(package_logits, dim=-1)
+        top_prob, top_package = package_prob.topk(min(self.top_packages, package_prob.shape[-1]), dim=-1)
+        functions, valid = self._package_functions(top_package)
+        function_prob = F.softmax(self._score(function_features, functions, valid), dim=-1)
+        prob = (top_prob[..., None] * function_prob).masked_fill(~valid, 0).flatten(1)
+        ids = functions.masked_fill(~valid, -1).flatten(1)
+        prob, order = prob.sort(dim=-1, descending=True)
+        return ids.gather(1, order), prob
+
+
 class Model(nn.Module):
     def __init__(self, encoder, config, tokenizer):
         super(Model, self).__init__()
@@ -32,9 +155,27 @@ class Model(nn.Module):
             self.encoder = encoder
         self.config = config
         self.tokenizer = tokenizer
-        self.classifier = RobertaClassificationHead(config)
+        if getattr(config, "hierarchical_head", False):
+            self.classifier = HierarchicalClassificationHead(config)
+        else:
+            self.classifier = RobertaClassificationHead(config)
 
-    def forward(self, inputs_ids, position_idx, attn_mask, labels=None):
+    def resize_labels(self, num_labels, function_package=None):
+        """
+        Grow the classifier to num_labels outputs; existing label ids keep their weights.
+        :param function_package: package number of every function (hierarchical head only)
+        """
+        if isinstance(self.classifier, HierarchicalClassificationHead):
+            num_packages = max(function_package) + 1
+            self.classifier.resize_labels(num_labels, num_packages, self.config.initializer_range)
+            self.classifier.set_function_package(function_package)
+            self.config.num_packages = num_packages
+        else:
+            self.classifier.out_proj = _extend_linear(self.classifier.out_proj, num_labels,
+                                                      self.config.initializer_range)
+        self.config.num_labels = num_labels
+
+    def encode(self, inputs_ids, position_idx, attn_mask):
 
         #position_idx = torch.clamp(position_idx, min=0, max=self.config.max_position_embeddings-1)
         # Generate embeddings
@@ -56,9 +197,21 @@ class Model(nn.Module):
             position_ids=position_idx,
             token_type_ids=position_idx.eq(-1).long()
         )[0]
+        # take <s> token (equiv. to [CLS])
+        return outputs[:, 0, :]
+
+    def forward(self, inputs_ids, position_idx, attn_mask, labels=None):
+        return self.classify(self.encode(inputs_ids, position_idx, attn_mask), labels)
+
+    def classify(self, pooled, labels=None):
+        """
+        Run the classification head on pooled encoder outputs (see encode)
+        """
+        if isinstance(self.classifier, HierarchicalClassificationHead):
+            return self.classifier(pooled, labels)
 
         # Classification head
-        logits = self.classifier(outputs)
+        logits = self.classifier(pooled)
         prob=F.softmax(logits, dim=-1)
 
         if labels is not None:
@@ -67,4 +220,16 @@ class Model(nn.Module):
             loss = loss_fct(logits, labels)
             return loss, prob
         else:
-            return prob
\ No newline at end of file
+            return prob
+
+    def rank(self, pooled, n=None):
+        """
+        :return: (ids, probs) of the n most likely labels (all scored labels when n is None), most likely first;
+        the hierarchical head pads rows with id -1 and probability 0
+        """
+        if isinstance(self.classifier, HierarchicalClassificationHead):
+            ids, prob = self.classifier(pooled)
+            return ids[:, :n], prob[:, :n]
+        prob = self.classify(pooled)
+        prob, ids = prob.topk(prob.shape[-1] if n is None else min(n, prob.shape[-1]), dim=-1)
+        return ids, prob
\ No newline at end of file
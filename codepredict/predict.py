@@ -1,6 +1,10 @@
 # Load label map
+import argparse
 import base64
+import itertools
 import json
+import logging
+import multiprocessing
 import os
 import pickle
 import traceback
@@ -8,63 +12,251 @@ import traceback
 import numpy as np
 import torch
 
+from cache import FeatureCache
 from model import Model
 import settings
 from utils import BundleDataset, convert_examples_to_features, set_seed, decode_label
 from transformers import RobertaConfig, RobertaTokenizer, RobertaForSequenceClassification
+from transformers.modeling_utils import no_init_weights
 import warnings
 
 
-def predict_candidates(model, tokenizer, function_code, label_id_to_label, n=5):
+def predict_candidates(model, tokenizer, function_code, label_id_to_label, n=5, encoder_cache=None,
+                       feature_cache=None):
     """
     Predict the label for a given JavaScript function code.
+    :param encoder_cache: optional cache.EncoderCache of pooled encoder outputs of model
+    :param feature_cache: optional cache.FeatureCache of the features of function_code
+    """
+    predicted_label_ids, confidences = predict_label_ids(model, tokenizer, function_code, n, encoder_cache,
+                                                         feature_cache)
+    predicted_labels = list(map(lambda e: decode_label(label_id_to_label[e]), predicted_label_ids))
+    return predicted_labels, confidences
+
+
+def predict_label_ids(model, tokenizer, function_code, n=5, encoder_cache=None, feature_cache=None):
+    """
+    Like predict_candidates, but return the label ids instead of the decoded labels
+    :param n: number of labels, None ranks all the labels the model scores
     """
     # Tokenize and process the input code
     inputs = {
         "code": function_code,
         "label": None
     }
-    feature = convert_examples_to_features(inputs, tokenizer, {})
-    # Prepare model input tensors
-    input_ids = torch.tensor(feature.input_ids, dtype=torch.long).unsqueeze(0).to(settings.device)
-    position_idx = torch.tensor(feature.position_idx, dtype=torch.long).unsqueeze(0).to(settings.device)
-    attn_mask = torch.tensor(BundleDataset.compute_attn_mask(feature)).unsqueeze(0).to(settings.device)
+    feature = feature_cache.get(function_code) if feature_cache is not None else None
+    if feature is None:
+        feature = convert_examples_to_features(inputs, tokenizer, {})
+        if feature_cache is not None:
+            feature_cache.put(function_code, feature)
+    attn_mask = BundleDataset.compute_attn_mask(feature)
     # Predict
     model.eval()
     with torch.no_grad():
-        logits = model(input_ids, position_idx, attn_mask)
-        probabilities = torch.sigmoid(logits).cpu().numpy()[0]
-        predicted_label_ids = np.argsort(probabilities)[-n:][::-1]
-        predicted_labels = list(map(lambda e: decode_label(label_id_to_label[e]), predicted_label_ids))
+        key, pooled = None, None
+        if encoder_cache is not None:
+            key = encoder_cache.key(feature.input_ids, feature.position_idx, attn_mask)
+            pooled = encoder_cache.get(key)
+        if pooled is None:
+            # Prepare model input tensors
+            input_ids = torch.tensor(feature.input_ids, dtype=torch.long).unsqueeze(0).to(settings.device)
+            position_idx = torch.tensor(feature.position_idx, dtype=torch.long).unsqueeze(0).to(settings.device)
+            attn_mask = torch.tensor(attn_mask).unsqueeze(0).to(settings.device)
+            pooled = model.encode(input_ids, position_idx, attn_mask)
+            if encoder_cache is not None:
+                encoder_cache.put(key, pooled)
+        ids, probabilities = model.rank(pooled, n)
+        ids, probabilities = ids.cpu().numpy()[0], torch.sigmoid(probabilities).cpu().numpy()[0]
+        scored = ids >= 0
 
-    return predicted_labels, probabilities[predicted_label_ids]
+    return ids[scored], probabilities[scored]
 
 
-if __name__ == '__main__':
-    label_map_path = os.path.join(settings.output_dir, 'labelMap.pkl')
+def _load_pretrained(cls, snapshot_dir, **kwargs):
+    """
+    Load a tokenizer or config from a local snapshot of settings.model_name, creating the snapshot on first use
+    so that later starts do not hit the Hugging Face cache or network.
+    """
+    if os.path.isdir(snapshot_dir):
+        try:
+            return cls.from_pretrained(snapshot_dir, local_files_only=True, **kwargs)
+        except (OSError, ValueError):
+            pass
+    pretrained = cls.from_pretrained(settings.model_name, **kwargs)
+    try:
+        pretrained.save_pretrained(snapshot_dir)
+    except OSError:
+        logging.warning("Cannot write the local snapshot %s", snapshot_dir)
+    return pretrained
+
+
+def load_model(model_dir=None, quantize=False):
+    """
+    Load a checkpoint saved by train.py or distill.py.
+    :param model_dir: directory containing labelMap.pkl and checkpoint-best-f1/
+    :param quantize: quantize the linear layers to int8 on CPU, for inference only since the result cannot be trained
+    :return: model, tokenizer, label id to label
+    """
+    model_dir = model_dir or settings.output_dir
+    label_map_path = os.path.join(model_dir, 'labelMap.pkl')
     if not os.path.exists(label_map_path):
         raise FileNotFoundError(f"Label map file not found at {label_map_path}")
     with open(label_map_path, 'rb') as f:
         label_id_to_label = {v: k for k, v in pickle.load(f).items()}
-    warnings.filterwarnings("ignore", category=FutureWarning)
-    set_seed()
-
-    checkpoint_prefix = 'checkpoint-best-f1/model.bin'
-    output_dir = os.path.join(settings.output_dir, '{}'.format(checkpoint_prefix))
 
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-
-    config = RobertaConfig.from_pretrained(settings.model_name)
+    checkpoint_dir = os.path.join(model_dir, settings.checkpoint_prefix)
+    snapshot_dir = os.path.join(model_dir, settings.snapshot_dir_name)
+    # checkpoints saved with their config (e.g. distilled students) may differ from the base architecture
+    if os.path.exists(os.path.join(checkpoint_dir, 'config.json')):
+        config = RobertaConfig.from_pretrained(checkpoint_dir)
+    else:
+        config = _load_pretrained(RobertaConfig, snapshot_dir)
     config.num_labels = len(label_id_to_label)
-    tokenizer = RobertaTokenizer.from_pretrained(settings.model_name)
-    
-    model = Model(encoder=None, config=config, tokenizer=tokenizer)
-    
-    checkpoint_path = os.path.join(settings.output_dir, 'checkpoint-best-f1/model.bin')
-    model.load_state_dict(torch.load(checkpoint_path, map_location=device))
+    tokenizer = _load_pretrained(RobertaTokenizer, snapshot_dir)
+
+    # the weights are overwritten by the checkpoint, skip their random initialization
+    with no_init_weights():
+        model = Model(encoder=None, config=config, tokenizer=tokenizer)
+    checkpoint_path = os.path.join(checkpoint_dir, 'model.bin')
+    model.load_state_dict(torch.load(checkpoint_path, map_location=settings.device))
     model.to(settings.device)
-    function_code = """
-    function makeNamespaceObject(exports: any){ if(typeof Symbol !== 'undefined' && Symbol.toStringTag) { Object.defineProperty(exports, Symbol.toStringTag, { value: 'Module' }); } Object.defineProperty(exports, '__esModule', { value: true }); }
+    model.eval()
+    if quantize and settings.device.type == "cpu":
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model, tokenizer, label_id_to_label
+
+
+_worker_tokenizer = None
+_worker_feature_cache = None
+
+
+def _init_featurize_worker(snapshot_dir):
+    global _worker_tokenizer, _worker_feature_cache
+    _worker_tokenizer = _load_pretrained(RobertaTokenizer, snapshot_dir)
+    _worker_feature_cache = FeatureCache(settings.feature_cache_path, settings.feature_cache_mb * 1024 * 1024,
+                                         settings.code_length, settings.data_flow_length, settings.model_name) \
+        if settings.feature_cache_mb > 0 else None
+
+
+def _featurize_line(line):
+    """
+    :return: input ids, positions, bit-packed attention mask and unpadded length, None if the line fails
+    """
+    try:
+        code = json.loads(line)["code"]
+        feature = _worker_feature_cache.get(code) if _worker_feature_cache is not None else None
+        if feature is None:
+            feature = convert_examples_to_features({"code": code, "label": None}, _worker_tokenizer, {})
+            if _worker_feature_cache is not None:
+                _worker_feature_cache.put(code, feature)
+        attn_mask = BundleDataset.compute_attn_mask(feature)
+        length = sum(i != _worker_tokenizer.pad_token_id for i in feature.position_idx)
+        # the packed mask is 8 times smaller to send back to the parent
+        return feature.input_ids, feature.position_idx, np.packbits(attn_mask), length
+    except Exception:
+        logging.warning(f"Cannot featurize line: {traceback.format_exc()}")
+        return None
+
+
+def _completed_lines(output_path):
+    """
+    Count the complete lines of a previous run and cut off a partially written last line
+    """
+    if not os.path.exists(output_path):
+        return 0
+    count, end = 0, 0
+    with open(output_path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            count += 1
+            end += len(line)
+    if end != os.path.getsize(output_path):
+        os.truncate(output_path, end)
+    return count
+
+
+def predict_file(model, label_id_to_label, input_path, output_path, model_dir=None, n=5, batch_size=32,
+                 workers=None, window=None):
+    """
+    Predict every function of a JSONL file with a 'code' field and write one JSONL line per input line, in order:
+    {"line", "predictions": [{"function", "confidence"}]} (and "error" if the function cannot be featurized).
+    Featurization runs in worker processes, overlapped with the inference of the previous window. Within a
+    window, functions are sorted by length and every batch is trimmed to its longest function.
+    An interrupted run resumes after the last complete line of output_path.
+    :param window: functions featurized at a time, default is 16 batches
     """
-    predicted_label = predict_candidates(model, tokenizer, function_code, label_id_to_label, n=3)
-    print(f"Predicted Label: {predicted_label}")
+    snapshot_dir = os.path.join(model_dir or settings.output_dir, settings.snapshot_dir_name)
+    window = window or batch_size * 16
+    sequence_length = settings.code_length + settings.data_flow_length
+    done = _completed_lines(output_path)
+    if done:
+        logging.info(f"Resuming after {done} lines of {output_path}")
+
+    model.eval()
+    with open(input_path) as inputs, open(output_path, "a") as output, \
+            multiprocessing.Pool(workers, initializer=_init_featurize_worker, initargs=(snapshot_dir,)) as pool:
+        lines = itertools.islice(inputs, done, None)
+        index = done
+        chunk = list(itertools.islice(lines, window))
+        pending = pool.map_async(_featurize_line, chunk)
+        while chunk:
+            features = pending.get()
+            next_chunk = list(itertools.islice(lines, window))
+            pending = pool.map_async(_featurize_line, next_chunk)
+
+            results = [None] * len(chunk)
+            valid = sorted((i for i, f in enumerate(features) if f is not None), key=lambda i: features[i][3])
+            for start in range(0, len(valid), batch_size):
+                batch = valid[start:start + batch_size]
+                length = max(features[i][3] for i in batch)
+                input_ids = torch.tensor([features[i][0][:length] for i in batch], dtype=torch.long)
+                position_idx = torch.tensor([features[i][1][:length] for i in batch], dtype=torch.long)
+                attn_mask = torch.tensor(np.stack([
+                    np.unpackbits(features[i][2])[:sequence_length * sequence_length]
+                    .reshape(sequence_length, sequence_length)[:length, :length] for i in batch]).astype(bool))
+                with torch.no_grad():
+                    pooled = model.encode(input_ids.to(settings.device), position_idx.to(settings.device),
+                                          attn_mask.to(settings.device))
+                    ids, probabilities = model.rank(pooled, n)
+                    ids, probabilities = ids.cpu().numpy(), torch.sigmoid(probabilities).cpu().numpy()
+                for row, i in enumerate(batch):
+                    results[i] = [{"function": decode_label(label_id_to_label[int(e)]),
+                                   "confidence": float(p)} for e, p in zip(ids[row], probabilities[row]) if e >= 0]
+
+            for i, result in enumerate(results):
+                record = {"line": index + i, "predictions": result or []}
+                if result is None:
+                    record["error"] = "featurization failed"
+                output.write(json.dumps(record) + "\n")
+            output.flush()
+            index += len(chunk)
+            logging.info(f"Predicted {index} functions")
+            chunk = next_chunk
+        pending.get()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default=None, type=str,
+                        help="JSONL file of functions ('code' field) to predict offline; without it a demo function is predicted.")
+    parser.add_argument("--output", default=None, type=str, help="JSONL predictions, appended to when resuming.")
+    parser.add_argument("--model_dir", default=None, type=str)
+    parser.add_argument("--topn", default=5, type=int)
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--workers", default=None, type=int, help="Featurization processes, default is one per core.")
+    args = parser.parse_args()
+
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    set_seed()
+    model, tokenizer, label_id_to_label = load_model(args.model_dir, quantize=settings.quantize)
+    if args.input:
+        logging.basicConfig(level=logging.INFO)
+        predict_file(model, label_id_to_label, args.input, args.output or f"{args.input}.predictions.jsonl",
+                     args.model_dir, args.topn, args.batch_size, args.workers)
+    else:
+        function_code = """
+        function makeNamespaceObject(exports: any){ if(typeof Symbol !== 'undefined' && Symbol.toStringTag) { Object.defineProperty(exports, Symbol.toStringTag, { value: 'Module' }); } Object.defineProperty(exports, '__esModule', { value: true }); }
+        """
+        predicted_label = predict_candidates(model, tokenizer, function_code, label_id_to_label, n=3)
+        print(f"Predicted Label: {predicted_label}")
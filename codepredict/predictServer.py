@@ -1,42 +1,109 @@
 import base64
-import os
-import pickle
+import hashlib
+import threading
 import traceback
 import uuid
 import warnings
 
 import torch
 from flask import Flask, request, jsonify
-from transformers import RobertaConfig, RobertaTokenizer, RobertaForSequenceClassification
 
 import settings
-from model import Model
-from predict import predict_candidates
+from cache import SingleFlight
+from predict import predict_label_ids
+from registry import ModelRegistry
 from utils import set_seed
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Response formats negotiated with the Accept header. The ids formats answer with label ids only,
+# clients decode them with the label dictionary of the model version from /labels.
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+IDS_JSON = "application/vnd.codepredict.ids+json"
+IDS_MSGPACK = "application/vnd.codepredict.ids+msgpack"
+
 app = Flask(__name__)
 
-label_map_path = os.path.join(settings.output_dir, 'labelMap.pkl')
-if not os.path.exists(label_map_path):
-    raise FileNotFoundError(f"Label map file not found at {label_map_path}")
-with open(label_map_path, 'rb') as f:
-    label_id_to_label = {v: k for k, v in pickle.load(f).items()}
 warnings.filterwarnings("ignore", category=FutureWarning)
 set_seed()
-checkpoint_prefix = 'checkpoint-best-f1/model.bin'
-output_dir = os.path.join(settings.output_dir, '{}'.format(checkpoint_prefix))
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+# Without limits every worker starts a thread per core, which thrashes with several workers per machine
+if settings.torch_threads > 0:
+    torch.set_num_threads(settings.torch_threads)
+if settings.torch_interop_threads > 0:
+    torch.set_num_interop_threads(settings.torch_interop_threads)
+
+# Load and warm up the model in the background, so the worker comes up immediately and /ready tells
+# load balancers and rolling restarts when it can serve requests. The registry then watches for new versions.
+registry = ModelRegistry()
+threading.Thread(target=registry.start, daemon=True).start()
+# Identical functions arriving at the same time (libraries shared by many sites) run one forward pass
+inflight = SingleFlight()
+
+
+@app.route('/ready', methods=['GET'])
+def is_ready():
+    if registry.ready.is_set():
+        return jsonify({"ready": True, "version": registry.active.version})
+    return jsonify({"ready": False, "error": registry.error}), 503
+
+
+@app.route('/models', methods=['GET'])
+def models():
+    return jsonify({**registry.status(), "coalesced_requests": inflight.coalesced})
+
+
+@app.route('/models/activate', methods=['POST'])
+def activate():
+    data = request.get_json()
+    if not data or 'version' not in data:
+        return jsonify({"error": "Missing 'version' in request body"}), 400
+    try:
+        registry.set_active(data['version'])
+    except KeyError as e:
+        return jsonify({"error": str(e)}), 404
+    # every worker (including this one) switches on its next registry check
+    return jsonify({"activating": data['version']}), 202
+
+
+def response_format(ids_formats=True) -> str:
+    offered = [JSON] + ([IDS_JSON] if ids_formats else [])
+    if msgpack is not None:
+        offered += [MSGPACK] + ([IDS_MSGPACK] if ids_formats else [])
+    return request.accept_mimetypes.best_match(offered, default=JSON)
 
 
-config = RobertaConfig.from_pretrained(settings.model_name)
-config.num_labels = len(label_id_to_label)
-tokenizer = RobertaTokenizer.from_pretrained(settings.model_name)
+def encode(payload, mimetype: str):
+    if mimetype in (MSGPACK, IDS_MSGPACK):
+        return app.response_class(msgpack.packb(payload), mimetype=mimetype)
+    response = jsonify(payload)
+    response.mimetype = mimetype
+    return response
 
-model = Model(encoder=None, config=config, tokenizer=tokenizer)
 
-checkpoint_path = os.path.join(settings.output_dir, 'checkpoint-best-f1/model.bin')
-model.load_state_dict(torch.load(checkpoint_path, map_location=device))
-model.to(settings.device)
+@app.route('/labels', methods=['GET'])
+def labels():
+    """
+    The label dictionary of a model version (default is the active one): label id -> label.
+    The ETag is the version, so clients can cache it and revalidate with If-None-Match.
+    """
+    if not registry.wait_ready(timeout=settings.ready_timeout):
+        return jsonify({"error": "Model failed to load" if registry.error else "Model is not loaded"}), 503
+    version = request.args.get('version')
+    if version is not None and version not in registry.versions():
+        return jsonify({"error": f"Unknown model version {version}"}), 404
+    with registry.use(version) as loaded:
+        version = loaded.version
+        if version in request.if_none_match:
+            response = app.response_class(status=304)
+        else:
+            response = encode({"version": version, "labels": loaded.labels}, response_format(ids_formats=False))
+    response.set_etag(version)
+    return response
 
 
 @app.route('/predict', methods=['POST'])
@@ -44,23 +111,42 @@ def predict():
     data = request.get_json()
     if not data or 'code' not in data:
         return jsonify({"error": "Missing 'code' in request body"}), 400
+    if not registry.wait_ready(timeout=settings.ready_timeout):
+        return jsonify({"error": "Model failed to load" if registry.error else "Model is not loaded"}), 503
 
     function_code = data['code']
     topn = data.get('topn', 3)
-    result = []
+    version = data.get('version')
+    if version is not None and version not in registry.versions():
+        return jsonify({"error": f"Unknown model version {version}"}), 404
+    mimetype = response_format()
+    ids, confidences = [], []
     try:
-        funcs, confidents = predict_candidates(model, tokenizer, function_code, label_id_to_label, n=topn)
-        for i, func in enumerate(funcs):
-            result.append({"function": func, "confidence": float(confidents[i])})
+        with registry.use(version) as loaded:
+            version = loaded.version
+            # surrounding whitespace does not change the features
+            code_hash = hashlib.blake2b(function_code.strip().encode('utf-8', errors='replace'), digest_size=16).digest()
+            # callers with another topn share the prediction, it ranks all labels and each takes its top
+            label_ids, confidents = inflight.do(
+                (version, code_hash),
+                lambda: predict_label_ids(loaded.model, loaded.tokenizer, function_code, n=None,
+                                          encoder_cache=loaded.encoder_cache, feature_cache=registry.feature_cache))
+            ids = [int(i) for i in label_ids[:topn]]
+            confidences = [float(c) for c in confidents[:topn]]
+            decoded = loaded.labels
     except Exception as e:
+        ids, confidences = [], []
         with open(f"error-{uuid.uuid1()}.log", "w") as log_file:
             log_file.write(f"Exception occurred while processing data flow: {str(e)}\n\n")
             log_file.write(traceback.format_exc()+"\n\n")
             log_file.write(f"Code that caused the exception:\n{base64.encode(function_code)}\n\n")
     finally:
-        return jsonify(result)
+        if mimetype in (IDS_JSON, IDS_MSGPACK):
+            return encode({"version": version, "ids": ids, "confidence": confidences}, mimetype)
+        result = [{"function": decoded[i], "confidence": c} for i, c in zip(ids, confidences)]
+        return encode(result, mimetype)
 
 
 if __name__ == "__main__":
-    # run with gunicorn -w 4 -b 0.0.0.0:8000 predictServer:app
+    # run with python launcher.py --workers 4 --bind 0.0.0.0:8000 (gunicorn with pinned, sized workers)
     app.run(host='0.0.0.0', port=8000, debug=False)
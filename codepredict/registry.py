@@ -0,0 +1,300 @@
+"""
+Versioned model registry with hot swap for the prediction server.
+
+Each version is a directory <registry>/<version> with the layout written by train.py --output_dir
+(labelMap.pkl and checkpoint-best-f1/). The active version is recorded in <registry>/ACTIVE, which every
+server worker watches, so activating a version switches all workers without restarting them.
+
+    python registry.py publish ./saved_models-new 2025-03-01   # copy a trained model into the registry
+    python registry.py activate 2025-03-01                     # make the workers switch to it
+"""
+import argparse
+import gc
+import logging
+import os
+import shutil
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+
+import settings
+from cache import EncoderCache, FeatureCache
+from predict import load_model, predict_candidates
+from utils import decode_label
+
+LEGACY_VERSION = "default"
+ACTIVE_FILE = "ACTIVE"
+
+# Representative inputs for warmup: a small function, a typical minified module and one long enough to be truncated
+WARMUP_FUNCTIONS = [
+    "function makeNamespaceObject(exports){ if(typeof Symbol !== 'undefined' && Symbol.toStringTag) { Object.defineProperty(exports, Symbol.toStringTag, { value: 'Module' }); } Object.defineProperty(exports, '__esModule', { value: true }); }",
+    "function n(r) { var a = t[r]; if (void 0 !== a) return a.exports; var l = (t[r] = { exports: {} }); return e[r](l, l.exports, n), l.exports;}",
+    "function(e,t,n){" + ";".join(f"var a{i}=e[{i}]||t.b{i}(n,{i}),c{i}=a{i}?n.c(a{i}):void 0" for i in range(200)) + "}",
+]
+
+
+class LoadedModel:
+    def __init__(self, version: str, model, tokenizer, label_id_to_label: dict[int, str]):
+        self.version = version
+        self.model = model
+        self.tokenizer = tokenizer
+        self.label_id_to_label = label_id_to_label
+        self.encoder_cache = EncoderCache(settings.encoder_cache_mb * 1024 * 1024) \
+            if settings.encoder_cache_mb > 0 else None
+        self._labels = None
+        # guarded by the registry lock
+        self.in_flight = 0
+        self.retired = False
+
+    @property
+    def labels(self) -> list[dict[str, str]]:
+        """
+        Decoded labels indexed by label id, the dictionary clients of the label-id response format cache
+        """
+        if self._labels is None:
+            self._labels = [decode_label(self.label_id_to_label[i]) for i in range(len(self.label_id_to_label))]
+        return self._labels
+
+    def warmup(self):
+        # the first forwards pay for lazy initialization (allocator, kernels, tree-sitter and tokenizer caches)
+        for _ in range(settings.warmup_rounds):
+            for code in WARMUP_FUNCTIONS:
+                predict_candidates(self.model, self.tokenizer, code, self.label_id_to_label, n=3)
+
+
+class ModelRegistry:
+    def __init__(self, root: str = settings.model_registry_dir, legacy_dir: str = settings.output_dir):
+        self.root = root
+        self.legacy_dir = legacy_dir
+        self.active: LoadedModel | None = None
+        self.ready = threading.Event()
+        self.error: str | None = None
+        # set once the first load succeeded or failed
+        self._settled = threading.Event()
+        self._pinned: OrderedDict[str, LoadedModel] = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._active_mtime = None
+        # features do not depend on the model version, so all versions share the cache
+        self.feature_cache = FeatureCache(settings.feature_cache_path, settings.feature_cache_mb * 1024 * 1024,
+                                          settings.code_length, settings.data_flow_length, settings.model_name) \
+            if settings.feature_cache_mb > 0 else None
+
+    def path(self, version: str) -> str:
+        if version == LEGACY_VERSION:
+            return self.legacy_dir
+        return os.path.join(self.root, version)
+
+    def versions(self) -> list[str]:
+        versions = []
+        if os.path.isdir(self.root):
+            for name in sorted(os.listdir(self.root)):
+                if os.path.exists(os.path.join(self.root, name, 'labelMap.pkl')):
+                    versions.append(name)
+        if os.path.exists(os.path.join(self.legacy_dir, 'labelMap.pkl')):
+            versions.append(LEGACY_VERSION)
+        return versions
+
+    def active_version(self) -> str:
+        """
+        The version in ACTIVE, else settings.model_version, else the newest registered version
+        """
+        active_file = os.path.join(self.root, ACTIVE_FILE)
+        if os.path.exists(active_file):
+            with open(active_file) as f:
+                version = f.read().strip()
+            if version:
+                return version
+        if settings.model_version:
+            return settings.model_version
+        versions = [v for v in self.versions() if v != LEGACY_VERSION]
+        return versions[-1] if versions else LEGACY_VERSION
+
+    def set_active(self, version: str):
+        """
+        Record the active version; every worker watching the registry switches to it
+        """
+        if version not in self.versions():
+            raise KeyError(f"Unknown model version {version}")
+        os.makedirs(self.root, exist_ok=True)
+        tmp = os.path.join(self.root, f".{ACTIVE_FILE}-{uuid.uuid4().hex}")
+        with open(tmp, "w") as f:
+            f.write(version)
+        os.replace(tmp, os.path.join(self.root, ACTIVE_FILE))
+
+    def load(self, version: str) -> LoadedModel:
+        if version not in self.versions():
+            raise KeyError(f"Unknown model version {version}")
+        logging.info(f"Loading model version {version}")
+        model, tokenizer, label_id_to_label = load_model(self.path(version), quantize=settings.quantize)
+        loaded = LoadedModel(version, model, tokenizer, label_id_to_label)
+        loaded.warmup()
+        return loaded
+
+    def activate(self, version: str):
+        """
+        Load version (outside the request path) and atomically make it the default of new requests.
+        The previous model is released once its in-flight requests are drained.
+        """
+        with self._load_lock:
+            if self.active is not None and self.active.version == version:
+                return
+            with self._lock:
+                loaded = self._pinned.pop(version, None)
+            if loaded is None:
+                loaded = self.load(version)
+            with self._lock:
+                previous, self.active = self.active, loaded
+                released = self._retire(previous) if previous is not None else False
+            if released:
+                self._collect()
+            logging.info(f"Model version {version} is active")
+
+    def start(self):
+        """
+        Load the active version, then keep watching the registry for activations
+        """
+        try:
+            self.activate(self.active_version())
+            self.ready.set()
+        except Exception:
+            self.error = traceback.format_exc()
+            logging.error(f"Cannot load the active model:\n{self.error}")
+            return
+        finally:
+            self._settled.set()
+        active_file = os.path.join(self.root, ACTIVE_FILE)
+        while True:
+            time.sleep(settings.registry_poll_interval)
+            try:
+                mtime = os.path.getmtime(active_file) if os.path.exists(active_file) else None
+                if mtime != self._active_mtime:
+                    self._active_mtime = mtime
+                    self.activate(self.active_version())
+            except Exception:
+                logging.error(f"Cannot switch the model version:\n{traceback.format_exc()}")
+
+    def wait_ready(self, timeout: float | None = None) -> bool:
+        """
+        Wait until the model is loaded, returning at once if loading failed
+        """
+        self._settled.wait(timeout=timeout)
+        return self.ready.is_set()
+
+    @contextmanager
+    def use(self, version: str | None = None):
+        """
+        :param version: pin a version, default is the active one
+        """
+        loaded = None
+        with self._lock:
+            if version is None or (self.active is not None and self.active.version == version):
+                loaded = self.active
+            elif version in self._pinned:
+                loaded = self._pinned[version]
+                self._pinned.move_to_end(version)
+            if loaded is not None:
+                loaded.in_flight += 1
+        if loaded is None:
+            if version is None:
+                raise RuntimeError("No model is loaded")
+            loaded = self._load_pinned(version)
+        try:
+            yield loaded
+        finally:
+            with self._lock:
+                loaded.in_flight -= 1
+                released = loaded.retired and loaded.in_flight == 0
+                if released:
+                    self._release(loaded)
+            if released:
+                self._collect()
+
+    def _load_pinned(self, version: str) -> LoadedModel:
+        with self._load_lock:
+            with self._lock:
+                loaded = self._pinned.get(version)
+            if loaded is None:
+                loaded = self.load(version)
+            released = False
+            with self._lock:
+                self._pinned[version] = loaded
+                loaded.in_flight += 1
+                # the active model does not count towards the limit
+                while len(self._pinned) > max(settings.max_loaded_models - 1, 0):
+                    _, evicted = self._pinned.popitem(last=False)
+                    released = self._retire(evicted) or released
+            if released:
+                self._collect()
+            return loaded
+
+    def _retire(self, loaded: LoadedModel) -> bool:
+        # must be called with the lock held
+        loaded.retired = True
+        if loaded.in_flight == 0:
+            self._release(loaded)
+            return True
+        return False
+
+    @staticmethod
+    def _release(loaded: LoadedModel):
+        logging.info(f"Releasing model version {loaded.version}")
+        loaded.model = None
+        loaded.encoder_cache = None
+
+    @staticmethod
+    def _collect():
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "active": self.active.version if self.active is not None else None,
+                "loaded": ([self.active.version] if self.active is not None else []) + list(self._pinned),
+                "in_flight": {m.version: m.in_flight for m in [self.active, *self._pinned.values()] if m is not None},
+                "available": self.versions(),
+                "feature_cache": self.feature_cache.stats() if self.feature_cache is not None else None,
+            }
+
+
+def publish(model_dir: str, version: str, root: str = settings.model_registry_dir):
+    """
+    Copy a model directory written by train.py into the registry; the copy is renamed into place so
+    workers never see a partial version
+    """
+    target = os.path.join(root, version)
+    if os.path.exists(target):
+        raise FileExistsError(f"Version {version} already exists in {root}")
+    os.makedirs(root, exist_ok=True)
+    tmp = os.path.join(root, f".{version}-{uuid.uuid4().hex}")
+    shutil.copytree(model_dir, tmp)
+    os.rename(tmp, target)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+    publish_parser = sub.add_parser("publish", help="Copy a trained model directory into the registry.")
+    publish_parser.add_argument("model_dir")
+    publish_parser.add_argument("version")
+    activate_parser = sub.add_parser("activate", help="Switch the servers to a version.")
+    activate_parser.add_argument("version")
+    sub.add_parser("list", help="List the registered versions.")
+    args = parser.parse_args()
+
+    registry = ModelRegistry()
+    if args.command == "publish":
+        publish(args.model_dir, args.version)
+    elif args.command == "activate":
+        registry.set_active(args.version)
+    else:
+        active = registry.active_version()
+        for v in registry.versions():
+            print(f"{'*' if v == active else ' '} {v}")
@@ -1,2 +1,2 @@
 #!/usr/bin/env bash
-gunicorn -w 2 -b 0.0.0.0:8000 predictServer:app
+python3 "$(dirname "$0")/launcher.py" --workers 2 --bind 0.0.0.0:8000
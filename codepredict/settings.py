@@ -21,6 +21,10 @@ max_grad_norm = 1.0  # Maximum gradient norm
 max_steps = -1  # Maximum training steps (-1 means disabled)
 warmup_steps = 0  # Linear warmup over this number of steps
 epochs = 100
+corpus_read_processes = 4  # Processes reading the shards of a corpus written by corpus.py
+dedup_threshold = None  # MinHash similarity above which same-label near-duplicates are dropped, None keeps them
+minhash_permutations = 128  # MinHash signature length of the near-duplicate removal
+shingle_size = 5  # Tokens per shingle of the near-duplicate removal
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 n_gpu = torch.cuda.device_count()
@@ -28,4 +32,31 @@ n_gpu = torch.cuda.device_count()
 # Random seed for reproducibility
 seed = 42
 
-output_dir = f"{SCRIPT_DIR}/saved_models"
+output_dir = os.getenv("CODEPREDICT_MODEL_DIR", f"{SCRIPT_DIR}/saved_models")
+checkpoint_prefix = 'checkpoint-best-f1'
+
+# Prediction server
+encoder_cache_mb = int(os.getenv("CODEPREDICT_ENCODER_CACHE_MB", 64))  # Memory bound of the encoder output cache, 0 disables it
+feature_cache_path = os.getenv("CODEPREDICT_FEATURE_CACHE", os.path.join(output_dir, "feature-cache.sqlite"))  # Featurization cache shared by workers and checkpoints
+feature_cache_mb = int(os.getenv("CODEPREDICT_FEATURE_CACHE_MB", 1024))  # Disk bound of the featurization cache, 0 disables it
+quantize = os.getenv("CODEPREDICT_QUANTIZE", "0") == "1"  # Dynamic int8 quantization of the linear layers when serving (CPU only)
+snapshot_dir_name = "base-snapshot"  # Local copy of the tokenizer and config of model_name inside the model directory
+warmup_rounds = 2  # Forward passes over the warmup functions before the server reports ready
+ready_timeout = 300  # Seconds a request waits for the model to be loaded before failing
+model_registry_dir = os.getenv("CODEPREDICT_MODEL_REGISTRY", os.path.join(output_dir, "registry"))  # Versioned model directories
+model_version = os.getenv("CODEPREDICT_MODEL_VERSION")  # Version served when the registry has no ACTIVE file
+registry_poll_interval = 10  # Seconds between checks of the registry for a new active version
+max_loaded_models = 2  # Models kept in memory per worker, including the active one
+torch_threads = int(os.getenv("CODEPREDICT_TORCH_THREADS", 0))  # Intra-op threads per worker, 0 keeps the torch default (set by launcher.py)
+torch_interop_threads = int(os.getenv("CODEPREDICT_TORCH_INTEROP_THREADS", 1))  # Inter-op threads per worker, 0 keeps the torch default
+
+# Hierarchical (package then function) classifier head
+hierarchical_head = False
+function_embedding_size = 128  # Width of the per-function output embeddings
+top_packages = 5  # Packages whose functions are scored at inference
+
+# Distillation configurations
+student_num_layers = 6  # Number of transformer layers kept in the student
+distill_temperature = 2.0  # Softmax temperature applied to teacher and student outputs
+distill_alpha = 0.7  # Weight of the soft (teacher) loss, 1 - alpha goes to the hard label loss
+student_output_dir = f"{SCRIPT_DIR}/saved_models-student"
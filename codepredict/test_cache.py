@@ -0,0 +1,20 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+utils = pytest.importorskip("utils", reason="needs the training dependencies (torch, transformers, tree_sitter)")
+
+from cache import FeatureCache
+
+
+def test_feature_cache_round_trip_of_large_function(tmp_path):
+    # dfg_to_code points into the subtokens before truncation, a large minified function has more than 65535
+    feature = utils.InputFeatures(None, list(range(640)), list(range(2, 642)),
+                                  [(0, 3), (70000, 70004), (65535, 131072)], [[1, 2], [], [0]], None)
+    cache = FeatureCache(str(tmp_path / "features.sqlite"), 1 << 20, 512, 128, "tokenizer")
+    cache.put("function f() {}", feature)
+    cached = cache.get("function f() {}")
+    assert cached is not None
+    assert cached.input_ids == feature.input_ids
+    assert cached.position_idx == feature.position_idx
+    assert cached.dfg_to_code == feature.dfg_to_code
+    assert cached.dfg_to_dfg == feature.dfg_to_dfg
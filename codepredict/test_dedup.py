@@ -0,0 +1,23 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+from dedup import MIN_RECALL, deduplicate, lsh_bands
+
+
+@pytest.mark.parametrize("threshold", [0.5, 0.8, 0.9, 0.95])
+def test_lsh_bands_find_pairs_at_the_threshold(threshold):
+    bands, rows = lsh_bands(128, threshold)
+    assert bands * rows <= 128
+    assert 1 - (1 - threshold ** rows) ** bands >= MIN_RECALL
+
+
+def test_renamed_variant_is_removed():
+    label = {"packageName": "p", "functionFile": "f.js", "functionName": "sum"}
+    code = "function sum(values) { let total = 0; for (const value of values) { total += value.amount; } return total; }"
+    renamed = code.replace("values", "a").replace("total", "b").replace("value", "c")
+    other = "function get(o, k) { return Object.prototype.hasOwnProperty.call(o, k) ? o[k] : undefined; }"
+    records = [{"code": c, "label": label} for c in (code, renamed, other)]
+    kept, report = deduplicate(records, 0.8)
+    assert [r["code"] for r in kept] == [code, other]
+    assert report["removed_samples"] == 1
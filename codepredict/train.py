@@ -1,4 +1,5 @@
 import argparse
+import json
 import logging
 import os
 import pickle
@@ -6,19 +7,39 @@ import pickle
 import numpy as np
 from tqdm import tqdm
 import torch
-from torch.utils.data import RandomSampler, DataLoader
+from torch.utils.data import RandomSampler, DataLoader, ConcatDataset
 from transformers import (AdamW, get_linear_schedule_with_warmup,
                           RobertaConfig, RobertaForSequenceClassification, RobertaTokenizer)
 
 import settings
-from model import Model
-from utils import BundleDataset, set_seed
+from model import Model, HierarchicalClassificationHead
+from predict import load_model
+from utils import BundleDataset, decode_label, set_seed
 
 logger = logging.getLogger(__name__)
 
 
-def train(train_dataset, model):
+def save_checkpoint(model, function2number, output_dir=None):
+    """
+    Save the model weights, its config and the label map in the layout read by predict.load_model
+    """
+    output_dir = output_dir or settings.output_dir
+    checkpoint_dir = os.path.join(output_dir, settings.checkpoint_prefix)
+    if not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    model_to_save = model.module if hasattr(model, 'module') else model
+    checkpoint_path = os.path.join(checkpoint_dir, 'model.bin')
+    torch.save(model_to_save.state_dict(), checkpoint_path)
+    # the config records the architecture (e.g. number of layers of a distilled student)
+    model_to_save.config.save_pretrained(checkpoint_dir)
+    logger.info("Saving model checkpoint to %s", checkpoint_path)
+    with open(os.path.join(output_dir, 'labelMap.pkl'), 'wb') as f:
+        pickle.dump(function2number, f)
+
+
+def train(train_dataset, model, function2number=None, output_dir=None):
     """ Train the model """
+    function2number = function2number or train_dataset.function2number
 
     # build dataloader
     train_sampler = RandomSampler(train_dataset)
@@ -103,50 +124,114 @@ def train(train_dataset, model):
                 if global_step % save_steps == 0:
                     if loss < best_loss:
                         best_loss = loss
-                        checkpoint_prefix = 'checkpoint-best-f1'
-                        output_dir = os.path.join(settings.output_dir, '{}'.format(checkpoint_prefix))
-                        if not os.path.exists(output_dir):
-                            os.makedirs(output_dir)
-                        model_to_save = model.module if hasattr(model, 'module') else model
-                        output_dir = os.path.join(output_dir, '{}'.format('model.bin'))
-                        torch.save(model_to_save.state_dict(), output_dir)
-                        logger.info("Saving model checkpoint to %s", output_dir)
-                        with open(os.path.join(settings.output_dir, 'labelMap.pkl'), 'wb') as f:
-                            pickle.dump(train_dataset.function2number, f)
+                        save_checkpoint(model, function2number, output_dir)
                     if loss < 0.01:
                         best_loss = loss
-                        checkpoint_prefix = 'checkpoint-best-f1'
-                        output_dir = os.path.join(settings.output_dir, '{}'.format(checkpoint_prefix))
-                        if not os.path.exists(output_dir):
-                            os.makedirs(output_dir)
-                        model_to_save = model.module if hasattr(model, 'module') else model
-                        output_dir = os.path.join(output_dir, '{}'.format('model.bin'))
-                        torch.save(model_to_save.state_dict(), output_dir)
-                        logger.info("Saving model checkpoint to %s", output_dir)
-                        with open(os.path.join(settings.output_dir, 'labelMap.pkl'), 'wb') as f:
-                            pickle.dump(train_dataset.function2number, f)
+                        save_checkpoint(model, function2number, output_dir)
                         print("early stop")
                         early_stop = True
                         break
 
 
+def incremental_datasets(tokenizer, model, label_id_to_label, dataset, replay_dataset, replay_ratio,
+                         dedup_threshold=None):
+    """
+    Build the training data for adding new labels to a trained model.
+    Existing label ids are kept and new labels are appended, so the new labelMap.pkl stays compatible.
+    :return: concatenation of the new and replayed samples, the extended label map
+    """
+    old_function2number = {v: k for k, v in label_id_to_label.items()}
+    new_dataset = BundleDataset(tokenizer, dataset, function2number=old_function2number,
+                                dedup_threshold=dedup_threshold)
+    function2number = new_dataset.function2number
+    assert all(function2number[k] == v for k, v in old_function2number.items()), "label map is not compatible"
+    logger.info("Adding %d new labels to %d existing ones", len(function2number) - len(old_function2number),
+                len(old_function2number))
+    datasets = [new_dataset]
+    if replay_dataset:
+        # replayed samples of the old labels prevent the model from forgetting them
+        replay = BundleDataset(tokenizer, replay_dataset, function2number=function2number, extend_labels=False,
+                               max_records=int(len(new_dataset) * replay_ratio))
+        logger.info("Replaying %d samples", len(replay))
+        datasets.append(replay)
+
+    function_package = None
+    if isinstance(model.classifier, HierarchicalClassificationHead):
+        # keep the package numbers the checkpoint was trained with
+        old_function_package = model.classifier.function_package.tolist()
+        package2number = {}
+        for functionName, number in old_function2number.items():
+            package2number[decode_label(functionName)["packageName"]] = old_function_package[number]
+        function_package = [0] * len(function2number)
+        for functionName, number in sorted(function2number.items(), key=lambda e: e[1]):
+            packageName = decode_label(functionName)["packageName"]
+            if packageName not in package2number:
+                package2number[packageName] = max(package2number.values(), default=-1) + 1
+            function_package[number] = package2number[packageName]
+    model.resize_labels(len(function2number), function_package)
+    return ConcatDataset(datasets), function2number, new_dataset.dedup_report
+
+
+def write_dedup_report(report, output_dir=None):
+    if report is None:
+        return
+    output_dir = output_dir or settings.output_dir
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, 'dedup-report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     ## Required parameters
     parser.add_argument("--dataset", default=None, type=str,
                         help="The input training data file (a text file).")
+    parser.add_argument("--hierarchical", action='store_true', default=settings.hierarchical_head,
+                        help="Predict the package first, then only the functions of the top packages.")
+    parser.add_argument("--resume_from", default=None, type=str,
+                        help="Incremental mode: directory of a trained model (labelMap.pkl and checkpoint) "
+                             "to extend with the new labels of --dataset.")
+    parser.add_argument("--replay_dataset", default=None, type=str,
+                        help="Incremental mode: the data the resumed model was trained on, sampled for replay.")
+    parser.add_argument("--replay_ratio", default=1.0, type=float,
+                        help="Incremental mode: replayed samples per new sample.")
+    parser.add_argument("--dedup_threshold", default=settings.dedup_threshold, type=float,
+                        help="Drop training samples whose normalized tokens have a MinHash similarity of at least "
+                             "this to a kept sample with the same label.")
+    parser.add_argument("--epochs", default=None, type=int,
+                        help="Override settings.epochs, e.g. for shorter incremental fine-tuning.")
+    parser.add_argument("--output_dir", default=settings.output_dir, type=str,
+                        help="Directory the checkpoint and labelMap.pkl are written to.")
     # Setup logging
     logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s', datefmt='%m/%d/%Y %H:%M:%S',
                         level=logging.INFO)
     logger.warning("device: %s, n_gpu: %s", settings.device, settings.n_gpu, )
 
     args = parser.parse_args()
+    if args.epochs is not None:
+        settings.epochs = args.epochs
     # Set seed
     set_seed()
-    tokenizer = RobertaTokenizer.from_pretrained(settings.model_name)
-    train_dataset = BundleDataset(tokenizer, args.dataset)
-    config = RobertaConfig.from_pretrained(settings.model_name, num_labels=len(train_dataset.function2number))
-    config.num_labels = len(train_dataset.function2number)
-    model = RobertaForSequenceClassification.from_pretrained(settings.model_name, config=config)
-    model = Model(model, config, tokenizer)
-    train(train_dataset, model)
+    if args.resume_from:
+        model, tokenizer, label_id_to_label = load_model(args.resume_from)
+        train_dataset, function2number, dedup_report = incremental_datasets(
+            tokenizer, model, label_id_to_label, args.dataset, args.replay_dataset, args.replay_ratio,
+            args.dedup_threshold)
+        write_dedup_report(dedup_report, args.output_dir)
+        train(train_dataset, model, function2number, args.output_dir)
+    else:
+        tokenizer = RobertaTokenizer.from_pretrained(settings.model_name)
+        train_dataset = BundleDataset(tokenizer, args.dataset, dedup_threshold=args.dedup_threshold)
+        write_dedup_report(train_dataset.dedup_report, args.output_dir)
+        config = RobertaConfig.from_pretrained(settings.model_name, num_labels=len(train_dataset.function2number))
+        config.num_labels = len(train_dataset.function2number)
+        if args.hierarchical:
+            config.hierarchical_head = True
+            config.num_packages = len(train_dataset.package2number)
+            config.function_embedding_size = settings.function_embedding_size
+            config.top_packages = settings.top_packages
+        model = RobertaForSequenceClassification.from_pretrained(settings.model_name, config=config)
+        model = Model(model, config, tokenizer)
+        if args.hierarchical:
+            model.classifier.set_function_package(train_dataset.function_packages())
+        train(train_dataset, model, output_dir=args.output_dir)
@@ -15,6 +15,8 @@ from transformers import (WEIGHTS_NAME, AdamW, get_linear_schedule_with_warmup,
 from tqdm import tqdm, trange
 
 import settings
+from corpus import Corpus, is_corpus
+from dedup import deduplicate
 from model import Model
 
 logger = logging.getLogger(__name__)
@@ -163,41 +165,70 @@ def convert_examples_to_features(record, tokenizer, function2number):
 
 
 class BundleDataset(Dataset):
-    def __init__(self, tokenizer, file_path: str = 'train'):
+    def __init__(self, tokenizer, file_path: str = 'train', function2number: dict[str, int] | None = None,
+                 extend_labels: bool = True, max_records: int | None = None, dedup_threshold: float | None = None):
+        """
+        :param file_path: a .jsonl file, a directory of .jsonl files or a corpus directory written by corpus.py
+        :param function2number: an existing label map (e.g. a teacher's labelMap.pkl) whose ids are kept
+        :param extend_labels: if False, records whose label is not in function2number are dropped
+        :param max_records: randomly keep at most this many records (e.g. replayed samples)
+        :param dedup_threshold: drop near-duplicates of a kept sample with the same label (see dedup.py)
+        """
         self.examples: list[InputFeatures] = []
         self.package2number = {}
         self.function2number = {}
+        if function2number is not None:
+            self.function2number = dict(function2number)
+            for functionName, _ in sorted(function2number.items(), key=lambda e: e[1]):
+                packageName = decode_label(functionName)["packageName"]
+                if packageName not in self.package2number:
+                    self.package2number[packageName] = len(self.package2number)
         # load index
         logger.info("Creating features from index file at %s ", file_path)
         data = []
         known_code = set()
 
-        def _process(file_path: Path):
+        def _process(records):
+            for record in records:
+                if record['code'] in known_code:
+                    continue
+                if not extend_labels and encode_label(record["label"]) not in self.function2number:
+                    continue
+                known_code.add(record['code'])
+                data.append(record)
+                # if file_path.parts[-3] == record["label"]["packageName"]:
+                packageName = record["label"]["packageName"]
+                functionName = encode_label(record["label"])
+                if packageName not in self.package2number:
+                    self.package2number[packageName] = len(self.package2number)
+                if functionName not in self.function2number:
+                    self.function2number[functionName] = len(self.function2number)
+
+        def _jsonl(file_path: Path):
             with file_path.open() as f:
                 for line in f:
-                    line = line.strip()
-                    record = json.loads(line)
-                    if record['code'] in known_code:
-                        continue
-                    known_code.add(record['code'])
-                    data.append(record)
-                    # if file_path.parts[-3] == record["label"]["packageName"]:
-                    packageName = record["label"]["packageName"]
-                    functionName = encode_label(record["label"])
-                    if packageName not in self.package2number:
-                        self.package2number[packageName] = len(self.package2number)
-                    if functionName not in self.function2number:
-                        self.function2number[functionName] = len(self.function2number)
-
-        if os.path.isfile(file_path) and file_path.endswith('.jsonl'):
-            _process(Path(file_path))
+                    yield json.loads(line.strip())
+
+        if is_corpus(file_path):
+            _process(Corpus(file_path).records(processes=settings.corpus_read_processes))
+        elif os.path.isfile(file_path) and file_path.endswith('.jsonl'):
+            _process(_jsonl(Path(file_path)))
         elif os.path.isdir(file_path):
             files = Path(file_path).glob('**/*.jsonl')
             for file in files:
-                _process(file)
+                _process(_jsonl(file))
         else:
             raise ValueError(
-                f"Invalid file path: {file_path}. Must be a .jsonl file or a directory containing .jsonl files.")
+                f"Invalid file path: {file_path}. Must be a .jsonl file, a directory containing .jsonl files "
+                f"or a corpus written by corpus.py.")
+
+        self.dedup_report = None
+        if dedup_threshold is not None:
+            data, self.dedup_report = deduplicate(data, dedup_threshold, settings.minhash_permutations,
+                                                  settings.shingle_size)
+
+        if max_records is not None and len(data) > max_records:
+            data = random.Random(settings.seed).sample(data, max_records)
 
         # convert example to input features
         print("Converting examples to features")
@@ -212,6 +243,15 @@ class BundleDataset(Dataset):
         if len(self.examples) != len(data):
             logger.warning("Duplicate code(after strip) detected, removed duplicates")
 
+    def function_packages(self) -> list[int]:
+        """
+        :return: the package number of every function, indexed by function number
+        """
+        function_package = [0] * len(self.function2number)
+        for functionName, number in self.function2number.items():
+            function_package[number] = self.package2number[decode_label(functionName)["packageName"]]
+        return function_package
+
     def __len__(self):
         return len(self.examples)
 
@@ -1,18 +1,41 @@
+import gzip
 import multiprocessing
 import os
+import shutil
 import threading
 import logging
 import platform
 import subprocess
 import traceback
 import time
+from contextlib import contextmanager
 from pathlib import Path
 
 import psutil
 
 from collections import deque
 
+import settings
+
 OS_LINUX = "ELF"
+# bytes read from the output of a command at a time
+READ_SIZE = 1024 * 1024
+
+# while record_commands is active, the commands a thread runs are appended to its list
+_recorded = threading.local()
+
+
+@contextmanager
+def record_commands():
+    """
+    Collect the exit code, resource usage (os.wait4) and duration of the commands the current thread runs
+    """
+    previous = getattr(_recorded, "commands", None)
+    _recorded.commands = []
+    try:
+        yield _recorded.commands
+    finally:
+        _recorded.commands = previous
 
 
 def kill(proc_pid):
@@ -27,12 +50,29 @@ def kill(proc_pid):
 
 class CommandRunner:
     """
-    Run command and get output
+    Run command and get output.
+    run_and_log streams the output to its log file as it arrives. In memory only the last tail_bytes of the output
+    are kept, of which output holds the last output_size lines.
     """
-    def __init__(self, output_size: int = 5000, silent: bool = False):
-        self.output: deque[str] = deque(maxlen=output_size)
+    def __init__(self, output_size: int = 5000, silent: bool = False, tail_bytes: int = settings.LOG_TAIL_BYTES):
+        self.output_size = output_size
         self.silent = silent
+        self.tail_bytes = tail_bytes
         self.lastline = ''
+        self._tail: deque[bytes] = deque()
+        self._tail_size = 0
+        self._total = 0
+        self._log_file = None
+        self._logged = 0
+
+    @property
+    def output(self) -> list[str]:
+        text = b"".join(self._tail).decode('utf8', errors='ignore').replace('\r\n', '\n').replace('\r', '\n')
+        lines = text.split('\n')
+        if self._total > self._tail_size:
+            # the first line was cut
+            lines = lines[1:]
+        return [line for line in lines if len(line) > 0][-self.output_size:]
 
     def log(self, log_line):
         logging.info(log_line)
@@ -43,7 +83,7 @@ class CommandRunner:
     def run_cmd(self, cmd: str, timeout: float | None = None, env: dict[str, str] | None = None,
                 cwd: str | None = None) -> tuple[str, int]:
         logging.info("Running cmd: \"{}\"".format(cmd))
-        kargs = {"shell": True, "bufsize": 1024, "stdout": subprocess.PIPE, "stderr": subprocess.STDOUT,
+        kargs = {"shell": True, "bufsize": READ_SIZE, "stdout": subprocess.PIPE, "stderr": subprocess.STDOUT,
                  "stdin": subprocess.DEVNULL}
         if env:
             _env = os.environ.copy()
@@ -51,13 +91,16 @@ class CommandRunner:
             kargs["env"] = _env
         if cwd:
             kargs["cwd"] = cwd
+        start_time = time.time()
         process = subprocess.Popen(cmd, **kargs)
         log_thread = threading.Thread(target=self.print_log, args=(process.stdout,))
         log_thread.daemon = True
         log_thread.start()
 
+        rusage, finished = None, False
         try:
-            process.wait(timeout=timeout)
+            rusage = self._wait(process, timeout)
+            finished = True
         except BaseException:
             # If the call to wait does not complete normally (for instance due
             # to a KeyboardInterrupt or a timeout), try to clean up the process
@@ -66,45 +109,108 @@ class CommandRunner:
             raise
         finally:
             log_thread.join(timeout=5)
+            commands = getattr(_recorded, "commands", None)
+            if commands is not None:
+                commands.append({"exit_code": process.returncode if finished else -1, "rusage": rusage,
+                                 "duration": time.time() - start_time})
 
         return self.callback(), process.returncode
 
+    @staticmethod
+    def _wait(process: subprocess.Popen, timeout: float | None):
+        """
+        Wait like Popen.wait, but with os.wait4 to get the resource usage of the command and its descendants
+        """
+        if not hasattr(os, "wait4"):
+            process.wait(timeout=timeout)
+            return None
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                process.returncode = os.waitstatus_to_exitcode(status)
+                return rusage
+            if deadline is not None and time.time() > deadline:
+                raise subprocess.TimeoutExpired(process.args, timeout)
+            time.sleep(0.05)
+
     def print_log(self, stdout):
-        for log_line in self._log_line_iter(stdout):
-            if not self.silent:
+        while buf := stdout.read1(READ_SIZE):
+            self._append(buf)
+
+    def _append(self, buf: bytes):
+        self._total += len(buf)
+        log_file = self._log_file
+        if log_file is not None:
+            room = len(buf) if settings.LOG_MAX_BYTES is None else settings.LOG_MAX_BYTES - self._logged
+            if room > 0:
+                try:
+                    log_file.write(buf[:room])
+                    self._logged += min(room, len(buf))
+                except (OSError, ValueError):
+                    # the log was closed while a descendant still writes to the pipe
+                    pass
+        elif not self.silent:
+            for log_line in self._log_line_iter(buf):
                 self.log(log_line)
-            self.output.append(log_line)
+        if self.tail_bytes:
+            buf = buf[-self.tail_bytes:]
+            self._tail.append(buf)
+            self._tail_size += len(buf)
+            while self._tail_size - len(self._tail[0]) >= self.tail_bytes:
+                self._tail_size -= len(self._tail.popleft())
 
-    def _log_line_iter(self, reader):
-        while True:
-            buf = reader.read(1024)
-            if buf:
-                lines = buf.decode('utf8', errors='ignore')
-                lines = lines.replace('\r\n', '\n').replace('\r', '\n').split('\n')
-                lines[0] = self.lastline + lines[0]
-                for line in lines[:-1]:
-                    if len(line) > 0:
-                        yield line
-                self.lastline = lines[-1]
-            else:
-                break
+    def _log_line_iter(self, buf: bytes):
+        lines = buf.decode('utf8', errors='ignore')
+        lines = lines.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+        lines[0] = self.lastline + lines[0]
+        for line in lines[:-1]:
+            if len(line) > 0:
+                yield line
+        self.lastline = lines[-1]
+
+    def _write_skipped(self, f):
+        """
+        Append the tail of an output that exceeded LOG_MAX_BYTES to its log
+        """
+        tail = b"".join(self._tail)
+        tail_start = self._total - len(tail)
+        overlap = max(self._logged - tail_start, 0)
+        f.write(f"\n\n[{tail_start + overlap - self._logged} bytes of output not logged, "
+                f"LOG_MAX_BYTES is {settings.LOG_MAX_BYTES}]\n\n".encode())
+        f.write(tail[overlap:])
 
     def run_and_log(self, cmd: str, log_file_path: str, timeout: float | None = None,
                     env: dict[str, str] | None = None,
                     cwd: str | None = None) -> tuple[str, int]:
+        """
+        Run cmd, streaming its output to log_file_path, which is gzipped to log_file_path.gz if it ends up larger
+        than LOG_COMPRESS_OVER
+        """
         start_time = time.time()
+        os.makedirs(os.path.dirname(log_file_path) or ".", exist_ok=True)
+        if os.path.exists(f"{log_file_path}.gz"):
+            os.remove(f"{log_file_path}.gz")
+        f = open(log_file_path, "wb", buffering=0)
+        f.write((cmd + "\n\n" + ("\n".join([f"{e}={env[e]}" for e in env]) if env else "") + "\n\n").encode())
+        self._log_file = f
         try:
             log, code = self.run_cmd(cmd, timeout, env, cwd)
             return log, code
         except Exception as e:
             trace = traceback.format_exc()
             self.log(trace)
-            self.output.append(trace)
+            self._append(trace.encode())
             return self.callback(), -1
         finally:
             end_time = time.time()
             duration = end_time - start_time
-            if not os.path.exists(log_file_path):
-                os.makedirs(os.path.dirname(log_file_path), exist_ok=True)
-            with open(log_file_path, "w+") as f:
-                f.write(cmd + "\n\n" + ("\n".join([f"{e}={env[e]}" for e in env]) if env else "") +"\n\n"+ "\n".join(self.output) + "\n\n" + f"Execution time: {duration} seconds")
+            self._log_file = None
+            with f:
+                if self._logged < self._total:
+                    self._write_skipped(f)
+                f.write(("\n\n" + f"Execution time: {duration} seconds").encode())
+            if settings.LOG_COMPRESS_OVER is not None and os.path.getsize(log_file_path) > settings.LOG_COMPRESS_OVER:
+                with open(log_file_path, "rb") as src, gzip.open(f"{log_file_path}.gz", "wb") as dst:
+                    shutil.copyfileobj(src, dst, READ_SIZE)
+                os.remove(log_file_path)
@@ -11,6 +11,7 @@ from strsimpy import MetricLCS, LongestCommonSubsequence
 from tqdm import tqdm
 
 import settings
+from utils import log_path, read_log
 DETAIL_REPORT = True
 
 @dataclasses.dataclass(frozen=True)
@@ -180,10 +181,9 @@ def diff_one_web(dir: Path, suffix="-pred"):
     unpack_file = dir / f"codeql{suffix}-results.csv"
     if not (os.path.exists(compile_file) and os.path.exists(unpack_file)):
         return False, [], [], [], [], [], []
-    compile_file_log = dir / 'codeql-compile-making-db.log'
-    with compile_file_log.open() as f:
-        if "syntax errors" in f.read():
-            return False, [], [], [], [], [], []
+    compile_file_log = read_log(str(dir / 'codeql-compile-making-db.log'))
+    if compile_file_log is None or "syntax errors" in compile_file_log:
+        return False, [], [], [], [], [], []
     return compare_files(compile_file, unpack_file)
 
 
@@ -541,7 +541,7 @@ def diff_all_webs(rdir: Path, unpack_suffix="-pred"):
                                 #     print("[Missing]",domain)
                                 miss_domains.add(_script)
                                 miss_sites.append(bundle_site)
-                    elif (domain / f"unpack{unpack_suffix}.log").exists():
+                    elif log_path(str(domain / f"unpack{unpack_suffix}.log")) is not None:
                         domains_failed.add("/".join(domain.parts[-2:]))
                         sites_failed.add(site)
                         scripts_has_webpack.add(bundle_script)
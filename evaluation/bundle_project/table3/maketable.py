@@ -8,6 +8,7 @@ import pandas as pd
 
 from bundle_project.compare_codeql import TaintReport, convert_path, trans_reports_to_dict, getTaintReport
 import settings
+from utils import read_log
 
 def geomean(data):
     log_sum = sum(math.log(x if x>0 else 1e-10) for x in data)
@@ -62,10 +63,9 @@ def diff_report(dir: Path, suffix="-pred"):
     unpack_file = dir / f"codeql{suffix}-results.csv"
     if not (compile_file.exists() and unpack_file.exists()):
         return False, [], [], [], [], [], []
-    compile_file_log = dir / 'codeql-compile-making-db.log'
-    with compile_file_log.open() as f:
-        if "syntax errors" in f.read():
-            return False, [], [], [], [], [], []
+    compile_file_log = read_log(str(dir / 'codeql-compile-making-db.log'))
+    if compile_file_log is None or "syntax errors" in compile_file_log:
+        return False, [], [], [], [], [], []
     return compare_reports(compile_file, unpack_file)
 
 def get_type_to_scripts(l: set[tuple[str,str]], keys: set[str]=set()):
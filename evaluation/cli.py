@@ -1,4 +1,6 @@
 #!/usr/bin/env python3
+import heapq
+import itertools
 import json
 import logging
 import multiprocessing
@@ -11,7 +13,7 @@ import traceback
 from collections import deque
 from functools import wraps
 from pathlib import Path
-from typing import Callable, Concatenate, ParamSpec, Protocol, Generator
+from typing import Any, Callable, Concatenate, ParamSpec, Protocol, Generator
 
 import fire  # type: ignore
 
@@ -19,6 +21,7 @@ import JellyTask as Task
 import settings
 from CommandRunner import CommandRunner
 from TempDirectoryManager import TempDirectoryManager
+from scheduler import MemoryScheduler, Unit
 from utils import md5_string, memory_str_to_megabytes
 
 """
@@ -555,6 +558,8 @@ class Cli:
             0 means the number of cores, -1 means no parallelism.
         """
         self.processes = processes
+        # expected peak memory of one task in MB, used by the memory-aware scheduler
+        self.memory_hint = memory_str_to_megabytes(str(memory))
         print(f"Using {self.processes} processes")
         settings.CPU_PER_PROCESS = cpus
         settings.MEMORY_PER_PROCESS = memory
@@ -563,6 +568,10 @@ class Cli:
         self.processes = multiprocessing.cpu_count() if processes == 0 else processes
         print(f"scheduling {self.processes} processes")
 
+    def set_memory_hint(self, memory_hint_mb: int):
+        self.memory_hint = memory_hint_mb
+        print(f"expecting {self.memory_hint} MB per task")
+
 
     def _batch_run(
         self,
@@ -576,13 +585,18 @@ class Cli:
     ):
         """
         run the provided function on all the tasks in db
-        if self.processes is not -1, the tasks will be run in parallel with multiprocessing
+        if self.processes is not -1, the tasks will be run in parallel with multiprocessing,
+        with MEMORY_SCHEDULER at most self.processes at a time as long as memory is available
         """
         if task_label == "TIMESTAMP":
             task_label = time.strftime("%Y-%m-%d#%H.%M.%S", time.localtime())
         tasks: list[Task.JellyTask] = read_db(db) if isinstance(db, str) else db
 
-        if self.processes != -1 and self.processes != 1:
+        if self.processes != -1 and self.processes != 1 and settings.MEMORY_SCHEDULER:
+            # admit tasks by the free memory instead of a fixed MEMORY_PER_PROCESS per slot
+            MemoryScheduler(self.processes, self.memory_hint).run(
+                f, tasks, task_label, black_list_tasks, white_list_tasks, *args, **kwargs)
+        elif self.processes != -1 and self.processes != 1:
             with multiprocessing.Pool(processes=self.processes) as pool:
                 for future in [
                     pool.apply_async(f, (task, task_label, black_list_tasks, white_list_tasks, *args), kwargs)
@@ -596,6 +610,34 @@ class Cli:
             for task in tasks:
                 f(task, task_label, black_list_tasks, white_list_tasks, *args, **kwargs)
 
+    def _batch_run_units(self, units: list[Unit], on_done: Callable[[Unit, bool, Any], list[Unit]]):
+        """
+        run units of work from a shared queue, the units returned by on_done are added to it
+        if self.processes is not -1, the units run in parallel, at most self.processes at a time
+        (with MEMORY_SCHEDULER as long as memory is available)
+        """
+        if self.processes != -1 and self.processes != 1:
+            MemoryScheduler(self.processes, self.memory_hint, memory_aware=settings.MEMORY_SCHEDULER).run_units(
+                units, on_done)
+            return
+        queue = [(unit.priority, i, unit) for i, unit in enumerate(units)]
+        heapq.heapify(queue)
+        sequence = itertools.count(len(queue))
+        failed = []
+        while queue:
+            _, _, unit = heapq.heappop(queue)
+            # like MemoryScheduler, a failed unit does not stop the others
+            try:
+                ok, result = True, unit.f(*unit.args)
+            except Exception:
+                ok, result = False, traceback.format_exc()
+                logging.error(f"Unit {unit.key} failed: {result}")
+                failed.append(str(unit.key))
+            for new_unit in on_done(unit, ok, result) or []:
+                heapq.heappush(queue, (new_unit.priority, next(sequence), new_unit))
+        if failed:
+            raise RuntimeError(f"{len(failed)} units failed: {', '.join(failed[:10])}")
+
     @staticmethod
     def _check_docker():
         assert (
@@ -652,6 +694,70 @@ class Cli:
         from pipeline import run_pipeline
         run_pipeline(self, db, task_label, script, black_list, white_list)
 
+    def codeql_warm(self, script: str = "simple"):
+        """
+        compile the CodeQL query suites of a pipeline script into CODEQL_COMPILATION_CACHE
+        :param script: script
+        """
+        from pipeline import query_suites, warm_query_suites
+        if not script.endswith(".json"):
+            script = f"{settings.SCRIPT_DIR}/script/{script}.json"
+        with open(script) as f:
+            pipeline = json.load(f)
+        warm_query_suites(pipeline)
+        print(f"compiled {', '.join(query_suites(pipeline)) or 'no query suites'}")
+
+    def pipeline_progress(self, task_label: str):
+        """
+        print the progress of a pipeline run from its journal
+        :param task_label: label of the run
+        """
+        from journal import RunJournal, JOURNAL_FILE
+        results_dir = f"{settings.WORK_DIR}/{task_label}"
+        if not os.path.exists(f"{results_dir}/{JOURNAL_FILE}"):
+            print(f"{results_dir} has no journal")
+            return
+        print(json.dumps(RunJournal(results_dir).progress(), indent=2))
+
+    def pipeline_enqueue(self, db: str, queue: str, task_label: str = "TIMESTAMP",
+                         script: str = "simple",
+                         black_list: str | None = None, white_list: str | None = None):
+        """
+        enqueue the tasks of a pipeline run into a work queue shared by the worker nodes
+        :param db: database.json file path
+        :param queue: work queue file, on storage shared by all nodes
+        :param task_label: unique label for this group of tasks
+        :param script: script
+        """
+        from pipeline import load_pipeline
+        from workqueue import enqueue
+        run = load_pipeline(self, db, task_label, script, black_list, white_list)
+        count = enqueue(queue, run)
+        print(f"enqueued {count} tasks as {run['task_label']}")
+
+    def pipeline_worker(self, queue: str, wait: bool = False):
+        """
+        run units of the work queue until it is drained, at most self.processes at a time
+        :param queue: work queue file
+        :param wait: keep waiting for new units
+        """
+        from workqueue import worker
+        processes = multiprocessing.cpu_count() if self.processes == 0 else max(self.processes, 1)
+        worker(queue, processes, wait=wait)
+
+    def pipeline_status(self, queue: str):
+        from workqueue import WorkQueue
+        print(json.dumps(WorkQueue(queue).status(), indent=2))
+
+    def pipeline_build_db(self, queue: str, task_label: str):
+        """
+        build the databases of a run of the work queue
+        """
+        from pipeline import build_databases
+        from workqueue import WorkQueue
+        config = WorkQueue(queue).run_config(task_label)
+        build_databases(config["pipeline"], config["results_dir"], config["task_name"], config["version_pattern"])
+
     def statics_benchmark(self, db: str):
         succeed_cases=[]
         failed_cases=[]
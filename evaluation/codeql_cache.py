@@ -0,0 +1,268 @@
+"""
+Caches for CodeQL: databases keyed by a content hash of the source root and the CodeQL version, and the compiled
+queries of the query suites.
+
+Re-running a pipeline with another query suite or after a crash, and sites that share byte-identical scripts, reuse
+the database instead of extracting the sources again. CodeQL stores source locations relative to the source root, so
+a database is valid for any root with the same content. Entries are locked with flock while they are created or
+analyzed, and the least recently used ones are evicted once the cache exceeds CODEQL_DB_CACHE_MB.
+
+    <cache>/<key>/db              the database
+    <cache>/<key>/making-db.log   log of its creation, copied to every task that uses it
+    <cache>/<key>/size            size in bytes, its mtime is the last use
+    <cache>/<key>.lock
+
+The queries of a suite are compiled once into CODEQL_COMPILATION_CACHE by warm_query_cache, before any analysis.
+A stamp records the fingerprint of what was compiled (CodeQL version, suite, query and library files), and
+check_query_cache fails if it is stale instead of letting every analysis compile the queries again.
+"""
+import fcntl
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable
+
+import settings
+from CommandRunner import CommandRunner
+from utils import log_path
+
+
+@functools.lru_cache(maxsize=None)
+def codeql_version(codeql: str) -> str:
+    return subprocess.run([codeql, "version", "--format=terse"], capture_output=True, text=True,
+                          check=True).stdout.strip()
+
+
+def source_hash(source_root: str) -> str:
+    """
+    Hash of the relative paths and contents of all files below source_root
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    for root, dirs, files in os.walk(source_root):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if not os.path.isfile(path):
+                continue
+            digest.update(os.path.relpath(path, source_root).encode("utf-8", errors="surrogateescape") + b"\0")
+            with open(path, "rb") as f:
+                while chunk := f.read(1 << 20):
+                    digest.update(chunk)
+            digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _directory_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _copy_log(src: str, dst: str):
+    """
+    Copy the log src, or src.gz if it was compressed, to dst or dst.gz
+    """
+    src = log_path(src)
+    for stale in [dst, f"{dst}.gz"]:
+        if os.path.exists(stale):
+            os.remove(stale)
+    if src is not None:
+        shutil.copyfile(src, f"{dst}.gz" if src.endswith(".gz") else dst)
+
+
+@contextmanager
+def _locked(path: str, exclusive: bool = True, blocking: bool = True):
+    with open(path, "a") as f:
+        try:
+            fcntl.flock(f, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class CodeQLDatabaseCache:
+    def __init__(self, root: str = settings.CODEQL_DB_CACHE_DIR,
+                 max_bytes: int = settings.CODEQL_DB_CACHE_MB * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def key(self, codeql: str, source_root: str, language: str = "javascript") -> str:
+        return hashlib.blake2b(f"{codeql_version(codeql)}\0{language}\0{source_hash(source_root)}".encode(),
+                               digest_size=20).hexdigest()
+
+    @contextmanager
+    def database(self, key: str, create: Callable[[str, str], bool], log_file: str):
+        """
+        Lock the database of key, creating it with create(database, log_file) if it is not cached
+        :param log_file: where the log of the creation is written, also for a cached database
+        :return: (yields) the database path, None if it could not be created
+        """
+        entry = os.path.join(self.root, key)
+        with _locked(f"{entry}.lock"):
+            if not os.path.isdir(os.path.join(entry, "db")):
+                tmp = os.path.join(self.root, f".{key}-{uuid.uuid4().hex}")
+                os.makedirs(tmp)
+                try:
+                    ok = create(os.path.join(tmp, "db"), log_file)
+                    if ok:
+                        _copy_log(log_file, os.path.join(tmp, "making-db.log"))
+                        shutil.rmtree(entry, ignore_errors=True)
+                        os.rename(tmp, entry)
+                finally:
+                    shutil.rmtree(tmp, ignore_errors=True)
+                if not ok:
+                    yield None
+                    return
+            else:
+                logging.info(f"Reusing CodeQL database {key}")
+                _copy_log(os.path.join(entry, "making-db.log"), log_file)
+            try:
+                yield os.path.join(entry, "db")
+            finally:
+                # analyzing adds its results and evaluation cache to the database
+                Path(entry, "size").write_text(str(_directory_size(entry)))
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used databases that are not in use until the cache fits in max_bytes
+        """
+        entries = []
+        for name in os.listdir(self.root):
+            size_file = os.path.join(self.root, name, "size")
+            if name.startswith(".") or not os.path.exists(size_file):
+                continue
+            try:
+                entries.append((os.path.getmtime(size_file), int(Path(size_file).read_text()), name))
+            except (OSError, ValueError):
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            entry = os.path.join(self.root, name)
+            with _locked(f"{entry}.lock", blocking=False) as locked:
+                if not locked:
+                    continue
+                logging.info(f"Evicting CodeQL database {name} ({size // 1024 // 1024} MB)")
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+
+
+def _pack_root(path: str) -> str:
+    directory = os.path.dirname(os.path.abspath(path))
+    while directory != os.path.dirname(directory):
+        if os.path.exists(os.path.join(directory, "qlpack.yml")):
+            return directory
+        directory = os.path.dirname(directory)
+    return os.path.dirname(os.path.abspath(path))
+
+
+def _library_path(codeql: str, query: str) -> list[str]:
+    """
+    Roots of the pack of a query and of the library packs it depends on, as CodeQL resolves them
+    """
+    resolved = json.loads(subprocess.run([codeql, "resolve", "library-path", "--format=json", f"--query={query}"],
+                                         capture_output=True, text=True, check=True).stdout)
+    return resolved["libraryPath"]
+
+
+@functools.lru_cache(maxsize=None)
+def suite_fingerprint(codeql: str, suite: str) -> str:
+    """
+    Hash of the CodeQL version, the suite, the queries it resolves to and the size and mtime of the query and
+    library files of their packs and the packs these depend on
+    """
+    queries = json.loads(subprocess.run([codeql, "resolve", "queries", "--format=json", suite],
+                                        capture_output=True, text=True, check=True).stdout)
+    # the queries of a pack share its dependencies, resolve them once per pack
+    packs = {}
+    for query in queries:
+        packs.setdefault(_pack_root(query), query)
+    roots = set(packs)
+    for query in packs.values():
+        roots.update(os.path.abspath(root) for root in _library_path(codeql, query))
+    digest = hashlib.blake2b(digest_size=20)
+    # a suite is a file or the name of a pack
+    digest.update(codeql_version(codeql).encode() + b"\0" +
+                  (Path(suite).read_bytes() if os.path.isfile(suite) else suite.encode()) + b"\0")
+    local_pack = os.path.join(os.path.dirname(os.path.abspath(suite)), "qlpack.yml")
+    if os.path.exists(local_pack):
+        digest.update(Path(local_pack).read_bytes())
+    for query in sorted(queries):
+        digest.update(query.encode() + b"\0")
+    for root in sorted(roots):
+        for directory, dirs, files in os.walk(root):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith((".ql", ".qll", ".yml")):
+                    stat = os.stat(os.path.join(directory, name))
+                    digest.update(f"{os.path.join(directory, name)}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode())
+    return digest.hexdigest()
+
+
+def _stamp_path(cache_dir: str, suite: str) -> str:
+    name = hashlib.blake2b(os.path.abspath(suite).encode(), digest_size=8).hexdigest()
+    return os.path.join(cache_dir, f"{Path(suite).stem}-{name}.stamp")
+
+
+def _read_stamp(path: str) -> dict | None:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def warm_query_cache(codeql: str, suite: str, cache_dir: str = settings.CODEQL_COMPILATION_CACHE,
+                     threads: int = 0, timeout: int = settings.TIMEOUT):
+    """
+    Compile the queries of suite into cache_dir unless its stamp is current; concurrent callers wait for the one
+    compiling
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    stamp = _stamp_path(cache_dir, suite)
+    fingerprint = suite_fingerprint(codeql, suite)
+    with _locked(f"{stamp}.lock"):
+        current = _read_stamp(stamp)
+        if current is not None and current["fingerprint"] == fingerprint:
+            return
+        logging.info(f"Compiling the queries of {suite} into {cache_dir}")
+        log_file = f"{stamp[:-len('.stamp')]}-compile.log"
+        _, code = CommandRunner().run_and_log(
+            f"{codeql} query compile --compilation-cache={cache_dir} --threads={threads} {suite}", log_file,
+            timeout=timeout)
+        if code != 0:
+            raise RuntimeError(f"Compiling the queries of {suite} failed, see {log_file}")
+        tmp = f"{stamp}.{uuid.uuid4().hex}"
+        with open(tmp, "w") as f:
+            json.dump({"fingerprint": fingerprint, "suite": os.path.abspath(suite),
+                       "codeql": codeql_version(codeql)}, f)
+        os.replace(tmp, stamp)
+
+
+def check_query_cache(codeql: str, suite: str, cache_dir: str = settings.CODEQL_COMPILATION_CACHE):
+    """
+    Raise if the compiled queries of suite in cache_dir are missing or stale
+    """
+    current = _read_stamp(_stamp_path(cache_dir, suite))
+    if current is None or current["fingerprint"] != suite_fingerprint(codeql, suite):
+        raise RuntimeError(f"The compilation cache {cache_dir} is stale for {suite}, warm it with "
+                           f"./cli.py codeql-warm --script <pipeline>")
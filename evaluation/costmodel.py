@@ -0,0 +1,227 @@
+"""
+Expected running time of pipeline tasks, to start the longest ones first and predict when a run completes.
+
+A task that ran before in the same pipeline (task_name) is expected to keep a process as busy as it did then: the
+spans of its units in the journals of the runs in WORK_DIR, or the "Execution time" lines that CommandRunner writes at
+the end of every log of runs without a journal. Other tasks are estimated by a linear model of their size on disk and
+number of scripts, fit on the tasks with both a history and their sources on disk.
+"""
+import glob
+import gzip
+import heapq
+import logging
+import os
+import re
+import sqlite3
+import time
+
+import numpy as np
+
+import JellyTask as Task
+import settings
+from journal import JOURNAL_FILE, unit_key
+
+EXECUTION_TIME_RE = re.compile(rb"Execution time: ([\d.]+) seconds")
+SCRIPT_SUFFIXES = (".js", ".mjs", ".cjs")
+# a model needs a few samples per coefficient, otherwise tasks are ordered by these rough defaults
+MIN_SAMPLES = 10
+DEFAULT_COEFFICIENTS = (60.0, 30.0, 120.0)  # seconds: per task, per MB, per script
+
+
+def task_features(directory: str) -> tuple[float, int]:
+    """
+    :return: size of the sources in MB and number of scripts
+    """
+    size, scripts = 0, 0
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if d != "node_modules"]
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                continue
+            if name.endswith(SCRIPT_SUFFIXES):
+                scripts += 1
+    return size / 1024 / 1024, scripts
+
+
+def journal_durations(results_dir: str) -> dict[str, float]:
+    """
+    Busy time of every finished task of a run in seconds: the sum over the task and its finished sub-tasks of the
+    span from the first start to the last finish of their steps. Steps of a unit run concurrently, so their
+    durations overlap, while sub-tasks may run in other processes or wait in the queue, so the span of the whole
+    task is not the time a process spent on it either.
+    """
+    path = os.path.join(results_dir, JOURNAL_FILE)
+    durations = {}
+    with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as db:
+        for task, seconds in db.execute(
+                "SELECT task, SUM(span) FROM ("
+                "SELECT tasks.unit AS task, MAX(steps.finished) - MIN(steps.started) AS span FROM units AS tasks "
+                "JOIN units ON units.unit = tasks.unit OR (units.parent = tasks.unit AND units.kind = 'sub_task') "
+                "JOIN steps ON steps.unit = units.unit "
+                "WHERE tasks.kind = 'task' AND tasks.status = 'done' AND units.status = 'done' "
+                "AND steps.started IS NOT NULL AND steps.finished IS NOT NULL GROUP BY tasks.unit, units.unit"
+                ") GROUP BY task"):
+            durations[task] = seconds
+    return durations
+
+
+def journal_task_name(results_dir: str) -> str | None:
+    """
+    The task_name of the pipeline of a run, None if its journal is from before it was recorded
+    """
+    path = os.path.join(results_dir, JOURNAL_FILE)
+    with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as db:
+        row = db.execute("SELECT value FROM meta WHERE key = 'task_name'").fetchone()
+    return row[0] if row else None
+
+
+def same_pipeline(results_dir: str, task_name: str, recorded: str | None = None) -> bool:
+    """
+    Whether a run is of the pipeline task_name; without a recorded task_name, a run is recognized by its label
+    (a TIMESTAMP label starts with the task_name) or by the {task_name}.db of its db_builders
+    """
+    if recorded is not None:
+        return recorded == task_name
+    return (os.path.basename(results_dir).startswith(f"{task_name}-")
+            or os.path.exists(os.path.join(results_dir, f"{task_name}.db")))
+
+
+def _log_execution_time(path: str) -> float | None:
+    # the line is the last of the log, only read its end
+    try:
+        if path.endswith(".gz"):
+            # a gzip stream cannot seek from its end
+            tail = b""
+            with gzip.open(path, "rb") as f:
+                while chunk := f.read(1 << 20):
+                    tail = (tail + chunk)[-4096:]
+        else:
+            with open(path, "rb") as f:
+                f.seek(max(os.path.getsize(path) - 4096, 0))
+                tail = f.read()
+    except (OSError, EOFError):
+        return None
+    matches = EXECUTION_TIME_RE.findall(tail)
+    return float(matches[-1]) if matches else None
+
+
+def log_durations(results_dir: str, task: Task.JellyTask) -> float | None:
+    """
+    Total "Execution time" of the logs of a task and its sub-tasks in a run without journal
+    """
+    base = f"{results_dir}/{task.canonical_name}/{task.canonical_version}"
+    total, found = 0.0, False
+    for directory in [base, *glob.glob(f"{glob.escape(base)}##*")]:
+        for log in glob.glob(f"{glob.escape(directory)}/*.log") + glob.glob(f"{glob.escape(directory)}/*.log.gz"):
+            seconds = _log_execution_time(log)
+            if seconds is not None:
+                total += seconds
+                found = True
+    return total if found else None
+
+
+def lpt_makespan(costs: list[float], slots: int) -> float:
+    """
+    Completion time of the longest-processing-time-first schedule of costs on slots parallel workers
+    """
+    loads = [0.0] * max(slots, 1)
+    for cost in sorted(costs, reverse=True):
+        heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads)
+
+
+class CostModel:
+    def __init__(self, task_name: str, work_dir: str = settings.WORK_DIR):
+        """
+        :param task_name: only runs of this pipeline are history, the same task takes a different time in another
+        """
+        self.task_name = task_name
+        self.work_dir = work_dir
+        self.history: dict[str, float] = {}
+        self.legacy_runs: list[str] = []
+        self._scanned: set[str] = set()
+        self.coefficients = DEFAULT_COEFFICIENTS
+        self.samples = 0
+        if os.path.isdir(work_dir):
+            for name in sorted(os.listdir(work_dir)):
+                results_dir = os.path.join(work_dir, name)
+                if not os.path.isdir(results_dir):
+                    continue
+                if os.path.exists(os.path.join(results_dir, JOURNAL_FILE)):
+                    try:
+                        if same_pipeline(results_dir, task_name, journal_task_name(results_dir)):
+                            self.history.update(journal_durations(results_dir))
+                    except sqlite3.Error as e:
+                        logging.warning(f"Cannot read the journal of {results_dir}: {e}")
+                elif same_pipeline(results_dir, task_name):
+                    self.legacy_runs.append(results_dir)
+
+    def past_duration(self, task: Task.JellyTask) -> float | None:
+        seconds = self.history.get(unit_key(task))
+        if seconds is None and unit_key(task) not in self._scanned:
+            self._scanned.add(unit_key(task))
+            for results_dir in self.legacy_runs:
+                seconds = log_durations(results_dir, task)
+                if seconds is not None:
+                    self.history[unit_key(task)] = seconds
+                    break
+        return seconds
+
+    def fit(self, tasks: list[Task.JellyTask]):
+        """
+        Fit the size model on the tasks with a past duration and sources on disk, the given ones and those of the
+        journals
+        """
+        directories = {unit_key(task): str(task.dir) for task in tasks}
+        for unit in self.history:
+            directories.setdefault(unit, f"{settings.PACKAGES_DIR}/{unit}")
+        for task in tasks:
+            self.past_duration(task)
+        rows, targets = [], []
+        for unit, seconds in self.history.items():
+            directory = directories.get(unit)
+            if directory is None or not os.path.isdir(directory):
+                continue
+            size, scripts = task_features(directory)
+            rows.append([1.0, size, scripts])
+            targets.append(seconds)
+        self.samples = len(rows)
+        if self.samples < MIN_SAMPLES:
+            return
+        coefficients, *_ = np.linalg.lstsq(np.asarray(rows), np.asarray(targets), rcond=None)
+        # a negative rate would put the largest tasks last
+        self.coefficients = tuple(max(float(c), 0.0) for c in coefficients)
+
+    def estimate(self, task: Task.JellyTask) -> tuple[float, str]:
+        """
+        :return: expected seconds and where the estimate comes from, "history" or "model"
+        """
+        seconds = self.past_duration(task)
+        if seconds is not None:
+            return seconds, "history"
+        size, scripts = task_features(str(task.dir)) if os.path.isdir(task.dir) else (0.0, 0)
+        base, per_mb, per_script = self.coefficients
+        return base + per_mb * size + per_script * scripts, "model"
+
+
+def order_tasks(tasks: list[Task.JellyTask], task_name: str, processes: int | None = None) -> list[Task.JellyTask]:
+    """
+    Sort tasks longest-expected-first and log the predicted completion time of the run on processes workers
+    :param task_name: task_name of the pipeline the tasks run
+    """
+    model = CostModel(task_name)
+    model.fit(tasks)
+    estimates = {task: model.estimate(task) for task in tasks}
+    ordered = sorted(tasks, key=lambda task: -estimates[task][0])
+    costs = [seconds for seconds, _ in estimates.values()]
+    from_history = sum(1 for _, source in estimates.values() if source == "history")
+    logging.info(f"Cost model: {from_history}/{len(tasks)} tasks ran before, size model fit on {model.samples} "
+                 f"tasks{'' if model.samples >= MIN_SAMPLES else ' (too few, using defaults)'}; "
+                 f"{sum(costs) / 3600:.1f} hours of work")
+    if processes and costs:
+        makespan = lpt_makespan(costs, processes)
+        logging.info(f"Predicted completion with {processes} processes in {makespan / 3600:.1f} hours, at "
+                     f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(time.time() + makespan))}")
+    return ordered
@@ -1,11 +1,11 @@
 import json
 import os
-from pathlib import Path
 from typing import Type, Callable
 
 from sqlalchemy import Column, Integer, String, Float, Boolean, Sequence, ForeignKey
 
 from db import TableBuilder, PY_TYPE, BASE, DB_CLASS, to_sql_name
+from utils import read_log
 
 
 def flatten_dict(d: dict[str, dict | str | int | float | bool], parent_key='', sep='_'):
@@ -140,8 +140,7 @@ class DiagnosticsBuilder(JsonObjectBuilder):
             elif diag.get("timeout", False):
                 error = "TLE"
         else:
-            stdout_log = Path(file_path.replace("diagnostics", "stdout").replace(".json", ".log"))
-            log_text = "" if not stdout_log.is_file() else stdout_log.read_text()
+            log_text = read_log(file_path.replace("diagnostics", "stdout").replace(".json", ".log")) or ""
             if "young object promotion failed Allocation failed" in log_text:
                 error = "SEMI_OOM"
             elif "Time limit reached" in log_text:
@@ -1,9 +1,9 @@
 import re
-from pathlib import Path
 from typing import Type
 
 from sqlalchemy import Column, Integer, ForeignKey, String, Text
 from db import TableBuilder, BASE
+from utils import read_log
 
 error_pattern = re.compile(r'Error.*', re.MULTILINE)
 warning_pattern = re.compile(r'Warning.*', re.MULTILINE)
@@ -25,9 +25,8 @@ class LogBuilder(TableBuilder):
         return type(self.table_name, (LogTemplate, BASE), attrs)
 
     def new_object(self, file_path: str, env: dict[str, BASE | list[BASE]]) -> list[BASE] | BASE | None:
-        path = Path(file_path)
-        if path.is_file():
-            log_text = path.read_text()
+        log_text = read_log(file_path)
+        if log_text is not None:
             log_records = []
             for pat, level in ((error_pattern, "ERROR"), (warning_pattern, "WARNING"), (debug_pattern, "VARSET")):
                 for line in set(pat.findall(log_text)):
@@ -0,0 +1,187 @@
+"""
+Run journal: the state of every unit (task, sub-task) and step of a pipeline run in one SQLite file,
+{WORK_DIR}/{task_label}/journal.db, instead of marker files (.finished-{i}, .finished_prepare_package_all and the
+existence of the output dir of a sub-task).
+
+Resuming a run reads the journal: done steps are skipped, failed steps run again until they have been attempted
+STEP_MAX_ATTEMPTS times, and steps that were running when the run died start over. The marker files of runs from
+before the journal are still honored if the results dir already existed when the journal was created.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+import JellyTask as Task
+import settings
+
+JOURNAL_FILE = "journal.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS units (
+    unit TEXT PRIMARY KEY,
+    parent TEXT,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS units_parent ON units (parent);
+CREATE TABLE IF NOT EXISTS steps (
+    unit TEXT NOT NULL,
+    step TEXT NOT NULL,
+    name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    started REAL,
+    finished REAL,
+    duration REAL,
+    exit_code INTEGER,
+    max_rss_mb REAL,
+    user_s REAL,
+    sys_s REAL,
+    error TEXT,
+    PRIMARY KEY (unit, step)
+);
+"""
+
+
+def unit_key(task: Task.JellyTask) -> str:
+    return f"{task.canonical_name}/{task.canonical_version}"
+
+
+class RunJournal:
+    def __init__(self, results_dir: str, max_attempts: int = settings.STEP_MAX_ATTEMPTS):
+        self.results_dir = results_dir
+        self.path = os.path.join(results_dir, JOURNAL_FILE)
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        existed = os.path.isdir(results_dir)
+        os.makedirs(results_dir, exist_ok=True)
+        created = not os.path.exists(self.path)
+        db = self._db()
+        if created:
+            # results of a run from before the journal are only known from its marker files
+            legacy = existed and any(name != JOURNAL_FILE for name in os.listdir(results_dir))
+            db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('legacy', ?)", (str(int(legacy)),))
+        self.legacy = db.execute("SELECT value FROM meta WHERE key = 'legacy'").fetchone()[0] == "1"
+
+    def set_task_name(self, task_name: str):
+        """
+        Record the task_name of the pipeline, the cost model only learns from runs of the same pipeline
+        """
+        self._db().execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('task_name', ?)", (task_name,))
+
+    def _db(self) -> sqlite3.Connection:
+        # steps of a task run in threads, and a connection must not cross a fork
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=120, isolation_level=None)
+            connection.executescript(SCHEMA)
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    def should_run(self, unit: str, step: str, legacy_finish_file: str | None = None) -> bool:
+        row = self._db().execute("SELECT status, attempts FROM steps WHERE unit = ? AND step = ?",
+                                 (unit, step)).fetchone()
+        if row is None:
+            if self.legacy and legacy_finish_file and os.path.exists(legacy_finish_file):
+                self._db().execute("INSERT OR IGNORE INTO steps (unit, step, name, status, finished) "
+                                   "VALUES (?, ?, 'legacy', 'done', ?)", (unit, step, time.time()))
+                return False
+            return True
+        status, attempts = row
+        if status == "failed":
+            return attempts < self.max_attempts
+        # a step still "running" was interrupted
+        return status == "running"
+
+    def start_step(self, unit: str, step: str, name: str):
+        self._db().execute(
+            "INSERT INTO steps (unit, step, name, status, attempts, started) VALUES (?, ?, ?, 'running', 1, ?) "
+            "ON CONFLICT (unit, step) DO UPDATE SET status = 'running', attempts = attempts + 1, "
+            "started = excluded.started, error = NULL", (unit, step, name, time.time()))
+
+    def finish_step(self, unit: str, step: str, ok: bool, commands: list[dict] | None = None,
+                    error: str | None = None):
+        """
+        :param commands: the commands the step ran, see CommandRunner.record_commands; a non-zero exit code
+            fails the step
+        """
+        commands = commands or []
+        exit_codes = [c["exit_code"] for c in commands]
+        exit_code = next((code for code in exit_codes if code != 0), exit_codes[-1] if exit_codes else None)
+        usages = [c["rusage"] for c in commands if c["rusage"] is not None]
+        # ru_maxrss is in KB on Linux
+        max_rss = max((u.ru_maxrss for u in usages), default=None)
+        now = time.time()
+        self._db().execute(
+            "UPDATE steps SET status = ?, finished = ?, duration = ? - started, exit_code = ?, max_rss_mb = ?, "
+            "user_s = ?, sys_s = ?, error = ? WHERE unit = ? AND step = ?",
+            ("done" if ok and not exit_code else "failed", now, now, exit_code,
+             max_rss / 1024 if max_rss is not None else None,
+             sum(u.ru_utime for u in usages) if usages else None,
+             sum(u.ru_stime for u in usages) if usages else None,
+             error, unit, step))
+
+    def set_units(self, units: list[str], kind: str, status: str, parent: str | None = None):
+        now = time.time()
+        self._db().executemany(
+            "INSERT INTO units (unit, parent, kind, status, updated) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (unit) DO UPDATE SET status = excluded.status, updated = excluded.updated",
+            [(unit, parent, kind, status, now) for unit in units])
+
+    def finish_unit(self, unit: str):
+        failed = self._db().execute("SELECT COUNT(*) FROM steps WHERE unit = ? AND status != 'done'",
+                                    (unit,)).fetchone()[0]
+        self._db().execute("UPDATE units SET status = ?, updated = ? WHERE unit = ?",
+                           ("failed" if failed else "done", time.time(), unit))
+
+    def sub_units(self, parent: str) -> dict[str, str]:
+        """
+        Status of the sub-tasks of a task; failed ones with steps left to retry are "retry"
+        """
+        statuses = dict(self._db().execute("SELECT unit, status FROM units WHERE parent = ?", (parent,)))
+        for (unit,) in self._db().execute(
+                "SELECT DISTINCT steps.unit FROM steps JOIN units ON steps.unit = units.unit "
+                "WHERE units.parent = ? AND units.status = 'failed' AND steps.status = 'failed' "
+                "AND steps.attempts < ?", (parent, self.max_attempts)):
+            statuses[unit] = "retry"
+        return statuses
+
+    def progress(self) -> dict:
+        db = self._db()
+        units = {}
+        for kind, status, n in db.execute("SELECT kind, status, COUNT(*) FROM units GROUP BY kind, status"):
+            units.setdefault(kind, {})[status] = n
+        steps = {}
+        for name, status, n, duration in db.execute(
+                "SELECT name, status, COUNT(*), SUM(duration) FROM steps GROUP BY name, status"):
+            steps.setdefault(name, {})[status] = {"count": n, "hours": round((duration or 0) / 3600, 2)}
+        failed = [{"unit": unit, "step": step, "name": name, "attempts": attempts, "exit_code": exit_code}
+                  for unit, step, name, attempts, exit_code in db.execute(
+                      "SELECT unit, step, name, attempts, exit_code FROM steps WHERE status = 'failed' "
+                      "ORDER BY finished DESC LIMIT 20")]
+        running = [{"unit": unit, "step": step, "name": name, "running_s": round(time.time() - started)}
+                   for unit, step, name, started in db.execute(
+                       "SELECT unit, step, name, started FROM steps WHERE status = 'running' ORDER BY started")]
+        return {"units": units, "steps": steps, "running": running, "recent_failures": failed}
+
+
+_journals: dict[str, RunJournal] = {}
+
+
+def open_journal(task_label: str) -> RunJournal | None:
+    """
+    The journal of a run, None if RUN_JOURNAL is disabled
+    """
+    if not settings.RUN_JOURNAL:
+        return None
+    results_dir = f"{settings.WORK_DIR}/{task_label}"
+    journal = _journals.get(results_dir)
+    if journal is None:
+        journal = _journals[results_dir] = RunJournal(results_dir)
+    return journal
@@ -1,3 +1,4 @@
+import csv
 import json
 import logging
 import os
@@ -6,6 +7,7 @@ import time
 import traceback
 import uuid
 from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 from typing import Callable
 
@@ -13,11 +15,17 @@ import CommandRunner
 import settings
 from TempDirectoryManager import TempDirectoryManager
 from cli import Cli, read_db, jelly_run2, requires_source, sub_packages
+from codeql_cache import CodeQLDatabaseCache, check_query_cache, warm_query_cache
+from costmodel import order_tasks
 from jelly_statistics import make_db
+from journal import open_journal, unit_key
+from scheduler import Unit, pipeline_memory_hint, step_memory_hint, steps_memory_hint
 import JellyTask as Task
-from utils import memory_str_to_megabytes, remove_non_alpha_characters
+from utils import memory_str_to_megabytes, read_log, remove_non_alpha_characters
 
 check_finish_task = ["jelly"]
+# keys of a step that configure its scheduling, not arguments of its function
+STEP_SCHEDULING_KEYS = ["name", "memory_hint", "cpus", "inputs", "outputs"]
 
 dynamic_dir = None
 
@@ -40,19 +48,24 @@ def jelly_wrapper(*args, **kwargs):
     sub_package = kwargs["task"]
     kwargs["output_dir"] = f"{settings.WORK_DIR}/{task_label}/{sub_package.canonical_name}/{sub_package.canonical_version}"
     kwargs["target_dir"] = str(sub_package.dir)
-    sub_finish_file = f"{kwargs['output_dir']}/{kwargs['finish_file']}"
+    # without a finish file (with the run journal), the journal records the step
+    sub_finish_file = f"{kwargs['output_dir']}/{kwargs['finish_file']}" if kwargs.get("finish_file") else None
     if "jelly_args" in kwargs:
         kwargs["jelly_args"] = replace_variables(kwargs["task"], kwargs["task_label"], kwargs["jelly_args"])
     if "jelly_path" in kwargs:
         kwargs["jelly_path"] = replace_variables(kwargs["task"], kwargs["task_label"], kwargs["jelly_path"])
-    if os.path.exists(sub_finish_file):
+    if sub_finish_file and os.path.exists(sub_finish_file):
         return
     jelly_run2(*args, **kwargs)
-    with open(sub_finish_file, "w+") as f:
-        f.write("FIN")
+    if sub_finish_file:
+        with open(sub_finish_file, "w+") as f:
+            f.write("FIN")
 
 
-def replace_variables(task: Task, task_label: str, s: str) -> str:
+def replace_variables(task: Task, task_label: str, s: str, max_memory: str = settings.MEMORY_PER_PROCESS) -> str:
+    """
+    :param max_memory: the memory limit of the step, $MAX_MEMORY_MB
+    """
     micros = {
         "$PACKAGES_DIR": settings.PACKAGES_DIR,
         "$PACKAGE_NAME": task.canonical_name,
@@ -67,7 +80,7 @@ def replace_variables(task: Task, task_label: str, s: str) -> str:
         "$RESULT_DIR": f"{settings.WORK_DIR}/{task_label}/{task.canonical_name}/{task.canonical_version}",
         "$SCRIPT_DIR": settings.SCRIPT_DIR,
         "$JELLY_PATH": settings.JELLY_PATH,
-        "$MAX_MEMORY_MB": str(memory_str_to_megabytes(settings.MEMORY_PER_PROCESS)),
+        "$MAX_MEMORY_MB": str(memory_str_to_megabytes(max_memory)),
         "$CODE_QL_HOME": settings.CODE_QL_HOME,
     }
     for [k, v] in micros.items():
@@ -95,7 +108,7 @@ def exec_command(task: Task.JellyTask, task_label: str, command: str,
                  env: dict[str, str] = None,
                  timeout: int = None,
                  cwd: str = None,
-                 log_file: str = None, finish_file: str = None):
+                 log_file: str = None, finish_file: str = None, max_memory: str = settings.MEMORY_PER_PROCESS):
     """
 
     :param task:
@@ -103,6 +116,7 @@ def exec_command(task: Task.JellyTask, task_label: str, command: str,
     :param command:
     :param timeout:
     :param log_file: relative path(/results/task_label/package_name/version/log_file) of the log file
+    :param max_memory: memory limit of the step, replaces $MAX_MEMORY_MB
     :return:
     """
     task_dir = f"{settings.WORK_DIR}/{task_label}/{task.canonical_name}/{task.canonical_version}"
@@ -111,10 +125,10 @@ def exec_command(task: Task.JellyTask, task_label: str, command: str,
         if os.path.exists(finish_file):
             return
     runner = CommandRunner.CommandRunner()
-    command = replace_variables(task, task_label, command)
+    command = replace_variables(task, task_label, command, max_memory)
     if env is not None:
-        for [k, v] in env.items():
-            env[k] = replace_variables(task, task_label, v)
+        # the env of the step is shared by all tasks, and $MAX_MEMORY_MB differs between steps
+        env = {k: replace_variables(task, task_label, v, max_memory) for k, v in env.items()}
             
     if log_file:
         log_file_path = f"{task_dir}/{log_file}"
@@ -182,7 +196,14 @@ def compare_callgraphs(task: Task.JellyTask, task_label: str, cg1: str, cg2: str
 
 
 def codeql(task: Task.JellyTask, task_label: str, rules: str | None = None, output_label: str = "codeql",
-           source_root: str | None = None, timeout: int = settings.TIMEOUT):
+           source_root: str | None = None, timeout: int = settings.TIMEOUT,
+           threads: int | None = None, ram: int | None = None):
+    """
+    :param threads: CodeQL threads, default is CPU_PER_PROCESS
+    :param ram: CodeQL memory in MB, default is MEMORY_PER_PROCESS
+    """
+    threads = threads or settings.CPU_PER_PROCESS
+    ram = ram or memory_str_to_megabytes(settings.MEMORY_PER_PROCESS)
     if source_root is None:
         source_root = task.dir
     else:
@@ -195,63 +216,283 @@ def codeql(task: Task.JellyTask, task_label: str, rules: str | None = None, outp
         return
     if not os.path.exists(output_dir):
         os.makedirs(output_dir, exist_ok=True)
-    database = f"{settings.TMP_DIR}/{task_label}/{task.canonical_name}/{task.canonical_version}/{uuid.uuid1()}"
+    compilation_cache = compilation_cache_option(task, task_label, rules)
+    run_codeql(task, task_label, source_root, output_dir, rules, output_label, timeout, threads, ram, compilation_cache)
 
-    with TempDirectoryManager(database):
+
+def compilation_cache_option(task: Task.JellyTask, task_label: str, rules: str | None) -> str:
+    """
+    :return: the --compilation-cache option of database analyze, "" without a compilation cache or if the suite
+        depends on the task, since warm_query_suites only compiles the others
+    """
+    if not settings.CODEQL_COMPILATION_CACHE or rules is None or "$" in task_independent_suite(rules):
+        return ""
+    # the queries were compiled before the run, fail instead of compiling them in every analysis
+    check_query_cache(f"{settings.CODE_QL_HOME}/codeql/codeql", replace_variables(task, task_label, rules),
+                      settings.CODEQL_COMPILATION_CACHE)
+    return f"--compilation-cache={settings.CODEQL_COMPILATION_CACHE} "
+
+
+def run_codeql(task: Task.JellyTask, task_label: str, source_root: Path, output_dir: str, rules: str | None,
+               output_label: str, timeout: int, threads: int, ram: int, compilation_cache: str):
+    """
+    Create the database of source_root and analyze it into {output_dir}/{output_label}-results.csv
+    :param compilation_cache: see compilation_cache_option
+    """
+    codeql_bin = f"{settings.CODE_QL_HOME}/codeql/codeql"
+
+    def create_database(database: str, log_file: str) -> bool:
         runner = CommandRunner.CommandRunner()
-        cmd = f"{settings.CODE_QL_HOME}/codeql/codeql database create --language=javascript {database} --source-root={source_root} --ram={memory_str_to_megabytes(settings.MEMORY_PER_PROCESS)} --threads={settings.CPU_PER_PROCESS}"
-        _, code = runner.run_and_log(cmd, f"{output_dir}/{output_label}-making-db.log",
+        cmd = f"{codeql_bin} database create --language=javascript {database} --source-root={source_root} --ram={ram} --threads={threads}"
+        _, code = runner.run_and_log(cmd, log_file,
                                      timeout=timeout,
                                      env={"LGTM_INCLUDE_DIRS": str(source_root)},
                                      cwd=output_dir)
-        if code != 0:
-            return
-        cmd = (f"{settings.CODE_QL_HOME}/codeql/codeql database analyze {database} "
+        return code == 0
+
+    def analyze(database: str):
+        cmd = (f"{codeql_bin} database analyze {database} "
                f"{replace_variables(task, task_label, rules) if rules is not None else ''} "
                f"--format=csv "
+               f"{compilation_cache}"
                f"--output={output_dir}/{output_label}-results.csv "
-               f"--ram={memory_str_to_megabytes(settings.MEMORY_PER_PROCESS)} "
-               f"--threads={settings.CPU_PER_PROCESS}")
+               f"--ram={ram} "
+               f"--threads={threads}")
         runner = CommandRunner.CommandRunner()
         runner.run_and_log(cmd, f"{output_dir}/{output_label}-analyzing.log",
                            timeout=timeout,
                            cwd=output_dir)
 
-def run_steps(task: Task.JellyTask, task_label: str, step: dict[str, any], max_cpus: int, max_memory:str, step_i: int):
+    making_db_log = f"{output_dir}/{output_label}-making-db.log"
+    if settings.CODEQL_DB_CACHE_MB > 0:
+        cache = CodeQLDatabaseCache()
+        with cache.database(cache.key(codeql_bin, str(source_root)), create_database, making_db_log) as database:
+            if database is not None:
+                analyze(database)
+        return
+
+    database = f"{settings.TMP_DIR}/{task_label}/{task.canonical_name}/{task.canonical_version}/{uuid.uuid1()}"
+    with TempDirectoryManager(database):
+        if create_database(database, making_db_log):
+            analyze(database)
+
+
+def _link_or_copy(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def codeql_batch(task: Task.JellyTask, task_label: str, source_roots: dict[str, str], rules: str | None = None,
+                 output_label: str = "codeql-batch", timeout: int = settings.TIMEOUT,
+                 threads: int | None = None, ram: int | None = None):
+    """
+    Analyze several source roots with one database and one CodeQL invocation of each command, and split the results
+    into {label}-results.csv, {label}-making-db.log and {label}-analyzing.log as if every root was analyzed by a
+    codeql step. The roots are linked into {staging}/{label}, so dataflow between roots is possible (e.g. a relative
+    import that leaves its root). Log lines that name no root are only in the logs of the batch,
+    {output_label}-making-db.log and {output_label}-analyzing.log.
+    :param source_roots: output label -> source root
+    :param timeout: of each command, which analyzes all roots
+    """
+    threads = threads or settings.CPU_PER_PROCESS
+    ram = ram or memory_str_to_megabytes(settings.MEMORY_PER_PROCESS)
+    output_dir = f"{settings.WORK_DIR}/{task_label}/{task.canonical_name}/{task.canonical_version}"
+    os.makedirs(output_dir, exist_ok=True)
+    roots = {}
+    for label, source_root in source_roots.items():
+        source_root = replace_variables(task, task_label, source_root)
+        if not os.path.exists(source_root):
+            logging.error(f"source root {source_root} not exists")
+            with open(f"{output_dir}/{label}-analyzing.log", "w") as f:
+                f.write(f"source root {source_root} not exists")
+            continue
+        roots[label] = source_root
+    if not roots:
+        return
+    compilation_cache = compilation_cache_option(task, task_label, rules)
+    staging = f"{settings.TMP_DIR}/{task_label}/{task.canonical_name}/{task.canonical_version}/{output_label}"
+    with TempDirectoryManager(staging):
+        for label, source_root in roots.items():
+            shutil.copytree(source_root, f"{staging}/{label}", symlinks=True, copy_function=_link_or_copy)
+        run_codeql(task, task_label, Path(staging), output_dir, rules, output_label, timeout, threads, ram,
+                   compilation_cache)
+    for suffix in ["making-db.log", "analyzing.log"]:
+        log = read_log(f"{output_dir}/{output_label}-{suffix}")
+        if log is None:
+            continue
+        lines = log.splitlines(keepends=True)
+        for label, source_root in roots.items():
+            with open(f"{output_dir}/{label}-{suffix}", "w") as f:
+                f.writelines(line.replace(f"{staging}/{label}/", f"{source_root}/") for line in lines
+                             if f"{staging}/{label}/" in line)
+    results = f"{output_dir}/{output_label}-results.csv"
+    if not os.path.exists(results):
+        return
+    # the path column is relative to the source root, here /{label}/...
+    rows = {label: [] for label in roots}
+    with open(results, newline="") as f:
+        for row in csv.reader(f):
+            label, _, path = row[4].lstrip("/").partition("/")
+            if label not in rows:
+                logging.warning(f"{results}: {row[4]} is in no source root")
+                continue
+            rows[label].append(row[:4] + [f"/{path}"] + row[5:])
+    for label, label_rows in rows.items():
+        with open(f"{output_dir}/{label}-results.csv", "w", newline="") as f:
+            csv.writer(f, quoting=csv.QUOTE_ALL).writerows(label_rows)
+
+
+def legacy_finish_file(step: dict[str, any], step_i: int) -> str | None:
+    """
+    The marker file a step writes when it is done if the run journal is disabled
+    """
+    if step["name"] in check_finish_task or (step["name"] == "exec_command" and step.get("require_source", False)):
+        return f".finished-{step_i}"
+    if step["name"] == "conditional_step":
+        return legacy_finish_file(step["execute"], step_i)
+    return None
+
+
+def run_steps(task: Task.JellyTask, task_label: str, step: dict[str, any], max_cpus: int, max_memory:str, step_i: int) -> bool:
+    """
+    :return: False if the step raised
+    """
     try:
-        _args = {key: value for key, value in step.items() if key != "name"}
+        _args = {key: value for key, value in step.items() if key not in STEP_SCHEDULING_KEYS}
         _args["task"] = task
         _args["task_label"] = task_label
-        if step["name"] in check_finish_task or (
-                step["name"] == "exec_command" and step.get("require_source", False)):
-            _args["finish_file"] = f".finished-{step_i}"
+        if not settings.RUN_JOURNAL and step["name"] != "conditional_step" and legacy_finish_file(step, step_i):
+            _args["finish_file"] = legacy_finish_file(step, step_i)
         # sub tasks which need dynamic_dir args
         if step["name"] in ["compare_to_dynamic", "link_dyn_callgraph"]:
             _args["dynamic_dir"] = dynamic_dir
         # TODO: refactoring this code
+        # the tools get max_cpus/max_memory: the task's budget, or the step's share when steps overlap
+        # (see run_step_graph), unless the step sets a limit itself
+        if step["name"] == "exec_command":
+            _args["max_memory"] = max_memory
         if step["name"] == "jelly":
             _args["cpus"] = max_cpus
             if "memory" not in _args:
                 _args["memory"] = max_memory
+        if step["name"] in ["codeql", "codeql_batch"]:
+            _args.setdefault("threads", max_cpus)
+            _args.setdefault("ram", memory_str_to_megabytes(max_memory))
         if step["name"] == "conditional_step":
             _args["max_cpus"] = max_cpus
             _args["max_memory"] = max_memory
             _args["step_i"] = step_i
         func = task_executor[step["name"]]
-        func(**_args)
+        result = func(**_args)
+        # a conditional step fails with the step it executes
+        return result is not False if step["name"] == "conditional_step" else True
     except Exception as e:
         print(f"Error in after_task {step['name']}")
         traceback.print_exc()
+        return False
+
+
+def run_journaled_step(task: Task.JellyTask, task_label: str, phase: str, step: dict[str, any], max_cpus: int,
+                       max_memory: str, step_i: int):
+    """
+    Run a step unless the run journal records it as done (or failed too often), and record its outcome
+    """
+    journal = open_journal(task_label)
+    if journal is None:
+        run_steps(task, task_label, step, max_cpus, max_memory, step_i)
+        return
+    unit = unit_key(task)
+    key = f"{phase}-{step_i}"
+    finish_file = legacy_finish_file(step, step_i)
+    task_dir = f"{settings.WORK_DIR}/{task_label}/{task.canonical_name}/{task.canonical_version}"
+    if not journal.should_run(unit, key, f"{task_dir}/{finish_file}" if finish_file else None):
+        return
+    journal.start_step(unit, key, step["name"])
+    with CommandRunner.record_commands() as commands:
+        ok = run_steps(task, task_label, step, max_cpus, max_memory, step_i)
+    journal.finish_step(unit, key, ok, commands)
+
+def _overlaps(paths_a: list[str], paths_b: list[str]) -> bool:
+    for a in paths_a:
+        for b in paths_b:
+            if a == b or a.startswith(b + os.sep) or b.startswith(a + os.sep):
+                return True
+    return False
+
+
+def step_dependencies(task: Task.JellyTask, task_label: str, steps: list[dict]) -> list[set[int]]:
+    """
+    For every step, the earlier steps it has to wait for. A step waits for an earlier one if it reads what
+    that one writes, or writes what that one reads or writes (paths overlap if one contains the other).
+    Steps that declare neither inputs nor outputs keep the sequential order: they wait for all earlier steps
+    and all later steps wait for them.
+    """
+    resolve = lambda paths: [os.path.normpath(replace_variables(task, task_label, p)) for p in paths]
+    declared = ["inputs" in step or "outputs" in step for step in steps]
+    inputs = [resolve(step.get("inputs", [])) for step in steps]
+    outputs = [resolve(step.get("outputs", [])) for step in steps]
+    dependencies = []
+    for i in range(len(steps)):
+        depends = set()
+        for j in range(i):
+            if not declared[i] or not declared[j] \
+                    or _overlaps(inputs[i], outputs[j]) \
+                    or _overlaps(outputs[i], outputs[j]) \
+                    or _overlaps(outputs[i], inputs[j]):
+                depends.add(j)
+        dependencies.append(depends)
+    return dependencies
+
+
+def run_step_graph(task: Task.JellyTask, task_label: str, steps: list[dict], max_cpus: int, max_memory: str,
+                   phase: str):
+    """
+    Run the steps of a task, running steps whose dependencies (see step_dependencies) are done concurrently
+    as long as their "cpus" (default max_cpus) and "memory_hint" (default max_memory) fit in the task's budget.
+    At least one step always runs. Since steps overlap, each one is limited to its "cpus" and "memory_hint"
+    instead of the task's budget.
+    """
+    if not any("inputs" in step or "outputs" in step for step in steps):
+        for [i, step] in enumerate(steps):
+            run_journaled_step(task, task_label, phase, step, max_cpus, max_memory, step_i=i)
+        return
+
+    dependencies = step_dependencies(task, task_label, steps)
+    cpus = [min(step.get("cpus", max_cpus), max_cpus) for step in steps]
+    memory = [step_memory_hint(step) for step in steps]
+    memory_budget = memory_str_to_megabytes(max_memory)
+    done, running, pending = set(), {}, list(range(len(steps)))
+    with ThreadPoolExecutor(max_workers=len(steps)) as executor:
+        while pending or running:
+            used_cpus = sum(cpus[i] for i in running.values())
+            used_memory = sum(memory[i] for i in running.values())
+            for i in list(pending):
+                if not dependencies[i] <= done:
+                    continue
+                if running and (used_cpus + cpus[i] > max_cpus or used_memory + memory[i] > memory_budget):
+                    continue
+                pending.remove(i)
+                running[executor.submit(run_journaled_step, task, task_label, phase, steps[i], cpus[i],
+                                        f"{min(memory[i], memory_budget)}m", i)] = i
+                used_cpus += cpus[i]
+                used_memory += memory[i]
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                done.add(running.pop(future))
+
 
 def conditional_step(task: Task.JellyTask, task_label: str, condition: str, execute: dict[str, str], max_cpus: int, max_memory: str, step_i:int):
     condition = replace_variables(task, task_label, condition)
     if eval(condition):
-        run_steps(task, task_label, execute, max_cpus, max_memory, step_i)
+        return run_steps(task, task_label, execute, max_cpus, max_memory, step_i)
 
 
 task_executor = {
     "jelly": jelly_wrapper,
     "codeql": codeql,
+    "codeql_batch": codeql_batch,
     "exec_command": exec_command,
     "rm": remove_dir,
     "hard_link": hard_link,
@@ -262,6 +503,123 @@ task_executor = {
 }
 
 
+def _task_tmp_dir(task: Task.JellyTask, task_label: str) -> str:
+    # TODO: use settings to config
+    return f"{settings.TMP_DIR}/{task_label}/{task.canonical_name}/{task.canonical_version}"
+
+
+def prepare_pipeline_task(task: Task.JellyTask, task_label: str, black_list_packages: list[Task.JellyTask],
+                          white_list_packages: list[Task.JellyTask] | None,
+                          pipeline: dict[str, list[dict[str, str]]],
+                          max_cpus: int = settings.CPU_PER_PROCESS,
+                          max_memory: str = settings.MEMORY_PER_PROCESS,
+                          ) -> list[Task.SubTask]:
+    """
+    Run the before steps of a task and install its sources if the later steps need them.
+    The tmp dir of the task is created here and removed by finish_pipeline_task.
+    :return: the sub-tasks still to run, in order
+    """
+    os.makedirs(_task_tmp_dir(task, task_label), exist_ok=True)
+    journal = open_journal(task_label)
+    task_unit = unit_key(task)
+    result_dir = f"{settings.WORK_DIR}/{task_label}/{task.canonical_name}/{task.canonical_version}"
+    if journal is not None:
+        journal.set_units([task_unit], "task", "running")
+    if "before" in pipeline:
+        if not os.path.exists(result_dir):
+            os.makedirs(result_dir, exist_ok=True)
+
+        run_step_graph(task, task_label, pipeline["before"], max_cpus, max_memory, "before")
+
+    all_actions = pipeline.get("sub_tasks", []) + pipeline.get("after", [])
+    need_source_code = False
+    for action in all_actions:
+        if "jelly" == action["name"]:
+            need_source_code = True
+        if "conditional_step" == action["name"] and action["execute"]["name"]=="jelly":
+            need_source_code = True
+        if "exec_command" == action["name"] and action.get("require_source", False):
+            need_source_code = True
+        if need_source_code:
+            break
+
+    if settings.INSTALL_DEPENDENCE and len(all_actions) > 0 and need_source_code:
+        if journal is None:
+            requires_source(lambda *args, **kwargs: None)(task, task_label, False, finish_file='.finished_prepare_package')
+        elif journal.should_run(task_unit, "install", f"{result_dir}/.finished_prepare_package_all"):
+            journal.start_step(task_unit, "install", "install")
+            with CommandRunner.record_commands() as commands:
+                requires_source(lambda *args, **kwargs: None)(task, task_label, False, finish_file='.finished_prepare_package')
+            # the exit codes of downloads and installs do not fail the task, like before the journal
+            journal.finish_step(task_unit, "install", True, [{**c, "exit_code": 0} for c in commands])
+
+    selected, skipped = [], []
+    if "sub_tasks" in pipeline:
+        statuses = journal.sub_units(task_unit) if journal is not None else {}
+        idx = 0
+        for _, sub_package in sub_packages(task):
+            output_dir = f"{settings.WORK_DIR}/{task_label}/{sub_package.canonical_name}/{sub_package.canonical_version}"
+            if journal is not None:
+                status = statuses.get(unit_key(sub_package))
+                if status in ("done", "skipped", "failed"):
+                    continue
+                # a sub-task of a run from before the journal is done if it has an out_dir
+                if status is None and journal.legacy and os.path.exists(output_dir):
+                    continue
+            # if we have out_dir, means subtask has been processed or being processed
+            elif os.path.exists(output_dir):
+                continue
+            idx += 1
+            # if has more than x sub packages, skip the rest
+            if idx > settings.MAX_SUB_PACKAGES:
+                break
+            if (sub_package in black_list_packages) or (white_list_packages and sub_package not in white_list_packages):
+                os.makedirs(output_dir, exist_ok=True)
+                skipped.append(unit_key(sub_package))
+                with open(f"{output_dir}/.skip", 'w'):
+                    continue
+            selected.append(sub_package)
+    if journal is not None:
+        journal.set_units(skipped, "sub_task", "skipped", task_unit)
+        journal.set_units([unit_key(sub_package) for sub_package in selected], "sub_task", "pending", task_unit)
+    return selected
+
+
+def run_pipeline_sub_task(sub_package: Task.SubTask, task_label: str, pipeline: dict[str, list[dict[str, str]]],
+                          max_cpus: int = settings.CPU_PER_PROCESS,
+                          max_memory: str = settings.MEMORY_PER_PROCESS, claim: bool = True):
+    """
+    :param claim: skip the sub-task if its output dir exists, i.e. another run has started it since it was
+        selected; False when a work queue already hands every sub-task to a single worker. With the run journal
+        the output dir of an interrupted sub-task exists, so it never claims.
+    """
+    journal = open_journal(task_label)
+    output_dir = f"{settings.WORK_DIR}/{task_label}/{sub_package.canonical_name}/{sub_package.canonical_version}"
+    try:
+        os.makedirs(output_dir, exist_ok=not claim or journal is not None)
+    except FileExistsError:
+        return
+    if journal is not None:
+        journal.set_units([unit_key(sub_package)], "sub_task", "running", unit_key(sub_package.task))
+    with TempDirectoryManager(_task_tmp_dir(sub_package, task_label)):
+        run_step_graph(sub_package, task_label, pipeline.get("sub_tasks", []), max_cpus, max_memory, "sub_tasks")
+    if journal is not None:
+        journal.finish_unit(unit_key(sub_package))
+
+
+def finish_pipeline_task(task: Task.JellyTask, task_label: str, pipeline: dict[str, list[dict[str, str]]],
+                         max_cpus: int = settings.CPU_PER_PROCESS,
+                         max_memory: str = settings.MEMORY_PER_PROCESS):
+    try:
+        if "after" in pipeline:
+            run_step_graph(task, task_label, pipeline["after"], max_cpus, max_memory, "after")
+        journal = open_journal(task_label)
+        if journal is not None:
+            journal.finish_unit(unit_key(task))
+    finally:
+        shutil.rmtree(_task_tmp_dir(task, task_label), ignore_errors=True)
+
+
 def run_pipeline_single(task: Task.JellyTask, task_label: str, black_list_packages: list[Task.JellyTask],
                         white_list_packages: list[Task.JellyTask] | None,
                         pipeline: dict[str, list[dict[str, str]]],
@@ -272,66 +630,76 @@ def run_pipeline_single(task: Task.JellyTask, task_label: str, black_list_packag
     if not ("before" in pipeline or "after" in pipeline or "sub_tasks" in pipeline):
         return
 
-    # TODO: use settings to config
-    with TempDirectoryManager(f"{settings.TMP_DIR}/{task_label}/{task.canonical_name}/{task.canonical_version}"):
-        if "before" in pipeline:
-            result_dir = f"{settings.WORK_DIR}/{task_label}/{task.canonical_name}/{task.canonical_version}"
-            if not os.path.exists(result_dir):
-                os.makedirs(result_dir, exist_ok=True)
-
-            for [i, step] in enumerate(pipeline["before"]):
-                run_steps(task, task_label, step, max_cpus, max_memory, step_i=i)
-
-        all_actions = pipeline.get("sub_tasks", []) + pipeline.get("after", [])
-        need_source_code = False
-        for action in all_actions:
-            if "jelly" == action["name"]:
-                need_source_code = True
-            if "conditional_step" == action["name"] and action["execute"]["name"]=="jelly":
-                need_source_code = True
-            if "exec_command" == action["name"] and action.get("require_source", False):
-                need_source_code = True
-            if need_source_code:
-                break
+    with TempDirectoryManager(_task_tmp_dir(task, task_label)):
+        for sub_package in prepare_pipeline_task(task, task_label, black_list_packages, white_list_packages,
+                                                 pipeline, max_cpus, max_memory):
+            run_pipeline_sub_task(sub_package, task_label, pipeline, max_cpus, max_memory)
+        finish_pipeline_task(task, task_label, pipeline, max_cpus, max_memory)
 
-        if settings.INSTALL_DEPENDENCE and len(all_actions) > 0 and need_source_code:
-            requires_source(lambda *args, **kwargs: None)(task, task_label, False, finish_file='.finished_prepare_package')
-        idx = 0
 
-        if "sub_tasks" in pipeline:
-            for _, sub_package in sub_packages(task):
-                output_dir = f"{settings.WORK_DIR}/{task_label}/{sub_package.canonical_name}/{sub_package.canonical_version}"
-                # if we have out_dir, means subtask has been processed or being processed
-                if os.path.exists(output_dir):
-                    continue
-                idx += 1
-                # if has more than x sub packages, skip the rest
-                if idx > settings.MAX_SUB_PACKAGES:
-                    break
-                # TODO: use settings to config
-                with TempDirectoryManager(f"{settings.TMP_DIR}/{task_label}/{sub_package.canonical_name}/{sub_package.canonical_version}"):
-                    os.makedirs(output_dir, exist_ok=True)
-                    if (sub_package in black_list_packages) or (white_list_packages and sub_package not in white_list_packages):
-                        output = f"{output_dir}/.skip"
-                        with open(output, 'w'):
-                            continue
-                    for [i, action] in enumerate(pipeline.get("sub_tasks",[])):
-                        run_steps(sub_package, task_label, action, max_cpus, max_memory, step_i=i)
+# units of a task run in this order of priority: a started task is finished before new tasks are prepared
+UNIT_PRIORITY = {"after": 0, "sub_task": 1, "prepare": 2}
 
-        if "after" in pipeline:
-            for [i, action] in enumerate(pipeline["after"]):
-                run_steps(task, task_label, action, max_cpus, max_memory, step_i=i)
 
-def run_pipeline(cli: Cli, db: str, task_label: str, script: str, black_list: str | None, white_list: str | None):
+def run_pipeline_units(cli: Cli, tasks: list[Task.JellyTask], task_label: str,
+                       black_list_packages: list[Task.JellyTask], white_list_packages: list[Task.JellyTask] | None,
+                       pipeline: dict[str, list[dict[str, str]]],
+                       max_cpus: int = settings.CPU_PER_PROCESS,
+                       max_memory: str = settings.MEMORY_PER_PROCESS):
     """
-    run with pipeline script
-    :param db: database.json file path
-    :param task_label: unique label for this group of tasks
-    :param black_list: don't analysis the task
-    :param script: script
+    Run the pipeline with every sub-task as its own unit of work, so the sub-packages of a large task spread over
+    all processes instead of running one after another in the process of the task. A task becomes a prepare unit
+    (before steps, installation), one unit per sub-task and an after unit once all its sub-tasks are done.
+    """
+    args = (task_label, pipeline, max_cpus, max_memory)
+    prepare_hint = steps_memory_hint(pipeline.get("before", []))
+    sub_task_hint = steps_memory_hint(pipeline.get("sub_tasks", []))
+    after_hint = steps_memory_hint(pipeline.get("after", []))
+    remaining: dict[Task.JellyTask, int] = {}
+    progress = {"tasks": 0, "sub_tasks": 0, "sub_tasks_done": 0}
+
+    def after_unit(task: Task.JellyTask) -> Unit:
+        return Unit(("after", task), finish_pipeline_task, (task, *args), after_hint, UNIT_PRIORITY["after"])
+
+    def on_done(unit: Unit, ok: bool, result) -> list[Unit]:
+        kind, task = unit.key[:2]
+        if kind == "prepare":
+            if not ok:
+                shutil.rmtree(_task_tmp_dir(task, task_label), ignore_errors=True)
+                return []
+            if not result:
+                return [after_unit(task)]
+            remaining[task] = len(result)
+            progress["sub_tasks"] += len(result)
+            return [Unit(("sub_task", task, sub_package), run_pipeline_sub_task, (sub_package, *args),
+                         sub_task_hint, UNIT_PRIORITY["sub_task"]) for sub_package in result]
+        if kind == "sub_task":
+            # a failed sub-task does not hold back the after steps, like in run_pipeline_single
+            remaining[task] -= 1
+            progress["sub_tasks_done"] += 1
+            if remaining[task] == 0:
+                del remaining[task]
+                return [after_unit(task)]
+        if kind == "after":
+            progress["tasks"] += 1
+            logging.info(f"Progress: {progress['tasks']}/{len(tasks)} tasks, "
+                         f"{progress['sub_tasks_done']}/{progress['sub_tasks']} sub-tasks of prepared tasks done")
+        return []
+
+    cli._batch_run_units(
+        [Unit(("prepare", task), prepare_pipeline_task,
+              (task, task_label, black_list_packages, white_list_packages, pipeline, max_cpus, max_memory),
+              prepare_hint, UNIT_PRIORITY["prepare"]) for task in tasks],
+        on_done)
+
+
+def load_pipeline(cli: Cli, db: str, task_label: str, script: str, black_list: str | None, white_list: str | None) -> dict:
+    """
+    Read the tasks and the pipeline script and apply its settings
+    :return: the run: tasks, task_label (TIMESTAMP resolved), black_list, white_list, pipeline (variables replaced),
+        dynamic_dir, results_dir, task_name, version_pattern
     """
     global dynamic_dir
-    global task_executor
     # cli._check_docker()
     tasks = read_db(db)
     if not script.endswith(".json"):
@@ -380,25 +748,105 @@ def run_pipeline(cli: Cli, db: str, task_label: str, script: str, black_list: st
     for [k, v] in micros.items():
         text = text.replace(k, v)
     pipeline = json.loads(text)
+    return {
+        "tasks": tasks,
+        "task_label": task_label,
+        "black_list": black_list_tasks,
+        "white_list": white_list_tasks,
+        "pipeline": pipeline,
+        "dynamic_dir": dynamic_dir,
+        "results_dir": micros["$RESULTS_DIR"],
+        "task_name": task_name,
+        "version_pattern": version_pattern,
+    }
+
+
+def task_independent_suite(rules: str) -> str:
     """
-    run sub tasks
+    :return: rules with the variables that do not depend on the task replaced
     """
-    if pipeline.get("sub_tasks") or pipeline.get("before") or pipeline.get("after"):
-        tmp_output_dir = f"{settings.TMP_DIR}/{task_label}"
-        with TempDirectoryManager(tmp_output_dir):
-            cli._batch_run(run_pipeline_single, tasks, task_label, black_list_tasks, white_list_tasks, pipeline,
-                           dynamic_dir, settings.CPU_PER_PROCESS, settings.MEMORY_PER_PROCESS)
+    for k, v in {"$BENCHMARK_DIR": settings.PROJECT_DIR, "$SCRIPT_DIR": settings.SCRIPT_DIR,
+                 "$CODE_QL_HOME": settings.CODE_QL_HOME}.items():
+        rules = rules.replace(k, str(v))
+    return rules
+
+
+def query_suites(pipeline: dict) -> list[str]:
     """
-    build database
+    The query suites of the codeql steps of a pipeline, with the variables that do not depend on the task replaced
     """
+    suites = []
+    for phase in ["before", "sub_tasks", "after"]:
+        for step in pipeline.get(phase) or []:
+            if step["name"] == "conditional_step":
+                step = step["execute"]
+            if step["name"] not in ["codeql", "codeql_batch"] or step.get("rules") is None:
+                continue
+            suite = task_independent_suite(step["rules"])
+            if "$" in suite:
+                logging.warning(f"Query suite {suite} depends on the task, its queries are compiled by every analysis")
+            elif suite not in suites:
+                suites.append(suite)
+    return suites
+
+
+def warm_query_suites(pipeline: dict):
+    """
+    Compile the query suites of a pipeline into CODEQL_COMPILATION_CACHE unless they are already
+    """
+    if not settings.CODEQL_COMPILATION_CACHE:
+        return
+    for suite in query_suites(pipeline):
+        warm_query_cache(f"{settings.CODE_QL_HOME}/codeql/codeql", suite, settings.CODEQL_COMPILATION_CACHE,
+                         threads=settings.CPU_PER_PROCESS)
+
+
+def build_databases(pipeline: dict, results_dir: str, task_name: str, version_pattern: str):
     if "db_builders" in pipeline:
         if "settings" in pipeline and "db_uri" not in pipeline["settings"]:
             raise Exception("db_uri is required for db_builders")
-        db_file = Path(micros["$RESULTS_DIR"], f"{task_name}.db")
+        db_file = Path(results_dir, f"{task_name}.db")
         if db_file.exists():
             os.remove(db_file)
         try:
-            make_db(micros["$RESULTS_DIR"], pipeline["settings"]["db_uri"], pipeline["db_builders"], version_pattern)
+            make_db(results_dir, pipeline["settings"]["db_uri"], pipeline["db_builders"], version_pattern)
         except Exception as e:
             print(f"Error in making db")
-            traceback.print_exc()
\ No newline at end of file
+            traceback.print_exc()
+
+
+def run_pipeline(cli: Cli, db: str, task_label: str, script: str, black_list: str | None, white_list: str | None):
+    """
+    run with pipeline script
+    :param db: database.json file path
+    :param task_label: unique label for this group of tasks
+    :param black_list: don't analysis the task
+    :param script: script
+    """
+    run = load_pipeline(cli, db, task_label, script, black_list, white_list)
+    tasks, task_label, pipeline = run["tasks"], run["task_label"], run["pipeline"]
+    # created before any result, so a results dir without journal is recognized as a run with marker files
+    journal = open_journal(task_label)
+    if journal is not None:
+        journal.set_task_name(run["task_name"])
+    warm_query_suites(pipeline)
+    if settings.COST_MODEL_ORDER:
+        tasks = order_tasks(tasks, run["task_name"], max(cli.processes, 1))
+    black_list_tasks, white_list_tasks = run["black_list"], run["white_list"]
+    cli.set_memory_hint(pipeline_memory_hint(pipeline))
+    """
+    run sub tasks
+    """
+    if pipeline.get("sub_tasks") or pipeline.get("before") or pipeline.get("after"):
+        tmp_output_dir = f"{settings.TMP_DIR}/{task_label}"
+        with TempDirectoryManager(tmp_output_dir):
+            if settings.SPLIT_SUB_TASKS and pipeline.get("sub_tasks"):
+                run_pipeline_units(cli, tasks, task_label, black_list_tasks, white_list_tasks, pipeline,
+                                   settings.CPU_PER_PROCESS, settings.MEMORY_PER_PROCESS)
+            else:
+                cli._batch_run(run_pipeline_single, tasks, task_label, black_list_tasks, white_list_tasks, pipeline,
+                               dynamic_dir, settings.CPU_PER_PROCESS, settings.MEMORY_PER_PROCESS)
+    """
+    build database
+    """
+    build_databases(pipeline, run["results_dir"], run["task_name"], run["version_pattern"])
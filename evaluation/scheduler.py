@@ -0,0 +1,209 @@
+import functools
+import heapq
+import itertools
+import logging
+import multiprocessing
+import traceback
+from queue import Empty
+from typing import Any, Callable, NamedTuple
+
+import psutil
+
+import settings
+from utils import memory_str_to_megabytes
+
+MB = 1024 * 1024
+# seconds to wait for the result of a unit whose process exited cleanly
+RESULT_TIMEOUT = 5
+
+
+def tree_rss(process: psutil.Process) -> int:
+    """
+    Resident memory of a process and all its descendants (node, CodeQL, ...) in bytes
+    """
+    total = 0
+    try:
+        processes = [process] + process.children(recursive=True)
+    except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+        return 0
+    for p in processes:
+        try:
+            total += p.memory_info().rss
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+            pass
+    return total
+
+
+def step_memory_hint(step: dict) -> int:
+    """
+    Expected peak memory of a pipeline step in MB: its "memory_hint", otherwise MEMORY_PER_PROCESS
+    """
+    if "memory_hint" in step:
+        return memory_str_to_megabytes(step["memory_hint"])
+    if step.get("name") == "conditional_step":
+        return step_memory_hint(step["execute"])
+    return memory_str_to_megabytes(settings.MEMORY_PER_PROCESS)
+
+
+def steps_memory_hint(steps: list[dict]) -> int:
+    """
+    Expected peak memory of a list of steps in MB. Steps run one after another, unless they declare
+    inputs/outputs, in which case the steps whose "cpus" fit in CPU_PER_PROCESS and whose hints fit in
+    MEMORY_PER_PROCESS may run concurrently: the peak is the largest sum of hints of such a set
+    """
+    budget = memory_str_to_megabytes(settings.MEMORY_PER_PROCESS)
+    hints = [step_memory_hint(step) for step in steps]
+    if not hints:
+        return budget
+    if not any("inputs" in step or "outputs" in step for step in steps):
+        return max(hints)
+    # (cpus, memory) of the sets of steps that can run at the same time
+    sets = {(0, 0)}
+    for step, hint in zip(steps, hints):
+        cpus = min(step.get("cpus", settings.CPU_PER_PROCESS), settings.CPU_PER_PROCESS)
+        sets |= {(c + cpus, m + hint) for c, m in sets
+                 if c + cpus <= settings.CPU_PER_PROCESS and m + hint <= budget}
+    return max(max(hints), max(m for _, m in sets))
+
+
+def pipeline_memory_hint(pipeline: dict) -> int:
+    """
+    Expected peak memory of one task of a pipeline in MB
+    """
+    phases = [pipeline.get(phase) for phase in ["before", "sub_tasks", "after"] if pipeline.get(phase)]
+    if not phases:
+        return memory_str_to_megabytes(settings.MEMORY_PER_PROCESS)
+    return max(steps_memory_hint(steps) for steps in phases)
+
+
+class Unit(NamedTuple):
+    """
+    A schedulable piece of work: f(*args) in a child process
+    :param key: identifies the unit for the caller, e.g. ("sub", task, sub_task)
+    :param priority: lower runs first, units of equal priority run in submission order
+    """
+    key: Any
+    f: Callable
+    args: tuple
+    memory_hint_mb: int
+    priority: int = 0
+
+
+def _drain(results, finished: dict[int, tuple[bool, Any]], timeout: float) -> bool:
+    """
+    Move the results of finished units into finished, waiting up to timeout for the first one
+    :return: whether there was any
+    """
+    drained = False
+    while True:
+        try:
+            unit_id, ok, result = results.get(timeout=timeout) if timeout else results.get_nowait()
+        except Empty:
+            return drained
+        finished[unit_id] = (ok, result)
+        drained, timeout = True, 0
+
+
+def _run_unit(results, unit_id: int, f: Callable, args: tuple):
+    try:
+        results.put((unit_id, True, f(*args)))
+    except BaseException:
+        results.put((unit_id, False, traceback.format_exc()))
+        raise
+
+
+class MemoryScheduler:
+    """
+    Run units in child processes from a shared priority queue, admitting a new one only while the machine
+    has memory for it.
+
+    A running unit reserves its memory hint until its process tree actually uses that much, so units that
+    are just starting are accounted for; beyond that the live resident memory (via psutil) decides. A unit
+    is admitted if the available memory minus the outstanding reservations and MEMORY_RESERVE covers its
+    hint. One unit is always allowed to run, so a hint larger than the machine cannot stall the batch.
+    """
+
+    def __init__(self, max_processes: int, memory_hint_mb: int, reserve_mb: int | None = None,
+                 poll_interval: float = settings.SCHEDULER_POLL_INTERVAL, memory_aware: bool = True):
+        """
+        :param memory_aware: if False, only max_processes limits the running units
+        """
+        self.max_processes = max_processes
+        self.memory_hint = memory_hint_mb
+        self.reserve = (reserve_mb if reserve_mb is not None else memory_str_to_megabytes(settings.MEMORY_RESERVE)) * MB
+        self.poll_interval = poll_interval
+        self.memory_aware = memory_aware
+        self.running: dict[int, tuple[multiprocessing.Process, psutil.Process, Unit]] = {}
+        self.failed: list[str] = []
+
+    def outstanding(self) -> int:
+        """
+        Memory the running units are expected to grow into
+        """
+        return sum(max(unit.memory_hint_mb * MB - tree_rss(p), 0) for _, p, unit in self.running.values())
+
+    def admissible_memory(self) -> int | None:
+        """
+        Largest memory hint in MB a new unit can have to be admitted now, None if there is no limit
+        """
+        if not self.running or not self.memory_aware:
+            return None
+        return (psutil.virtual_memory().available - self.outstanding() - self.reserve) // MB
+
+    def can_admit(self, unit: Unit) -> bool:
+        if not self.running:
+            return True
+        if len(self.running) >= self.max_processes:
+            return False
+        limit = self.admissible_memory()
+        return limit is None or unit.memory_hint_mb <= limit
+
+    def run(self, f: Callable, tasks: list, *args, **kwargs):
+        """
+        Call f(task, *args, **kwargs) for every task in its own process
+        """
+        call = functools.partial(f, **kwargs) if kwargs else f
+        self.run_units([Unit(str(task), call, (task, *args), self.memory_hint) for task in tasks])
+
+    def run_units(self, units: list[Unit], on_done: Callable[[Unit, bool, Any], list[Unit]] | None = None):
+        """
+        Run units until the queue is empty.
+        :param on_done: called in this process with a finished unit, whether it succeeded and its return value
+            (the traceback if it failed); the units it returns are added to the queue
+        """
+        queue: list[tuple[int, int, Unit]] = []
+        sequence = itertools.count()
+        for unit in units:
+            heapq.heappush(queue, (unit.priority, next(sequence), unit))
+        results = multiprocessing.Queue()
+        finished: dict[int, tuple[bool, Any]] = {}
+        held = False
+        while queue or self.running:
+            # drain the results before joining, a child exits only once its result is read
+            _drain(results, finished, self.poll_interval if self.running else 0)
+            for unit_id, (process, _, unit) in list(self.running.items()):
+                if unit_id not in finished and process.is_alive():
+                    continue
+                process.join()
+                # a child that put its result and exited after the drain above: its result is in the pipe by now
+                while unit_id not in finished and process.exitcode == 0 and _drain(results, finished, RESULT_TIMEOUT):
+                    pass
+                ok, result = finished.pop(unit_id, (False, f"exited with code {process.exitcode}"))
+                del self.running[unit_id]
+                if not ok:
+                    logging.error(f"Unit {unit.key} failed: {result}")
+                    self.failed.append(str(unit.key))
+                for new_unit in (on_done(unit, ok, result) if on_done else None) or []:
+                    heapq.heappush(queue, (new_unit.priority, next(sequence), new_unit))
+            while queue and self.can_admit(queue[0][2]):
+                _, unit_id, unit = heapq.heappop(queue)
+                process = multiprocessing.Process(target=_run_unit, args=(results, unit_id, unit.f, unit.args))
+                process.start()
+                self.running[unit_id] = (process, psutil.Process(process.pid), unit)
+                held = False
+            if queue and not held:
+                held = True
+                logging.info(f"Holding {len(queue)} units: {len(self.running)} running, "
+                             f"{psutil.virtual_memory().available // MB} MB available")
+        if self.failed:
+            raise RuntimeError(f"{len(self.failed)} units failed: {', '.join(self.failed[:10])}")
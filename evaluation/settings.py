@@ -18,12 +18,38 @@ OLD_PACKAGE_FORMAT=False
 PROCESSES = 4
 CPU_PER_PROCESS = 4
 MEMORY_PER_PROCESS = "30g"
+# Admit tasks by the free memory (psutil) and the memory_hint of the pipeline steps, PROCESSES is then an upper bound
+MEMORY_SCHEDULER = True
+# Memory kept free for the system when admitting tasks
+MEMORY_RESERVE = "4g"
+SCHEDULER_POLL_INTERVAL = 2
+# Schedule the sub-tasks of a pipeline as separate units, so the sub-packages of one large task spread over all processes
+SPLIT_SUB_TASKS = True
+# Distributed runs (workqueue.py): a unit whose lease is not renewed for this long is handed out again
+QUEUE_LEASE_SECONDS = 300
+QUEUE_MAX_ATTEMPTS = 3
+# Record the state of every step in {WORK_DIR}/{task_label}/journal.db instead of .finished marker files
+RUN_JOURNAL = True
+# Resuming a run retries a failed step until it has been attempted this often
+STEP_MAX_ATTEMPTS = 2
+# Start the tasks expected to take longest first (costmodel.py), from past durations and the size of their sources
+COST_MODEL_ORDER = True
+# Logs of commands (CommandRunner.run_and_log) are streamed to their file. Beyond LOG_MAX_BYTES only the last
+# LOG_TAIL_BYTES are kept, and logs larger than LOG_COMPRESS_OVER bytes are gzipped to .log.gz (None disables either)
+LOG_MAX_BYTES = 1024 * 1024 * 1024
+LOG_TAIL_BYTES = 64 * 1024
+LOG_COMPRESS_OVER = None
 TIMEOUT = 60 * 40
 USE_PNPM = False
 RUNNING_IN_DOCKER = False
 INSTALL_DEPENDENCE = True
 CODE_QL_HOME = os.getenv('CODE_QL_HOME', '/codeql-home')
 MAX_SUB_PACKAGES = 987654321
+# CodeQL databases are cached by the content of their source root (codeql_cache.py), 0 disables the cache
+CODEQL_DB_CACHE_DIR = os.path.join(PROJECT_DIR, "codeql-db-cache")
+CODEQL_DB_CACHE_MB = 50 * 1024
+# the query suites of a pipeline are compiled once into this cache before the run, None compiles them in every analysis
+CODEQL_COMPILATION_CACHE = os.path.join(PROJECT_DIR, "codeql-compilation-cache")
 
 JELLY_PATH = os.path.join(PROJECT_DIR, "..", "d-bundlr", "lib")
 
@@ -36,6 +62,34 @@ if os.path.exists(os.path.join(SCRIPT_DIR, local_settings_path)):
         PROCESSES = local_settings.PROCESSES
     if hasattr(local_settings, "MEMORY_PER_PROCESS"):
         MEMORY_PER_PROCESS = local_settings.MEMORY_PER_PROCESS
+    if hasattr(local_settings, "MEMORY_SCHEDULER"):
+        MEMORY_SCHEDULER = local_settings.MEMORY_SCHEDULER
+    if hasattr(local_settings, "MEMORY_RESERVE"):
+        MEMORY_RESERVE = local_settings.MEMORY_RESERVE
+    if hasattr(local_settings, "SPLIT_SUB_TASKS"):
+        SPLIT_SUB_TASKS = local_settings.SPLIT_SUB_TASKS
+    if hasattr(local_settings, "QUEUE_LEASE_SECONDS"):
+        QUEUE_LEASE_SECONDS = local_settings.QUEUE_LEASE_SECONDS
+    if hasattr(local_settings, "QUEUE_MAX_ATTEMPTS"):
+        QUEUE_MAX_ATTEMPTS = local_settings.QUEUE_MAX_ATTEMPTS
+    if hasattr(local_settings, "RUN_JOURNAL"):
+        RUN_JOURNAL = local_settings.RUN_JOURNAL
+    if hasattr(local_settings, "STEP_MAX_ATTEMPTS"):
+        STEP_MAX_ATTEMPTS = local_settings.STEP_MAX_ATTEMPTS
+    if hasattr(local_settings, "COST_MODEL_ORDER"):
+        COST_MODEL_ORDER = local_settings.COST_MODEL_ORDER
+    if hasattr(local_settings, "CODEQL_DB_CACHE_DIR"):
+        CODEQL_DB_CACHE_DIR = local_settings.CODEQL_DB_CACHE_DIR
+    if hasattr(local_settings, "CODEQL_DB_CACHE_MB"):
+        CODEQL_DB_CACHE_MB = local_settings.CODEQL_DB_CACHE_MB
+    if hasattr(local_settings, "CODEQL_COMPILATION_CACHE"):
+        CODEQL_COMPILATION_CACHE = local_settings.CODEQL_COMPILATION_CACHE
+    if hasattr(local_settings, "LOG_MAX_BYTES"):
+        LOG_MAX_BYTES = local_settings.LOG_MAX_BYTES
+    if hasattr(local_settings, "LOG_TAIL_BYTES"):
+        LOG_TAIL_BYTES = local_settings.LOG_TAIL_BYTES
+    if hasattr(local_settings, "LOG_COMPRESS_OVER"):
+        LOG_COMPRESS_OVER = local_settings.LOG_COMPRESS_OVER
     if hasattr(local_settings, "TIMEOUT"):
         TIMEOUT = local_settings.TIMEOUT
     if hasattr(local_settings, "JELLY_PATH"):
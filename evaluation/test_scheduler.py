@@ -0,0 +1,32 @@
+import pytest
+
+pytest.importorskip("psutil")
+
+from scheduler import MemoryScheduler, Unit, steps_memory_hint
+
+
+def _identity(i):
+    return i
+
+
+def test_many_short_units_all_succeed():
+    # a child that puts its result and exits between draining the results and is_alive must not count as failed
+    results = {}
+
+    def on_done(unit, ok, result):
+        results[unit.key] = (ok, result)
+        return []
+
+    units = [Unit(i, _identity, (i,), 1) for i in range(1000)]
+    MemoryScheduler(8, 1, reserve_mb=0, poll_interval=2, memory_aware=False).run_units(units, on_done)
+    assert results == {i: (True, i) for i in range(1000)}
+
+
+def test_steps_memory_hint_of_overlapping_steps(monkeypatch):
+    monkeypatch.setattr("settings.CPU_PER_PROCESS", 4)
+    monkeypatch.setattr("settings.MEMORY_PER_PROCESS", "30g")
+    unpack = {"name": "exec_command", "inputs": [], "cpus": 1, "memory_hint": "6g"}
+    analyze = {"name": "codeql", "inputs": [], "cpus": 2, "memory_hint": "8g"}
+    # at most two unpacks and one analysis, or two analyses, fit in 4 cores at a time
+    assert steps_memory_hint([unpack, analyze, unpack, analyze, analyze]) == 20 * 1024
+    assert steps_memory_hint([{"name": "jelly"}]) == 30 * 1024
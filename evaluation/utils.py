@@ -1,3 +1,4 @@
+import gzip
 import hashlib
 import os
 import re
@@ -18,6 +19,27 @@ def memory_str_to_megabytes(memory: str) -> int:
     return memory
 
 
+def log_path(path: str) -> str | None:
+    """
+    The log written for path: path itself, or path.gz if CommandRunner compressed it; None if there is none
+    """
+    for candidate in [path, f"{path}.gz"]:
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def read_log(path: str) -> str | None:
+    """
+    Text of a log that may have been compressed, None if it does not exist
+    """
+    path = log_path(path)
+    if path is None:
+        return None
+    with (gzip.open(path, "rt", errors="replace") if path.endswith(".gz") else open(path, errors="replace")) as f:
+        return f.read()
+
+
 def md5_string(input_string: str) -> str:
     hash_md5 = hashlib.md5()
     hash_md5.update(input_string.encode('utf-8'))
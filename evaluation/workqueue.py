@@ -0,0 +1,315 @@
+"""
+Durable work queue for running a pipeline on several machines.
+
+A coordinator enqueues the tasks of a dataset into a SQLite file on storage that all nodes share (WORK_DIR and
+PACKAGES_DIR must be shared as well, TMP_DIR can stay local; the file system needs working POSIX locks, e.g. NFSv4).
+On a single machine a local file is the broker. Workers lease units, renew their leases while the units run and
+complete them. A lease that is not renewed, because its node died, expires and the unit is handed out again, at
+most QUEUE_MAX_ATTEMPTS times.
+
+Like run_pipeline_units, a task is first a prepare unit (before steps, installation). Completing it enqueues one
+unit per sub-task, and the last finished sub-task enqueues the after unit. The steps of a sub-task stay in one
+unit since they share its node-local tmp dir.
+
+    ./cli.py pipeline-enqueue ./bundle_project/table3/dataset.part1.json /shared/table3.queue \\
+        --script ./bundle_project/table3/pipeline.json --task-label table3
+    ./cli.py pipeline-worker /shared/table3.queue --processes 8    # on every node
+    ./cli.py pipeline-status /shared/table3.queue
+    ./cli.py pipeline-build-db /shared/table3.queue table3         # once the queue is drained
+"""
+import logging
+import multiprocessing
+import os
+import pickle
+import shutil
+import socket
+import sqlite3
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+
+import psutil
+
+import JellyTask as Task
+import settings
+from costmodel import order_tasks
+from journal import open_journal
+from scheduler import MemoryScheduler, Unit, steps_memory_hint
+
+# lower is leased first: a started task is finished before new tasks are prepared
+PRIORITY = {"after": 0, "sub_task": 1, "prepare": 2}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    label TEXT PRIMARY KEY,
+    config BLOB NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    label TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    task_key TEXT NOT NULL,
+    name TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    memory_hint INTEGER NOT NULL,
+    priority INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    UNIQUE (label, kind, name)
+);
+CREATE INDEX IF NOT EXISTS units_ready ON units (state, priority, id);
+CREATE INDEX IF NOT EXISTS units_task ON units (label, task_key, kind, state);
+"""
+
+
+class WorkQueue:
+    def __init__(self, path: str, max_attempts: int = settings.QUEUE_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        # no WAL: it needs shared memory, which a network file system does not provide
+        self.db = sqlite3.connect(path, timeout=120, isolation_level=None)
+        self.db.executescript(SCHEMA)
+
+    @contextmanager
+    def _transaction(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.db
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def add_run(self, label: str, config: dict):
+        with self._transaction() as db:
+            db.execute("INSERT OR REPLACE INTO runs (label, config, created) VALUES (?, ?, ?)",
+                       (label, pickle.dumps(config), time.time()))
+
+    def run_config(self, label: str) -> dict:
+        row = self.db.execute("SELECT config FROM runs WHERE label = ?", (label,)).fetchone()
+        if row is None:
+            raise KeyError(f"No run {label} in {self.path}")
+        return pickle.loads(row[0])
+
+    @staticmethod
+    def _insert(db, label: str, kind: str, task_key: str, task: Task.JellyTask, memory_hint: int) -> int:
+        # units are unique per run, enqueueing the same dataset again does not duplicate them
+        cursor = db.execute(
+            "INSERT OR IGNORE INTO units (label, kind, task_key, name, payload, memory_hint, priority, created) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (label, kind, task_key, str(task), pickle.dumps(task), memory_hint, PRIORITY[kind], time.time()))
+        return cursor.rowcount
+
+    def enqueue(self, label: str, tasks: list[Task.JellyTask], memory_hint: int) -> int:
+        with self._transaction() as db:
+            return sum(self._insert(db, label, "prepare", str(task), task, memory_hint) for task in tasks)
+
+    def lease(self, owner: str, lease_seconds: float, max_memory_hint: int | None = None) -> tuple | None:
+        """
+        Lease the next unit whose memory hint fits
+        :return: (id, label, kind, payload, memory_hint) or None
+        """
+        now = time.time()
+        with self._transaction() as db:
+            self._expire(db, now)
+            row = db.execute(
+                "SELECT id, label, kind, payload, memory_hint FROM units WHERE state = 'pending' "
+                "AND (? IS NULL OR memory_hint <= ?) ORDER BY priority, id LIMIT 1",
+                (max_memory_hint, max_memory_hint)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE units SET state = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1, "
+                       "started = ? WHERE id = ?", (owner, now + lease_seconds, now, row[0]))
+            return row
+
+    def _expire(self, db, now: float):
+        expired = db.execute("SELECT id, label, kind, task_key, attempts FROM units "
+                             "WHERE state = 'leased' AND lease_expires < ?", (now,)).fetchall()
+        for unit_id, label, kind, task_key, attempts in expired:
+            logging.warning(f"Lease of unit {unit_id} expired after attempt {attempts}")
+            self._finish_attempt(db, unit_id, label, kind, task_key, attempts, "lease expired")
+
+    def _finish_attempt(self, db, unit_id: int, label: str, kind: str, task_key: str, attempts: int, error: str):
+        if attempts < self.max_attempts:
+            db.execute("UPDATE units SET state = 'pending', owner = NULL, lease_expires = NULL, error = ? "
+                       "WHERE id = ?", (error, unit_id))
+            return
+        db.execute("UPDATE units SET state = 'failed', owner = NULL, error = ?, finished = ? WHERE id = ?",
+                   (error, time.time(), unit_id))
+        if kind == "sub_task":
+            # a failed sub-task does not hold back the after steps, like in run_pipeline_single
+            self._enqueue_after(db, label, task_key)
+
+    def _enqueue_after(self, db, label: str, task_key: str):
+        left = db.execute("SELECT COUNT(*) FROM units WHERE label = ? AND task_key = ? AND kind = 'sub_task' "
+                          "AND state IN ('pending', 'leased')", (label, task_key)).fetchone()[0]
+        if left:
+            return
+        task = pickle.loads(db.execute("SELECT payload FROM units WHERE label = ? AND task_key = ? "
+                                       "AND kind = 'prepare'", (label, task_key)).fetchone()[0])
+        hints = pickle.loads(db.execute("SELECT config FROM runs WHERE label = ?", (label,)).fetchone()[0])["hints"]
+        self._insert(db, label, "after", task_key, task, hints["after"])
+
+    def _owned(self, db, unit_id: int, owner: str) -> tuple | None:
+        return db.execute("SELECT label, kind, task_key, attempts FROM units WHERE id = ? AND owner = ? "
+                          "AND state = 'leased'", (unit_id, owner)).fetchone()
+
+    def heartbeat(self, owner: str, unit_ids: list[int], lease_seconds: float):
+        with self._transaction() as db:
+            db.executemany("UPDATE units SET lease_expires = ? WHERE id = ? AND owner = ? AND state = 'leased'",
+                           [(time.time() + lease_seconds, unit_id, owner) for unit_id in unit_ids])
+
+    def complete(self, unit_id: int, owner: str, sub_tasks: list[Task.SubTask] | None = None) -> bool:
+        """
+        :param sub_tasks: for a prepare unit, the sub-tasks to enqueue
+        :return: False if the lease was lost, the unit then runs again elsewhere
+        """
+        with self._transaction() as db:
+            owned = self._owned(db, unit_id, owner)
+            if owned is None:
+                return False
+            label, kind, task_key, _ = owned
+            db.execute("UPDATE units SET state = 'done', owner = NULL, finished = ? WHERE id = ?",
+                       (time.time(), unit_id))
+            if kind == "prepare":
+                hint = pickle.loads(db.execute("SELECT config FROM runs WHERE label = ?",
+                                               (label,)).fetchone()[0])["hints"]["sub_task"]
+                for sub_task in sub_tasks or []:
+                    self._insert(db, label, "sub_task", task_key, sub_task, hint)
+            if kind in ("prepare", "sub_task"):
+                self._enqueue_after(db, label, task_key)
+            return True
+
+    def fail(self, unit_id: int, owner: str, error: str):
+        with self._transaction() as db:
+            owned = self._owned(db, unit_id, owner)
+            if owned is not None:
+                label, kind, task_key, attempts = owned
+                self._finish_attempt(db, unit_id, label, kind, task_key, attempts, error)
+
+    def idle(self) -> bool:
+        return self.db.execute("SELECT COUNT(*) FROM units WHERE state IN ('pending', 'leased')").fetchone()[0] == 0
+
+    def status(self) -> dict:
+        counts = {}
+        for label, kind, state, n in self.db.execute(
+                "SELECT label, kind, state, COUNT(*) FROM units GROUP BY label, kind, state"):
+            counts.setdefault(label, {}).setdefault(kind, {})[state] = n
+        failed = [{"label": label, "unit": name, "error": error} for label, name, error in self.db.execute(
+            "SELECT label, name, error FROM units WHERE state = 'failed' ORDER BY finished")]
+        leased = [{"label": label, "unit": name, "owner": owner, "running_s": round(time.time() - started)}
+                  for label, name, owner, started in self.db.execute(
+                      "SELECT label, name, owner, started FROM units WHERE state = 'leased' ORDER BY started")]
+        return {"units": counts, "leased": leased, "failed": failed}
+
+
+def enqueue(path: str, run: dict) -> int:
+    """
+    :param run: a run loaded by pipeline.load_pipeline
+    :return: number of newly enqueued tasks
+    """
+    pipeline = run["pipeline"]
+    queue = WorkQueue(path)
+    journal = open_journal(run["task_label"])
+    if journal is not None:
+        journal.set_task_name(run["task_name"])
+    hints = {phase: steps_memory_hint(pipeline.get(phase, [])) for phase in ["before", "sub_tasks", "after"]}
+    queue.add_run(run["task_label"], {
+        "pipeline": pipeline,
+        "black_list": run["black_list"],
+        "white_list": run["white_list"],
+        "dynamic_dir": run["dynamic_dir"],
+        "max_cpus": settings.CPU_PER_PROCESS,
+        "max_memory": settings.MEMORY_PER_PROCESS,
+        "results_dir": run["results_dir"],
+        "task_name": run["task_name"],
+        "version_pattern": run["version_pattern"],
+        "hints": {"prepare": hints["before"], "sub_task": hints["sub_tasks"], "after": hints["after"]},
+    })
+    from pipeline import warm_query_suites
+    warm_query_suites(pipeline)
+    # units are leased in order, the longest tasks go first
+    tasks = order_tasks(run["tasks"], run["task_name"]) if settings.COST_MODEL_ORDER else run["tasks"]
+    return queue.enqueue(run["task_label"], tasks, hints["before"])
+
+
+def _run_leased(path: str, owner: str, unit_id: int, label: str, kind: str, payload: bytes):
+    import pipeline as pipeline_module
+    from pipeline import (_task_tmp_dir, finish_pipeline_task, prepare_pipeline_task, run_pipeline_sub_task,
+                          warm_query_suites)
+
+    queue = WorkQueue(path)
+    # the failure is recorded here, the worker only records crashes (non-zero exit codes)
+    try:
+        config = queue.run_config(label)
+        pipeline_module.dynamic_dir = config["dynamic_dir"]
+        task = pickle.loads(payload)
+        pipeline, max_cpus, max_memory = config["pipeline"], config["max_cpus"], config["max_memory"]
+        # compiled by the coordinator if the cache is shared, otherwise by the first unit on this node while the
+        # others wait for it
+        warm_query_suites(pipeline)
+        sub_tasks = None
+        if kind == "prepare":
+            try:
+                sub_tasks = prepare_pipeline_task(task, label, config["black_list"], config["white_list"], pipeline,
+                                                  max_cpus, max_memory)
+            finally:
+                # the after unit may run on another node
+                shutil.rmtree(_task_tmp_dir(task, label), ignore_errors=True)
+        elif kind == "sub_task":
+            run_pipeline_sub_task(task, label, pipeline, max_cpus, max_memory, claim=False)
+        else:
+            os.makedirs(_task_tmp_dir(task, label), exist_ok=True)
+            finish_pipeline_task(task, label, pipeline, max_cpus, max_memory)
+        if not queue.complete(unit_id, owner, sub_tasks):
+            logging.warning(f"Lease of unit {unit_id} was lost before it completed")
+    except Exception:
+        logging.error(f"Unit {unit_id} failed:\n{traceback.format_exc()}")
+        queue.fail(unit_id, owner, traceback.format_exc())
+
+
+def worker(path: str, processes: int, lease_seconds: float = settings.QUEUE_LEASE_SECONDS,
+           poll_interval: float = settings.SCHEDULER_POLL_INTERVAL, wait: bool = False):
+    """
+    Lease and run units until the queue is drained
+    :param processes: maximum number of units to run at a time, with MEMORY_SCHEDULER as long as memory is available
+    :param wait: keep polling for new units when the queue is drained
+    """
+    queue = WorkQueue(path)
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    scheduler = MemoryScheduler(processes, 0, memory_aware=settings.MEMORY_SCHEDULER)
+    logging.info(f"Worker {owner} on {path} with {processes} processes")
+    last_heartbeat = time.time()
+    while True:
+        for unit_id, (process, _, unit) in list(scheduler.running.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del scheduler.running[unit_id]
+            if process.exitcode != 0:
+                queue.fail(unit_id, owner, f"exited with code {process.exitcode}")
+        if scheduler.running and time.time() - last_heartbeat > lease_seconds / 3:
+            queue.heartbeat(owner, list(scheduler.running), lease_seconds)
+            last_heartbeat = time.time()
+        while len(scheduler.running) < processes:
+            leased = queue.lease(owner, lease_seconds, scheduler.admissible_memory())
+            if leased is None:
+                break
+            unit_id, label, kind, payload, memory_hint = leased
+            logging.info(f"Running {kind} unit {unit_id} of {label}")
+            process = multiprocessing.Process(target=_run_leased, args=(path, owner, unit_id, label, kind, payload))
+            process.start()
+            scheduler.running[unit_id] = (process, psutil.Process(process.pid), Unit((label, kind), _run_leased, (),
+                                                                                     memory_hint, PRIORITY[kind]))
+        if not scheduler.running and not wait and queue.idle():
+            logging.info(f"Worker {owner}: queue drained")
+            return
+        time.sleep(poll_interval)